@@ -1,3 +1,4 @@
+import contextlib
 from typing import Tuple
 
 import torch as th
@@ -15,7 +16,11 @@ class KLDivergence(nn.Module):
     def forward(self, mean: th.Tensor, var: th.Tensor) -> th.Tensor:
         device = mean.device
 
-        kld = th.tensor(-0.5).to(device) * (1 + var.log() - mean.pow(2) - var).mean()
+        # under mixed precision, the log of small variances and the sum over latents need float32.
+        no_autocast = th.autocast(device.type, enabled=False) if hasattr(th, 'autocast') else contextlib.suppress()
+        with no_autocast:
+            mean, var = mean.float(), var.float()
+            kld = th.tensor(-0.5).to(device) * (1 + var.log() - mean.pow(2) - var).mean()
 
         return kld
 
@@ -0,0 +1,135 @@
+import typing as t
+
+import torch as th
+import torch.nn.functional as func
+
+BATCH = t.Tuple[th.Tensor, th.Tensor, th.Tensor]
+EPS = 1e-8
+
+
+def rgb_to_hsv(_in: th.Tensor) -> th.Tensor:
+    r, g, b = _in.unbind(dim=-3)
+    max_c, _ = _in.max(dim=-3)
+    min_c, _ = _in.min(dim=-3)
+    delta = max_c - min_c
+    delta_c = delta.clamp(min=EPS)
+
+    rc, gc, bc = (max_c - r) / delta_c, (max_c - g) / delta_c, (max_c - b) / delta_c
+    h = th.where(max_c == r, bc - gc, th.where(max_c == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = th.where(delta > 0, (h / 6.0) % 1.0, th.zeros_like(h))
+    s = th.where(max_c > 0, delta / max_c.clamp(min=EPS), th.zeros_like(delta))
+
+    return th.stack([h, s, max_c], dim=-3)
+
+
+def hsv_to_rgb(_in: th.Tensor) -> th.Tensor:
+    h, s, v = _in.unbind(dim=-3)
+    i = th.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p, q, _t = v * (1.0 - s), v * (1.0 - s * f), v * (1.0 - s * (1.0 - f))
+
+    sector = i.unsqueeze(-3)
+    r = th.stack([v, q, p, p, _t, v], dim=-3).gather(-3, sector)
+    g = th.stack([_t, v, v, q, p, p], dim=-3).gather(-3, sector)
+    b = th.stack([p, p, _t, v, v, q], dim=-3).gather(-3, sector)
+
+    return th.cat([r, g, b], dim=-3)
+
+
+class BatchAugment(object):
+    """Vectorised counterpart of the imgaug train sequence, applied to whole (B, T, C, H, W) batches in [0, 1].
+
+    One parameter set is drawn per clip and shared by all its frames, like imgaug's to_deterministic(). Values follow
+    imgaug's uint8 conventions: add and saturation are on a 0-255 scale, hue is a fraction value/255 of the circle.
+    """
+
+    def __init__(self, fliplr: float = 0.5, flipud: float = 0.5,
+                 add: t.Tuple[int, int] = (25, 25), hue_saturation: t.Tuple[int, int] = (-25, 25),
+                 recon_size: int = 56):
+        self.fliplr = fliplr
+        self.flipud = flipud
+        self.add = add
+        self.hue_saturation = hue_saturation
+        self.recon_size = recon_size
+
+    def _per_clip(self, low: int, high: int, _in: th.Tensor) -> th.Tensor:
+        b = _in.shape[0]
+        values = th.randint(low, high + 1, (b,), device=_in.device).to(dtype=_in.dtype)
+
+        return values.reshape(b, 1, 1, 1, 1) / 255.0
+
+    def _flip(self, _in: th.Tensor, prob: float, dim: int) -> th.Tensor:
+        flip = th.rand(_in.shape[0], device=_in.device) < prob
+
+        return th.where(flip.reshape(-1, 1, 1, 1, 1), _in.flip(dims=[dim]), _in)
+
+    def _add_hue_saturation(self, _in: th.Tensor) -> th.Tensor:
+        value = self._per_clip(*self.hue_saturation, _in)
+        h, s, v = rgb_to_hsv(_in).unbind(dim=-3)
+        h = (h + value.squeeze(-3)) % 1.0
+        s = (s + value.squeeze(-3)).clamp(0.0, 1.0)
+
+        return hsv_to_rgb(th.stack([h, s, v], dim=-3))
+
+    def _recon(self, _in: th.Tensor) -> th.Tensor:
+        b, _t, c, h, w = _in.shape
+        recon = func.interpolate(_in.reshape(b * _t, c, h, w), size=self.recon_size, mode='bicubic',
+                                 align_corners=False)
+
+        return recon.clamp(0.0, 1.0).reshape(b, _t, c, self.recon_size, self.recon_size)
+
+    def __call__(self, input_data: th.Tensor, class_data: th.Tensor, recon_data: th.Tensor) -> BATCH:
+        if input_data.dtype == th.uint8:
+            input_data = input_data.float().div_(255)
+        _out = self._flip(input_data, self.fliplr, -1)
+        _out = self._flip(_out, self.flipud, -2)
+        _out = (_out + self._per_clip(*self.add, _out)).clamp(0.0, 1.0)
+        _out = self._add_hue_saturation(_out)
+
+        return _out, class_data, self._recon(_out)
+
+
+class BatchNormalise(object):
+    """Converts batches to float on the device and standardises the input per channel.
+
+    The 1/255 scale of uint8 batches and the mean/std of models.common.Standardize are folded into one multiply-add.
+    Recon targets are only scaled to [0, 1].
+    """
+
+    def __init__(self, means: t.Sequence[float] = (0.0, 0.0, 0.0), stds: t.Sequence[float] = (1.0, 1.0, 1.0)):
+        self.means = tuple(means)
+        self.stds = tuple(stds)
+        self.identity = self.means == (0.0, 0.0, 0.0) and self.stds == (1.0, 1.0, 1.0)
+        self._affine = {}
+
+    def _get_affine(self, device: th.device, scale: float) -> t.Tuple[th.Tensor, th.Tensor]:
+        if (device, scale) not in self._affine:
+            means = th.tensor(self.means, dtype=th.float32, device=device).reshape(1, 1, 3, 1, 1)
+            stds = th.tensor(self.stds, dtype=th.float32, device=device).reshape(1, 1, 3, 1, 1)
+            self._affine[(device, scale)] = (scale / stds, -means / stds)
+
+        return self._affine[(device, scale)]
+
+    def __call__(self, input_data: th.Tensor, class_data: th.Tensor, recon_data: th.Tensor) -> BATCH:
+        scale = 1.0 / 255 if input_data.dtype == th.uint8 else 1.0
+        if self.identity:
+            _out = input_data.float().mul_(scale) if scale != 1.0 else input_data
+        else:
+            mul, add = self._get_affine(input_data.device, scale)
+            _out = th.addcmul(add, input_data.float(), mul)
+        if recon_data.dtype == th.uint8:
+            recon_data = recon_data.float().div_(255)
+
+        return _out, class_data, recon_data
+
+
+class BatchCompose(object):
+    def __init__(self, transforms: t.List[t.Optional[t.Callable[..., BATCH]]]):
+        self.transforms = [transform for transform in transforms if transform is not None]
+
+    def __call__(self, input_data: th.Tensor, class_data: th.Tensor, recon_data: th.Tensor) -> BATCH:
+        for transform in self.transforms:
+            input_data, class_data, recon_data = transform(input_data, class_data, recon_data)
+
+        return input_data, class_data, recon_data
@@ -0,0 +1,59 @@
+import typing as t
+
+import numpy as np
+
+
+class BucketBatchSampler(object):
+    """Batch sampler that groups videos of similar length, so no batch waits on a single long decode.
+
+    Each epoch the dataset is shuffled and cut into buckets of bucket_batches x num_replicas batches. Every bucket is
+    sorted by length and split into batches, and the batches are shuffled across buckets. Like DistributedSampler, all
+    replicas draw the same permutation from (seed, epoch) and take every num_replicas-th batch, repeating batches from
+    the start so that each replica gets the same number of batches.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, bucket_batches: int = 16, shuffle: bool = True,
+                 drop_last: bool = False, num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        assert 0 <= rank < num_replicas, f'Invalid rank {rank} for {num_replicas} replicas.'
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def _batches(self) -> t.List[np.ndarray]:
+        rng = np.random.RandomState((self.seed, self.epoch))
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        bucket_size = self.batch_size * self.bucket_batches * self.num_replicas
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        padding = -len(batches) % self.num_replicas
+        batches = batches + (batches * (padding // max(len(batches), 1) + 1))[:padding]
+
+        return batches[self.rank::self.num_replicas]
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> t.Iterator[t.List[int]]:
+        return iter([batch.tolist() for batch in self._batches()])
+
+    def __len__(self):
+        # every bucket but the last one is a whole number of batches.
+        n = len(self.lengths)
+        batches = n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+        return -(-batches // self.num_replicas)
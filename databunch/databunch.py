@@ -1,8 +1,16 @@
+import typing as t
 from dataclasses import asdict
 
+import torch.distributed as dist
 from torch.utils import data as thd
 
+import constants as ct
+import databunch.batch_transforms as pbt
+import databunch.bucket_sampler as pbs
 import databunch.dataset as dataset
+import databunch.persistent_loader as ppl
+import databunch.shard_dataset as psd
+import env
 import helpers as hp
 import options.data_options as do
 
@@ -16,37 +24,107 @@ class VideoDataBunch(object):
         self.test_dso = self.dbo.test_dso
         self.stats = hp.read_stats(self.dbo.stats_path)
 
-        self.train_set = dataset.VideoDataset(self.dbo.cut, self.dbo.frame_size, self.train_dso, self.dbo.so)
-        self.dev_set = dataset.VideoDataset(self.dbo.cut, self.dbo.frame_size, self.dev_dso, self.dbo.so)
-        self.test_set = dataset.VideoDataset(self.dbo.cut, self.dbo.frame_size, self.test_dso, self.dbo.so)
+        self.train_set = self._dataset(self.train_dso)
+        self.dev_set = self._dataset(self.dev_dso)
+        self.test_set = self._dataset(self.test_dso)
+        self.sharded = [_set for _set in [self.train_set, self.dev_set, self.test_set]
+                        if isinstance(_set, psd.ShardedVideoDataset)]
+        assert not (self.sharded and self.dbo.persistent_workers), 'Sharded datasets do not support persistent workers.'
 
         self.lids = self.train_set.lids
+        if self.dbo.dlo.num_workers:
+            self._share_meta()
 
-        self.train_sampler = None
-        self.dev_sampler = None
-        self.test_sampler = None
-        if self.dbo.distributed:
+        normalise = pbt.BatchNormalise(self.dbo.means or (0.0, 0.0, 0.0), self.dbo.stds or (1.0, 1.0, 1.0))
+        self.train_transform = pbt.BatchCompose([self.train_set.batch_transform, normalise])
+        self.dev_transform = pbt.BatchCompose([self.dev_set.batch_transform, normalise])
+        self.test_transform = pbt.BatchCompose([self.test_set.batch_transform, normalise])
+
+        self.train_sampler = self._sampler(self.train_set, self.dbo.dlo.shuffle or self.dbo.distributed)
+        self.dev_sampler = self._sampler(self.dev_set, False)
+        self.test_sampler = self._sampler(self.test_set, False)
+        if self.dbo.distributed and not self.dbo.bucket_batches:
             self.dbo.dlo.shuffle = False
-            self.train_sampler = thd.distributed.DistributedSampler(self.train_set)
-            self.dev_sampler = thd.distributed.DistributedSampler(self.dev_set)
-            self.test_sampler = thd.distributed.DistributedSampler(self.test_set)
-
-        self.train_loader = thd.DataLoader(self.train_set,
-                                           collate_fn=dataset.collate,
-                                           sampler=self.train_sampler,
-                                           worker_init_fn=dataset.init_worker,
-                                           **asdict(self.dbo.dlo))
+
+        self.train_loader = self._loader(self.train_set)(self.train_set,
+                                                         collate_fn=self.train_set.collate,
+                                                         worker_init_fn=dataset.init_worker,
+                                                         **self._loader_kwargs(self.train_set, self.train_sampler))
         self.dbo.dlo.shuffle = False
-        self.dev_loader = thd.DataLoader(self.dev_set,
-                                         collate_fn=dataset.collate,
-                                         sampler=self.dev_sampler,
-                                         worker_init_fn=dataset.init_worker,
-                                         **asdict(self.dbo.dlo))
-        self.test_loader = thd.DataLoader(self.test_set,
-                                          collate_fn=dataset.collate,
-                                          sampler=self.test_sampler,
-                                          worker_init_fn=dataset.init_worker,
-                                          **asdict(self.dbo.dlo))
+        self.dev_loader = self._loader(self.dev_set)(self.dev_set,
+                                                     collate_fn=self.dev_set.collate,
+                                                     worker_init_fn=dataset.init_worker,
+                                                     **self._loader_kwargs(self.dev_set, self.dev_sampler))
+        self.test_loader = self._loader(self.test_set)(self.test_set,
+                                                       collate_fn=self.test_set.collate,
+                                                       worker_init_fn=dataset.init_worker,
+                                                       **self._loader_kwargs(self.test_set, self.test_sampler))
+
+    def _dataset(self, dso: do.DataSetOptions) -> dataset.VideoDataset:
+        if dso.read_shards:
+            return psd.ShardedVideoDataset(self.dbo.cut, self.dbo.frame_size, dso, self.dbo.so)
+
+        return dataset.VideoDataset(self.dbo.cut, self.dbo.frame_size, dso, self.dbo.so)
+
+    def _sampler(self, _set: dataset.VideoDataset, shuffle: bool) -> t.Any:
+        """Sharded datasets order and split their shards themselves, so they take no sampler."""
+        if isinstance(_set, psd.ShardedVideoDataset):
+            return None
+        if self.dbo.bucket_batches:
+            return self._bucket_sampler(_set, shuffle)
+        if self.dbo.distributed:
+            return thd.distributed.DistributedSampler(_set)
+
+        return None
+
+    def _loader(self, _set: dataset.VideoDataset) -> t.Type[thd.DataLoader]:
+        if isinstance(_set, psd.ShardedVideoDataset):
+            return psd.ShardLoader
+
+        return ppl.PersistentDataLoader if self.dbo.persistent_workers else thd.DataLoader
+
+    def _bucket_sampler(self, _set: dataset.VideoDataset, shuffle: bool) -> pbs.BucketBatchSampler:
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if self.dbo.distributed else (1, 0)
+
+        return pbs.BucketBatchSampler(_set.meta['length'].to_numpy(), self.dbo.dlo.batch_size, self.dbo.bucket_batches,
+                                      shuffle, self.dbo.dlo.drop_last, num_replicas, rank, ct.RANDOM_STATE)
+
+    def _loader_kwargs(self, _set: dataset.VideoDataset, sampler: t.Any) -> t.Dict[str, t.Any]:
+        """Bucket samplers yield whole batches, so they replace the batch options of the loader. Iterable datasets
+        cannot be shuffled by the loader."""
+        kwargs = asdict(self.dbo.dlo)
+        if isinstance(_set, psd.ShardedVideoDataset):
+            kwargs['shuffle'] = False
+        elif isinstance(sampler, pbs.BucketBatchSampler):
+            for option in ['batch_size', 'shuffle', 'drop_last']:
+                del kwargs[option]
+            kwargs['batch_sampler'] = sampler
+        else:
+            kwargs['sampler'] = sampler
+
+        return kwargs
+
+    def set_epoch(self, epoch: int) -> None:
+        """Epoch of the train sampling. Persistent loaders pass it on to their workers along with the indices."""
+        self.train_set.sampler.set_epoch(epoch)
+        if self.dbo.persistent_workers:
+            self.train_loader.set_epoch(epoch)
+        elif self.train_sampler is not None:
+            self.train_sampler.set_epoch(epoch)
+
+    def close(self) -> None:
+        """Shut down the workers of persistent loaders."""
+        if self.dbo.persistent_workers:
+            for loader in [self.train_loader, self.dev_loader, self.test_loader]:
+                loader.close()
+
+    def _share_meta(self):
+        datasets = [_set for _set in [self.train_set, self.dev_set, self.test_set] if _set not in self.sharded]
+        shared = sum(_set.meta_store.share() for _set in datasets)
+        copies = sum(_set.meta.memory_usage(index=True, deep=True).sum() for _set in datasets)
+        env.LOGGER.info(f'Shared {shared / 2 ** 20:.1f} MiB of meta columns across {self.dbo.dlo.num_workers} workers '
+                        f'per loader, saving up to {copies * self.dbo.dlo.num_workers / 2 ** 20:.1f} MiB of '
+                        f'per-worker meta copies.')
 
     def __str__(self):
         return (f"""Something-Something-v2 DataBunch.
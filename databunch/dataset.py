@@ -1,3 +1,5 @@
+import collections as cl
+import threading
 import typing as t
 
 import imgaug.augmenters as ia
@@ -7,12 +9,32 @@ import torch as th
 import torch.utils.data as thd
 
 import constants as ct
+import databunch.batch_transforms as pbt
+import databunch.flow_cache as pfc
+import databunch.frame_cache as pfr
+import databunch.frame_store as pfs
+import databunch.jpeg_index as pji
 import databunch.label as pil
+import databunch.meta_store as pms
+import databunch.segment_sampler as pss
 import databunch.video as piv
 import databunch.video_meta as pim
 import helpers as hp
 import options.data_options as do
 
+BUFFER_RING_SIZE = 2
+
+
+class _Buffers(threading.local):
+    """Rings of reusable batch buffers of the calling thread, by shape and dtype."""
+
+    def __init__(self):
+        self.size = BUFFER_RING_SIZE
+        self.rings = {}
+
+
+BUFFERS = _Buffers()
+
 
 def init_worker(_id: int):
     np.random.seed(_id)
@@ -22,7 +44,59 @@ def collate(batch: [(piv.Video, pil.Label)]) -> (th.Tensor, th.Tensor, t.List[pi
     videos, labels, metas = zip(*batch)
 
     input_data = th.stack([th.stack(video.data, dim=0) for video in videos], dim=0)
-    recon_data = th.stack([th.stack(video.recon, dim=0) for video in videos], dim=0)
+    if videos[0].recon:
+        recon_data = th.stack([th.stack(video.recon, dim=0) for video in videos], dim=0)
+    else:
+        recon_data = th.empty(0)
+    class_data = th.tensor([label.data for label in labels], dtype=th.int64)
+
+    return input_data, class_data, recon_data, metas
+
+
+def reserve_buffers(size: int) -> None:
+    """Collate batches of the calling thread into rings of `size` reusable buffers. A batch then stays intact until
+    `size` - 1 more batches of its shape are collated, so the ring should cover every batch alive at once."""
+    BUFFERS.size = size
+
+
+def _batch_buffer(shape: t.Tuple[int, ...], dtype: th.dtype, reuse: bool) -> th.Tensor:
+    """Batch sized tensor to collate into. Worker batches live in fresh shared memory since the main process reads them
+    after collate returns. In the main process, reusable buffers are taken from a ring of pinned tensors of the
+    calling thread, sized by reserve_buffers."""
+    if thd.get_worker_info() is not None:
+        return th.empty(shape, dtype=dtype).share_memory_()
+    if not reuse:
+        return th.empty(shape, dtype=dtype)
+
+    ring = BUFFERS.rings.setdefault((shape, dtype), cl.deque())
+    while len(ring) < BUFFERS.size:
+        ring.appendleft(th.empty(shape, dtype=dtype, pin_memory=th.cuda.is_available()))
+    ring.rotate(-1)
+
+    return ring[-1]
+
+
+def buffered_collate(batch: [(piv.Video, pil.Label)]) -> (th.Tensor, th.Tensor, t.List[pim.VideoMeta]):
+    """Collate videos holding HWC numpy frames. Frames stay uint8 in (B, T, C, H, W) buffers and are converted to float
+    on the device by databunch.batch_transforms.BatchNormalise."""
+    videos, labels, metas = zip(*batch)
+
+    _t, (h, w, c) = len(videos[0].data), videos[0].data[0].shape
+    input_data = _batch_buffer((len(videos), _t, c, h, w), th.uint8, True)
+    for b, video in enumerate(videos):
+        for i, frame in enumerate(video.data):
+            input_data[b, i].copy_(th.from_numpy(frame).permute(2, 0, 1))
+
+    if videos[0].recon:
+        # rgb targets travel as uint8 as well. flow targets are float32 by nature.
+        _t, (h, w, c) = len(videos[0].recon), videos[0].recon[0].shape
+        dtype = th.uint8 if videos[0].recon[0].dtype == np.uint8 else th.float32
+        recon_data = _batch_buffer((len(videos), _t, c, h, w), dtype, dtype == th.uint8)
+        for b, video in enumerate(videos):
+            for i, frame in enumerate(video.recon):
+                recon_data[b, i].copy_(th.from_numpy(frame).permute(2, 0, 1))
+    else:
+        recon_data = th.empty(0)
     class_data = th.tensor([label.data for label in labels], dtype=th.int64)
 
     return input_data, class_data, recon_data, metas
@@ -30,8 +104,33 @@ def collate(batch: [(piv.Video, pil.Label)]) -> (th.Tensor, th.Tensor, t.List[pi
 
 class VideoDataset(thd.Dataset):
     def __init__(self, cut: float, frame_size: int, data_opts: do.DataSetOptions, sampling_opts: do.SamplingOptions):
+        self._init_meta(cut, frame_size, data_opts, sampling_opts)
+        self.store = pfs.FrameStore(ct.WORK_ROOT / data_opts.meta_path) if data_opts.read_store else None
+        self.frame_cache = None
+        if data_opts.frame_cache_mb and self.store is None:
+            frame_cache_path = ct.WORK_ROOT / data_opts.frame_cache_path if data_opts.frame_cache_path else None
+            self.frame_cache = pfr.FrameCache(data_opts.frame_cache_mb * 2 ** 20, frame_cache_path)
+        self.jpeg_index = None
+        if data_opts.read_jpeg and self.store is None:
+            self.jpeg_index = pji.JpegIndex(self.meta, ct.WORK_ROOT / data_opts.root_path,
+                                            ct.WORK_ROOT / data_opts.meta_path)
+
+        if data_opts.keep is not None:
+            if 0 <= data_opts.keep < 1:
+                self._stratified_sample_meta(data_opts.keep)
+            else:
+                self.meta = self.meta.iloc[0:data_opts.keep]
+        self.meta_store = pms.MetaStore(self.meta, self.meta_fields)
+        self._init_sampling()
+
+    def _init_meta(self, cut: float, frame_size: int, data_opts: do.DataSetOptions,
+                   sampling_opts: do.SamplingOptions) -> None:
+        """Options, meta, label maps and flow cache, shared with databunch.shard_dataset.ShardedVideoDataset."""
         assert 0.0 <= cut <= 1.0, f'Cut should be between 0.0, and 1.0. Received: {cut}.'
         assert data_opts.setting in ['train', 'eval'], f'Unknown setting: {data_opts.setting}.'
+        assert data_opts.aug_engine in ['imgaug', 'torch'], f'Unknown augmentation engine: {data_opts.aug_engine}.'
+        assert not (data_opts.aug_engine == 'torch' and data_opts.use_flow), 'Flow targets need the imgaug engine.'
+        assert data_opts.clips * data_opts.crops == 1 or data_opts.setting == 'eval', 'Views need the eval setting.'
 
         self.cut = cut
         self.frame_size = frame_size
@@ -39,19 +138,46 @@ class VideoDataset(thd.Dataset):
         self.so = sampling_opts
 
         self.meta = hp.read_meta(data_opts.meta_path)
+        self.meta_fields = [field for field in pim.VideoMeta.fields if field in self.meta.columns]
         self.lids = self.meta['lid'].unique()
         self.lid2labels = self.meta.groupby('lid')['label'].head(1)
         self.labels2lid = self.lid2labels.reset_index().set_index('label')
-
-        if data_opts.keep is not None:
-            if 0 <= data_opts.keep < 1:
-                self._stratified_sample_meta(data_opts.keep)
-            else:
-                self.meta = self.meta.iloc[0:data_opts.keep]
+        self.flow_cache = None
+        if data_opts.use_flow and data_opts.flow_cache:
+            self.flow_cache = pfc.FlowCache(ct.WORK_ROOT / data_opts.meta_path)
+
+    def _init_sampling(self) -> None:
+        """Segment locations of every video in the meta, views and transforms."""
+        self.sampler = pss.SegmentSampler(self.meta['length'].to_numpy(), self.cut, self.so.num_segments,
+                                          self.do.setting, ct.RANDOM_STATE)
+        self.clip_locs = None
+        if self.do.clips * self.do.crops > 1:
+            self.clip_locs = self.sampler.clips(self.do.clips)
+        self.batch_transform = self._compose_batch_transform()
         self.aug_seq = self._compose_aug_seq()
+        self.collate = buffered_collate if self.do.buffered else collate
+
+    def _compose_batch_transform(self) -> t.Optional[pbt.BatchAugment]:
+        if self.do.setting == 'train' and self.do.aug_engine == 'torch':
+            return pbt.BatchAugment(fliplr=0.5, flipud=0.5, add=(25, 25), hue_saturation=(-25, 25))
+
+        return None
 
     def _compose_aug_seq(self) -> ia.Sequential:
-        if self.do.setting == 'train':
+        if self.batch_transform is not None:
+            aug_seq = ia.Sequential([
+                ia.PadToFixedSize(224, 224),
+                ia.CropToFixedSize(224, 224),
+            ])
+        elif self.do.setting == 'train' and self.flow_cache is not None:
+            # cached flow is computed on centre crops. flips are applied by the video so they can be mirrored on flow.
+            aug_seq = ia.Sequential([
+                ia.PadToFixedSize(224, 224, position='center'),
+                ia.CropToFixedSize(224, 224, position='center'),
+                ia.Add((25, 25)),
+                ia.AddToHueAndSaturation((-25, 25)),
+            ])
+        elif self.do.setting == 'train':
             aug_seq = ia.Sequential([
                 ia.PadToFixedSize(224, 224),
                 ia.CropToFixedSize(224, 224),
@@ -68,20 +194,40 @@ class VideoDataset(thd.Dataset):
 
         return aug_seq
 
-    def __getitem__(self, item: int) -> t.Tuple[piv.Video, pil.Label, pim.VideoMeta]:
-        video_meta = pim.VideoMeta(**self.meta.iloc[item][pim.VideoMeta.fields].to_dict())
-
-        video = piv.Video(video_meta, ct.WORK_ROOT / self.do.root_path, self.do.read_jpeg,
-                          self.cut, self.do.setting, self.so.num_segments, self.do.use_flow, self.aug_seq)
+    def __getitem__(self, item: t.Union[int, t.Tuple[int, int]]) -> t.Tuple[piv.Video, pil.Label, pim.VideoMeta]:
+        if isinstance(item, tuple):
+            epoch, item = item
+            self.sampler.set_epoch(epoch)
+        video_meta = self.meta_store[item]
+
+        if self.clip_locs is not None:
+            video = piv.MultiViewVideo(video_meta, ct.WORK_ROOT / self.do.root_path, self.do.read_jpeg, self.cut,
+                                       self.so.num_segments, self.do.use_flow, self.aug_seq, self.clip_locs[item],
+                                       self.do.crops, 224, self.store, self.jpeg_index, self.batch_transform is None,
+                                       self.frame_cache)
+        else:
+            video = piv.Video(video_meta, ct.WORK_ROOT / self.do.root_path, self.do.read_jpeg,
+                              self.cut, self.do.setting, self.so.num_segments, self.do.use_flow, self.aug_seq,
+                              self.store, self.jpeg_index, self.batch_transform is None, self.flow_cache,
+                              self.sampler[item], self.frame_cache)
         label = pil.Label(video_meta)
 
-        video.to_tensor()
+        if not self.do.buffered:
+            video.to_tensor()
         label.to_tensor()
 
         return video, label, video_meta
 
     def __len__(self):
-        return len(self.meta)
+        return len(self.meta_store)
+
+    def __getstate__(self):
+        # workers only read the meta store. the pandas frames stay in the main process.
+        state = self.__dict__.copy()
+        for name in ['meta', 'lid2labels', 'labels2lid']:
+            state[name] = None
+
+        return state
 
     def __str__(self):
         string = f"""Something-Something Dataset: {len(self)} x {self[0]}"""
@@ -0,0 +1,98 @@
+import pathlib as pl
+import typing as t
+
+import cv2
+import numpy as np
+import pandas as pd
+
+PAIR_COLUMNS = ['id', 'a', 'b']
+DENSE_COLUMNS = ['offset', 'count']
+FLOW_CLIP = 20.0
+
+
+def cache_paths(meta_path: pl.Path, kind: str, resolution: int) -> t.Tuple[pl.Path, pl.Path]:
+    """Flow cache files live next to the meta file, e.g. meta.dev.flow_pairs56.{bin,json}."""
+    assert kind in ['pairs', 'dense'], f'Unknown flow cache kind: {kind}.'
+    meta_path = pl.Path(meta_path)
+    stem = f'{meta_path.stem}.flow_{kind}{resolution}'
+
+    return meta_path.parent / f'{stem}.bin', meta_path.parent / f'{stem}.json'
+
+
+def compose(flows: t.List[np.ndarray]) -> np.ndarray:
+    """Chain consecutive flows a->a+1->...->b into a single a->b flow by sampling each step at the displaced grid."""
+    h, w, _ = flows[0].shape
+    grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    total = np.zeros((h, w, 2), dtype=np.float32)
+    for flow in flows:
+        map_x, map_y = grid_x + total[..., 0], grid_y + total[..., 1]
+        total += cv2.remap(flow, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    return np.clip(total, -FLOW_CLIP, FLOW_CLIP)
+
+
+class FlowCache(object):
+    """Read-only, lazily memory mapped view over the flow written by prepro.common.cache_flow.
+
+    Flow is stored as resolution x resolution x 2 float16 entries computed on frames with the eval geometry. The pairs
+    file holds the flow between the fixed eval sample locations. The optional dense file holds the flow between every
+    two consecutive frames, from which the flow between arbitrary pairs is composed.
+    """
+
+    def __init__(self, meta_path: pl.Path, resolution: int = 56):
+        self.resolution = resolution
+        self.pairs_path, pairs_index_path = cache_paths(meta_path, 'pairs', resolution)
+        self.dense_path, dense_index_path = cache_paths(meta_path, 'dense', resolution)
+        assert self.pairs_path.exists() or self.dense_path.exists(), \
+            f'Flow cache not found at {self.pairs_path}. Run the cache_flow prepro job.'
+
+        self.pairs = {}
+        if self.pairs_path.exists():
+            index = pd.read_json(pairs_index_path, orient='records', dtype=False)
+            self.pairs = {(str(_id), a, b): row for row, (_id, a, b) in enumerate(index[PAIR_COLUMNS].values)}
+        self.dense = {}
+        if self.dense_path.exists():
+            index = pd.read_json(dense_index_path, orient='index', dtype=False)
+            self.dense = dict(zip(index.index.astype(str), index[DENSE_COLUMNS].to_numpy(dtype=np.int64)))
+        self._pairs_data = None
+        self._dense_data = None
+
+    def _entries(self, path: pl.Path) -> np.ndarray:
+        return np.memmap(path.as_posix(), dtype=np.float16, mode='r').reshape((-1, self.resolution, self.resolution, 2))
+
+    def _pair(self, _id: str, a: int, b: int) -> t.Optional[np.ndarray]:
+        if a == b:
+            return np.zeros((self.resolution, self.resolution, 2), dtype=np.float32)
+        row = self.pairs.get((_id, a, b))
+        if row is not None:
+            if self._pairs_data is None:
+                self._pairs_data = self._entries(self.pairs_path)
+            return self._pairs_data[row].astype(np.float32)
+
+        if _id not in self.dense:
+            return None
+        if self._dense_data is None:
+            self._dense_data = self._entries(self.dense_path)
+        offset, count = self.dense[_id]
+        if b > count:
+            return None
+
+        return compose([flow.astype(np.float32) for flow in self._dense_data[offset + a:offset + b]])
+
+    def read(self, _id: t.Any, locs: np.ndarray) -> t.Optional[t.List[np.ndarray]]:
+        """Flow between every two consecutive locations, or None if any pair is missing from the cache."""
+        flows = []
+        for a, b in zip(locs[:-1], locs[1:]):
+            flow = self._pair(str(_id), int(a), int(b))
+            if flow is None:
+                return None
+            flows.append(flow)
+
+        return flows
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pairs_data'] = None
+        state['_dense_data'] = None
+
+        return state
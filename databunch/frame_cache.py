@@ -0,0 +1,103 @@
+import multiprocessing as mp
+import os
+import pathlib as pl
+import shutil
+import tempfile
+import typing as t
+import weakref
+
+import numpy as np
+
+import databunch.meta_store as pms
+
+EVICT_RATIO = 0.9
+
+
+def _remove(path: str, pid: int) -> None:
+    # forked dataloader workers inherit the finalizer. only the process that created the directory removes it.
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class FrameCache(object):
+    """Decoded frames keyed by (video id, frame index), kept as .npy files in a directory shared by the DataLoader
+    workers.
+
+    Without a path, the directory is a temporary one in shared memory that is removed with the cache. Reads refresh the
+    modification time of a frame. Writes that take the cache over its byte budget evict the least recently used frames
+    down to EVICT_RATIO of the budget.
+    """
+
+    def __init__(self, budget: int, path: t.Optional[pl.Path] = None):
+        self.budget = budget
+        if path is None:
+            self.path = pl.Path(tempfile.mkdtemp(prefix='frames_', dir=pms.SHM_DIR))
+            weakref.finalize(self, _remove, self.path.as_posix(), os.getpid())
+        else:
+            self.path = pl.Path(path)
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = mp.Lock()
+        self.used = mp.RawValue('q', sum(entry.stat().st_size for entry in self._entries()))
+
+    def _entries(self) -> t.List[os.DirEntry]:
+        return [entry for entry in os.scandir(self.path.as_posix()) if entry.name.endswith('.npy')]
+
+    def _frame_path(self, _id: t.Any, loc: int) -> pl.Path:
+        return self.path / f'{str(_id).replace(os.sep, "_")}.{int(loc)}.npy'
+
+    def get(self, _id: t.Any, locs: np.ndarray) -> t.List[t.Optional[np.ndarray]]:
+        """Cached frames at the locations of a video, None where a frame is missing."""
+        frames = []
+        for loc in locs:
+            path = self._frame_path(_id, loc).as_posix()
+            try:
+                frames.append(np.load(path))
+                os.utime(path)
+            except FileNotFoundError:
+                frames.append(None)
+
+        return frames
+
+    def put(self, _id: t.Any, locs: np.ndarray, frames: t.List[np.ndarray]) -> None:
+        for loc, frame in zip(locs, frames):
+            path = self._frame_path(_id, loc)
+            if path.exists():
+                continue
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path.as_posix())
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, frame)
+            size = os.path.getsize(tmp_path)
+            try:
+                # link only creates the frame if no other worker cached it meanwhile, so each frame is counted once.
+                os.link(tmp_path, path.as_posix())
+            except FileExistsError:
+                continue
+            finally:
+                os.unlink(tmp_path)
+            with self.lock:
+                self.used.value += size
+                if self.used.value > self.budget:
+                    self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= self.budget * EVICT_RATIO:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+        self.used.value = used
+
+    def __len__(self):
+        return len(self._entries())
@@ -0,0 +1,55 @@
+import pathlib as pl
+import typing as t
+
+import numpy as np
+import pandas as pd
+
+INDEX_COLUMNS = ['offset', 'length', 'height', 'width']
+
+
+def store_paths(meta_path: pl.Path) -> t.Tuple[pl.Path, pl.Path]:
+    """Frame store files live next to the meta file they were built from, e.g. meta.train.frames.{bin,json}."""
+    meta_path = pl.Path(meta_path)
+
+    return meta_path.parent / f'{meta_path.stem}.frames.bin', meta_path.parent / f'{meta_path.stem}.frames.json'
+
+
+class FrameStore(object):
+    """Read-only, lazily memory mapped view over the uint8 frames written by prepro.common.store_frames.
+
+    Each video occupies length x height x width x 3 contiguous bytes starting at its offset in the store file.
+    """
+
+    def __init__(self, meta_path: pl.Path):
+        self.data_path, self.index_path = store_paths(meta_path)
+        assert self.data_path.exists(), f'Frame store not found at {self.data_path}. Run the store_frames prepro job.'
+
+        index = pd.read_json(self.index_path, orient='index', dtype=False)
+        self.ids = {str(_id): row for row, _id in enumerate(index.index)}
+        self.index = index[INDEX_COLUMNS].to_numpy(dtype=np.int64)
+        self._data = None
+
+    def _clip(self, _id: t.Any) -> np.ndarray:
+        if self._data is None:
+            self._data = np.memmap(self.data_path.as_posix(), dtype=np.uint8, mode='r')
+        offset, length, height, width = self.index[self.ids[str(_id)]]
+        size = length * height * width * 3
+
+        return self._data[offset:offset + size].reshape((length, height, width, 3))
+
+    def read(self, _id: t.Any, locs: np.ndarray) -> t.List[np.ndarray]:
+        clip = self._clip(_id)
+
+        return list(clip[locs])
+
+    def __contains__(self, _id: t.Any) -> bool:
+        return str(_id) in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+
+        return state
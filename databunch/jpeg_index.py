@@ -0,0 +1,98 @@
+import os
+import pathlib as pl
+import re
+import typing as t
+
+import numpy as np
+import pandas as pd
+
+FRAME_NAME = re.compile(r'^(\d+)\.jpeg$')
+NO_PATTERN = -1
+
+
+def index_path(meta_path: pl.Path) -> pl.Path:
+    meta_path = pl.Path(meta_path)
+
+    return meta_path.parent / f'{meta_path.stem}.jpeg.npz'
+
+
+def _infer_pattern(names: t.List[str]) -> t.Tuple[t.Optional[str], int, int]:
+    numbers = []
+    for name in names:
+        match = FRAME_NAME.match(name)
+        if match is None:
+            return None, 0, len(names)
+        numbers.append(match.group(1))
+
+    locs = np.sort(np.array([int(number) for number in numbers], dtype=np.int64))
+    start, count = (int(locs[0]), len(locs)) if len(locs) else (0, 0)
+    if count and not np.array_equal(locs, np.arange(start, start + count)):
+        return None, start, count
+
+    padded = [number for number in numbers if len(number) > 1 and number.startswith('0')]
+    pattern = f'%0{min(len(number) for number in padded)}d.jpeg' if padded else '%d.jpeg'
+    if {pattern % loc for loc in locs} != set(names):
+        return None, start, count
+
+    return pattern, start, count
+
+
+class JpegIndex(object):
+    """Per-video frame count, first frame number and filename pattern of the extracted .jpeg frames of a split.
+
+    Built once with a single directory listing per video and persisted next to the meta file, so readers can compute
+    frame paths without listing directories per sample.
+    """
+
+    def __init__(self, meta: pd.DataFrame, root_path: pl.Path, meta_path: pl.Path):
+        self.path = index_path(meta_path)
+
+        if not self._load(meta_path, meta['id']):
+            self._build(meta, root_path)
+            np.savez(self.path.as_posix(), ids=self.ids, counts=self.counts, starts=self.starts,
+                     pattern_ids=self.pattern_ids, patterns=self.patterns)
+        self.rows = {_id: row for row, _id in enumerate(self.ids)}
+
+    def _load(self, meta_path: pl.Path, ids: pd.Series) -> bool:
+        if not self.path.exists() or self.path.stat().st_mtime < pl.Path(meta_path).stat().st_mtime:
+            return False
+
+        with np.load(self.path.as_posix()) as index:
+            if not set(ids.astype(str)).issubset(index['ids']):
+                return False
+            self.ids, self.counts, self.starts = index['ids'], index['counts'], index['starts']
+            self.pattern_ids, self.patterns = index['pattern_ids'], index['patterns']
+
+        return True
+
+    def _build(self, meta: pd.DataFrame, root_path: pl.Path):
+        patterns, pattern_ids, starts, counts = [], [], [], []
+        for image_path in meta['image_path']:
+            with os.scandir((root_path / image_path).as_posix()) as entries:
+                names = [entry.name for entry in entries if entry.name.endswith('.jpeg')]
+            pattern, start, count = _infer_pattern(names)
+            if pattern is None:
+                pattern_ids.append(NO_PATTERN)
+            else:
+                if pattern not in patterns:
+                    patterns.append(pattern)
+                pattern_ids.append(patterns.index(pattern))
+            starts.append(start)
+            counts.append(count)
+
+        self.ids = meta['id'].astype(str).to_numpy().astype(np.str_)
+        self.counts = np.array(counts, dtype=np.int32)
+        self.starts = np.array(starts, dtype=np.int32)
+        self.pattern_ids = np.array(pattern_ids, dtype=np.int16)
+        self.patterns = np.array(patterns, dtype=np.str_)
+
+    def paths(self, _id: t.Any, image_path: pl.Path, locs: np.ndarray) -> t.Optional[t.List[str]]:
+        row = self.rows.get(str(_id))
+        if row is None or self.pattern_ids[row] == NO_PATTERN:
+            return None
+        assert np.all(locs < self.counts[row]), f'Frame locations out of range for video {_id}.'
+
+        pattern = str(self.patterns[self.pattern_ids[row]])
+        start = int(self.starts[row])
+
+        return [os.path.join(image_path.as_posix(), pattern % (start + loc)) for loc in locs]
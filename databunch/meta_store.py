@@ -0,0 +1,103 @@
+import os
+import tempfile
+import typing as t
+import weakref
+
+import numpy as np
+import pandas as pd
+
+import databunch.video_meta as vm
+import helpers as hp
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+ALIGN = 64
+
+
+def _unlink(path: str, pid: int) -> None:
+    # forked dataloader workers inherit the finalizer. only the process that created the block removes it.
+    if os.getpid() == pid and os.path.exists(path):
+        os.unlink(path)
+
+
+class MetaStore(object):
+    """Meta fields of a dataset held as typed numpy columns, so records are built per item without touching pandas."""
+
+    def __init__(self, meta: pd.DataFrame, fields: t.List[str]):
+        self.fields = fields
+        self.columns = hp.meta_to_columns(meta[fields])
+        self.path = None
+        self.layout = None
+        self._index_lists()
+
+    def _index_lists(self):
+        self.lists = {}
+        for field in self.fields:
+            if f'{field}{hp.LENGTHS_SUFFIX}' in self.columns:
+                lengths = self.columns[f'{field}{hp.LENGTHS_SUFFIX}']
+                self.lists[field] = (self.columns[f'{field}{hp.VALUES_SUFFIX}'], lengths,
+                                     np.cumsum(np.maximum(lengths, 0)) - np.maximum(lengths, 0))
+
+    def _value(self, field: str, item: int) -> t.Any:
+        if field in self.lists:
+            values, lengths, starts = self.lists[field]
+            if lengths[item] < 0:
+                return None
+            return values[starts[item]:starts[item] + lengths[item]].tolist()
+        nulls = self.columns.get(f'{field}{hp.NULLS_SUFFIX}')
+        if nulls is not None and nulls[item]:
+            return None
+
+        return self.columns[field][item].item()
+
+    def __getitem__(self, item: int) -> vm.VideoMeta:
+        return vm.VideoMeta(**{field: self._value(field, item) for field in self.fields})
+
+    def __len__(self):
+        return len(self.columns[hp.INDEX_COLUMN])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def share(self) -> int:
+        """Move all columns into a single file in shared memory and map it read-only. Pickled copies sent to
+        DataLoader workers only carry the path and layout, and attach to the same pages."""
+        if self.path is not None:
+            return self.nbytes
+
+        self.layout, size = [], 0
+        for name, column in self.columns.items():
+            size = -(-size // ALIGN) * ALIGN
+            self.layout.append((name, column.dtype.str, column.shape, size, column.nbytes))
+            size += column.nbytes
+        fd, self.path = tempfile.mkstemp(prefix='meta_', suffix='.bin', dir=SHM_DIR)
+        os.close(fd)
+
+        block = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(max(size, 1),))
+        for name, _, _, offset, nbytes in self.layout:
+            block[offset:offset + nbytes] = np.ascontiguousarray(self.columns[name]).reshape(-1).view(np.uint8)
+        block.flush()
+        del block
+        weakref.finalize(self, _unlink, self.path, os.getpid())
+        self._attach()
+
+        return size
+
+    def _attach(self):
+        block = np.memmap(self.path, dtype=np.uint8, mode='r')
+        self.columns = {name: block[offset:offset + nbytes].view(np.dtype(dtype)).reshape(shape)
+                        for name, dtype, shape, offset, nbytes in self.layout}
+        self._index_lists()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['columns'] = None
+            state['lists'] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self._attach()
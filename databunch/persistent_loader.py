@@ -0,0 +1,66 @@
+import typing as t
+
+from torch.utils import data as thd
+
+
+class RepeatBatchSampler(object):
+    """Endless pass over a batch sampler. Every index is tagged with the epoch of its pass, so the dataset copies in
+    long-lived workers can follow the epoch of the main process. Samplers with set_epoch are reseeded per pass."""
+
+    def __init__(self, batch_sampler: thd.BatchSampler, epoch: int = 1):
+        self.batch_sampler = batch_sampler
+        self.epoch = epoch
+
+    def __iter__(self) -> t.Iterator[t.List[t.Tuple[int, int]]]:
+        while True:
+            for sampler in [self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)]:
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(self.epoch)
+            for batch in self.batch_sampler:
+                yield [(self.epoch, item) for item in batch]
+            self.epoch += 1
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class PersistentDataLoader(thd.DataLoader):
+    """DataLoader whose worker processes live across epochs.
+
+    The workers are started on the first iteration and iterate an endless sampler. Each pass over the loader yields
+    the batches of one epoch from that single iterator, so the prefetch of the next epoch overlaps the end of the
+    current one. A pass that is left before its end shuts the workers down, since the batches they hold belong to the
+    abandoned epoch, and the next pass starts new ones on the following epoch. Workers are shut down by close().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PersistentDataLoader, self).__init__(*args, **kwargs)
+        # DataLoader forbids reassigning the batch sampler after init.
+        object.__setattr__(self, 'batch_sampler', RepeatBatchSampler(self.batch_sampler))
+        self.persistent_iterator = None
+        self.epoch = self.batch_sampler.epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the first pass. Later passes count up from it."""
+        if self.persistent_iterator is None:
+            self.epoch = self.batch_sampler.epoch = epoch
+
+    def __iter__(self) -> t.Iterator[t.Any]:
+        if self.persistent_iterator is None:
+            self.batch_sampler.epoch = self.epoch
+            self.persistent_iterator = super(PersistentDataLoader, self).__iter__()
+        self.epoch += 1
+        remaining = len(self)
+        try:
+            while remaining:
+                batch = next(self.persistent_iterator)
+                remaining -= 1
+                yield batch
+        finally:
+            if remaining:
+                self.close()
+
+    def close(self) -> None:
+        if self.persistent_iterator is not None and hasattr(self.persistent_iterator, '_shutdown_workers'):
+            self.persistent_iterator._shutdown_workers()
+        self.persistent_iterator = None
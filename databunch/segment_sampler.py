@@ -0,0 +1,61 @@
+import typing as t
+
+import numpy as np
+
+
+class SegmentSampler(object):
+    """Frame locations of every video in a dataset, computed at once from the meta lengths.
+
+    Reproduces the per video sampling: the first round(length * cut) - 1 frames are split into num_segments segments
+    like np.array_split, empty segments repeat the last non-empty one, and one frame is taken per segment. Train
+    sampling picks a random frame per segment and is redrawn from (seed, epoch), eval sampling picks the middle frame.
+    """
+
+    def __init__(self, lengths: np.ndarray, cut: float, num_segments: int, setting: str, seed: int = 0):
+        assert setting in ['train', 'eval'], f'Unknown setting: {setting}.'
+        self.setting = setting
+        self.seed = seed
+        self.epoch = 0
+
+        counts = np.round(np.asarray(lengths, dtype=np.float64) * cut).astype(np.int64) - 1
+        assert np.all(counts > 0), 'Every video should keep at least one frame after the cut.'
+        q, r = np.divmod(counts, num_segments)
+        segments = np.minimum(np.arange(num_segments)[np.newaxis, :], counts[:, np.newaxis] - 1)
+        self.starts = segments * q[:, np.newaxis] + np.minimum(segments, r[:, np.newaxis])
+        self.sizes = q[:, np.newaxis] + (segments < r[:, np.newaxis])
+        self.locs = self._sample()
+
+    def _sample(self) -> np.ndarray:
+        if self.setting == 'eval':
+            return self.starts + self.sizes // 2
+
+        rng = np.random.RandomState((self.seed, self.epoch))
+        offsets = np.floor(rng.random_sample(self.sizes.shape) * self.sizes).astype(np.int64)
+
+        return self.starts + offsets
+
+    def clips(self, num_clips: int) -> np.ndarray:
+        """Eval locations of num_clips clips per video, as (videos, clips, segments). Clip k takes the frame at the
+        fraction (2k + 1) / (2 * num_clips) of each segment, so a single clip is the middle frame."""
+        k = np.arange(num_clips)[np.newaxis, :, np.newaxis]
+
+        return self.starts[:, np.newaxis] + (self.sizes[:, np.newaxis] * (2 * k + 1)) // (2 * num_clips)
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.locs = self._sample()
+
+    def state_dict(self) -> t.Dict[str, int]:
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state: t.Dict[str, int]) -> None:
+        self.seed = state['seed']
+        self.epoch = -1
+        self.set_epoch(state['epoch'])
+
+    def __getitem__(self, item: int) -> np.ndarray:
+        return self.locs[item]
+
+    def __len__(self):
+        return len(self.locs)
@@ -0,0 +1,198 @@
+import itertools
+import json
+import pathlib as pl
+import tarfile
+import typing as t
+
+import cv2
+import numpy as np
+import torch.distributed as dist
+import torch.utils.data as thd
+
+import constants as ct
+import databunch.dataset as dataset
+import databunch.label as pil
+import databunch.segment_sampler as pss
+import databunch.video as piv
+import databunch.video_meta as pim
+import options.data_options as do
+
+META_SUFFIX = 'json'
+FRAME_SUFFIX = 'jpg'
+SAMPLE = t.Tuple[str, t.Dict[str, bytes]]
+
+
+def shard_paths(meta_path: pl.Path) -> t.Tuple[pl.Path, pl.Path]:
+    """Shards live in a directory next to the meta file, e.g. meta.train.shards/, indexed by meta.train.shards.json."""
+    meta_path = pl.Path(meta_path)
+
+    return meta_path.parent / f'{meta_path.stem}.shards', meta_path.parent / f'{meta_path.stem}.shards.json'
+
+
+def frame_name(key: str, loc: int) -> str:
+    return f'{key}.{loc:05d}.{FRAME_SUFFIX}'
+
+
+def meta_name(key: str) -> str:
+    return f'{key}.{META_SUFFIX}'
+
+
+def read_shard(path: pl.Path) -> t.Iterator[SAMPLE]:
+    """Stream the samples of a tar shard. Members of a sample are stored consecutively and share the key before the
+    first dot of their name."""
+    key, files = None, {}
+    with tarfile.open(path.as_posix(), mode='r|') as shard:
+        for member in shard:
+            if not member.isfile():
+                continue
+            _key, suffix = member.name.split('.', 1)
+            if _key != key and files:
+                yield key, files
+                files = {}
+            key = _key
+            files[suffix] = shard.extractfile(member).read()
+    if files:
+        yield key, files
+
+
+class SampleFrames(object):
+    """Frame store over the encoded frames of a single shard sample. Only the requested frames are decoded."""
+
+    def __init__(self, files: t.Dict[str, bytes]):
+        self.files = files
+
+    def read(self, _id: t.Any, locs: np.ndarray) -> t.List[np.ndarray]:
+        frames = []
+        for loc in locs:
+            data = np.frombuffer(self.files[f'{int(loc):05d}.{FRAME_SUFFIX}'], np.uint8)
+            frame = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+        return frames
+
+
+class ShardSampler(object):
+    """Order of the shards of a dataset and their assignment to the global workers, i.e. all DataLoader workers of all
+    ranks. The train order is a permutation drawn from the seed and epoch of the segment sampler, which all ranks
+    share."""
+
+    def __init__(self, num_shards: int, shuffle: bool, sampler: pss.SegmentSampler):
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.sampler = sampler
+
+    def order(self) -> np.ndarray:
+        if not self.shuffle:
+            return np.arange(self.num_shards)
+
+        return np.random.RandomState((self.sampler.seed, self.sampler.epoch)).permutation(self.num_shards)
+
+    def shards(self, worker: int, workers: int, wrap: bool) -> t.List[int]:
+        """Every workers-th shard from worker on. With wrap, workers beyond the number of shards reuse shards."""
+        order = self.order()
+        stop = max(self.num_shards, workers) if wrap else self.num_shards
+
+        return [int(order[i % self.num_shards]) for i in range(worker, stop, workers)]
+
+
+class ShardedVideoDataset(dataset.VideoDataset, thd.IterableDataset):
+    """Streams the samples written by prepro.common.write_shards with sequential reads of large tar shards.
+
+    Shards are spread over the DataLoader workers of every rank. Train sets read the shards in a new order every epoch
+    and mix samples through a shuffle buffer. Each worker yields a fixed quota of samples, cycling through its shards if
+    needed, so that all ranks run the same number of batches. A single process eval set reads every sample once.
+    """
+
+    def __init__(self, cut: float, frame_size: int, data_opts: do.DataSetOptions, sampling_opts: do.SamplingOptions):
+        assert data_opts.clips * data_opts.crops == 1, 'Sharded datasets have a single view.'
+        assert data_opts.keep is None or data_opts.keep >= 1, 'Sharded datasets keep a number of videos only.'
+        self._init_meta(cut, frame_size, data_opts, sampling_opts)
+
+        self.shard_dir, index_path = shard_paths(ct.WORK_ROOT / data_opts.meta_path)
+        assert index_path.exists(), f'Shards not found at {self.shard_dir}. Run the write_shards prepro job.'
+        with open(index_path.as_posix(), 'r') as file:
+            index = json.load(file)
+        self.shards = [entry['shard'] for entry in index]
+        self.counts = np.array([entry['count'] for entry in index], dtype=np.int64)
+        self.total = int(self.counts.sum()) if data_opts.keep is None else min(int(self.counts.sum()), data_opts.keep)
+
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        self.exact = self.do.setting == 'eval' and self.world_size == 1 and data_opts.keep is None
+        # sample keys are positions in the meta, so the segment sampler covers the whole meta regardless of keep.
+        self._init_sampling()
+        self.shard_sampler = ShardSampler(len(self.shards), self.do.setting == 'train', self.sampler)
+
+    def quotas(self, workers: int) -> t.List[int]:
+        """Number of samples each DataLoader worker of this rank yields in an epoch."""
+        if self.exact:
+            return [int(self.counts[self.shard_sampler.shards(worker, workers, False)].sum())
+                    for worker in range(workers)]
+        quota = -(-self.total // self.world_size)
+
+        return [quota // workers + (worker < quota % workers) for worker in range(workers)]
+
+    def _samples(self, shards: t.List[int]) -> t.Iterator[SAMPLE]:
+        while True:
+            for shard in shards:
+                yield from read_shard(self.shard_dir / self.shards[shard])
+            if self.exact or not shards:
+                return
+
+    def _shuffled(self, samples: t.Iterator[SAMPLE], rng: np.random.RandomState) -> t.Iterator[SAMPLE]:
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.do.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _item(self, sample: SAMPLE) -> t.Tuple[piv.Video, pil.Label, pim.VideoMeta]:
+        key, files = sample
+        video_meta = pim.VideoMeta(**json.loads(files[META_SUFFIX]))
+        video = piv.Video(video_meta, ct.WORK_ROOT / self.do.root_path, False, self.cut, self.do.setting,
+                          self.so.num_segments, self.do.use_flow, self.aug_seq, SampleFrames(files), None,
+                          self.batch_transform is None, self.flow_cache, self.sampler[int(key)])
+        label = pil.Label(video_meta)
+
+        if not self.do.buffered:
+            video.to_tensor()
+        label.to_tensor()
+
+        return video, label, video_meta
+
+    def __iter__(self) -> t.Iterator[t.Tuple[piv.Video, pil.Label, pim.VideoMeta]]:
+        info = thd.get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        shards = self.shard_sampler.shards(self.rank * workers + worker, self.world_size * workers, not self.exact)
+
+        samples = self._samples(shards)
+        if self.do.setting == 'train':
+            rng = np.random.RandomState((self.sampler.seed, self.sampler.epoch, self.rank, worker))
+            samples = self._shuffled(samples, rng)
+
+        for sample in itertools.islice(samples, self.quotas(workers)[worker]):
+            yield self._item(sample)
+
+    def __getitem__(self, item: t.Any):
+        raise TypeError('Sharded datasets are iterable only.')
+
+    def __len__(self):
+        return sum(self.quotas(1))
+
+    def __str__(self):
+        return f'Sharded Something-Something Dataset: {len(self)} videos in {len(self.shards)} shards'
+
+
+class ShardLoader(thd.DataLoader):
+    """DataLoader over a ShardedVideoDataset that knows its number of batches. Workers batch their own samples."""
+
+    def __len__(self):
+        rounding = (lambda q: q // self.batch_size) if self.drop_last else (lambda q: -(-q // self.batch_size))
+
+        return sum(rounding(quota) for quota in self.dataset.quotas(max(self.num_workers, 1)))
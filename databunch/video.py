@@ -9,50 +9,137 @@ import numpy as np
 import torch as th
 import torchvision.transforms.functional as tv_func
 
+import databunch.flow_cache as fc
+import databunch.frame_cache as frc
+import databunch.frame_store as fs
+import databunch.jpeg_index as ji
 import databunch.video_meta as vm
 
+FLOW_ALGO = None
+
+
+def flow_algo() -> cv2.DenseOpticalFlow:
+    """Farneback is stateless between calls, so a single instance is shared by all videos of a process."""
+    global FLOW_ALGO
+    if FLOW_ALGO is None:
+        FLOW_ALGO = optf.createOptFlow_Farneback()
+
+    return FLOW_ALGO
+
+
+def flow_data(data: t.List[np.ndarray]) -> t.List[np.ndarray]:
+    _flow = []
+    for i in range(len(data) - 1):
+        first, second = data[i], data[i + 1]
+        first = cv2.cvtColor(first, cv2.COLOR_RGB2GRAY)
+        second = cv2.cvtColor(second, cv2.COLOR_RGB2GRAY)
+        frame_flow = np.clip(flow_algo().calc(first, second, None), -fc.FLOW_CLIP, fc.FLOW_CLIP)
+        _flow.append(frame_flow)
+
+    return _flow
+
+
+def segments(length: int, cut: float, num_segments: int) -> t.List[np.ndarray]:
+    cut_locs = np.arange(length)[0:int(round(length * cut)) - 1]
+    _segments = [segment for segment in np.array_split(cut_locs, num_segments) if segment.size > 0]
+
+    return _segments + [_segments[-1]] * (num_segments - len(_segments))
+
+
+def fixed_subsample(length: int, cut: float, num_segments: int) -> np.ndarray:
+    return np.array([segment[len(segment) // 2] for segment in segments(length, cut, num_segments)])
+
+
+def crop_windows(height: int, width: int, size: int, crops: int) -> t.List[t.Tuple[slice, slice]]:
+    """size x size windows spread evenly along the longer side of a frame, edge to edge, and centred on the shorter
+    side. A single window is centred."""
+    long, short = max(height, width), min(height, width)
+    offsets = np.linspace(0, long - size, crops).astype(int) if crops > 1 else [(long - size) // 2]
+    windows = [(slice((short - size) // 2, (short - size) // 2 + size), slice(x, x + size)) for x in offsets]
+
+    return windows if width >= height else [window[::-1] for window in windows]
+
 
 class Video(object):
     def __init__(self, meta: vm.VideoMeta, root_path: pl.Path, read_jpeg: bool,
-                 cut: float, setting: str, num_segments: int, flow: bool, aug_seq: ia.Sequential):
+                 cut: float, setting: str, num_segments: int, flow: bool, aug_seq: ia.Sequential,
+                 store: t.Optional[fs.FrameStore] = None, jpeg_index: t.Optional[ji.JpegIndex] = None,
+                 recon: bool = True, flow_cache: t.Optional[fc.FlowCache] = None,
+                 locs: t.Optional[np.ndarray] = None, frame_cache: t.Optional[frc.FrameCache] = None):
         assert 0.0 <= cut <= 1.0, f'Cut should be a value between 0.0 and 1.0. Received: {cut}.'
         assert setting in ['train', 'eval'], f'Unknown setting: {setting}.'
 
         self.meta = meta
         self.root_path = root_path
         self.read_jpeg = read_jpeg
+        self.cut_ratio = cut
         self.cut = int(round(self.meta.length * cut)) - 1
         self.setting = setting
         self.num_segments = num_segments
         self.flow = flow
         self.aug_seq = aug_seq
+        self.store = store
+        self.jpeg_index = jpeg_index
+        self.flow_cache = flow_cache
+        self.frame_cache = frame_cache
+        # with a flow cache, train flips are drawn here so they can be mirrored onto the cached flow.
+        self.flips = (False, False)
+        if flow and flow_cache is not None and setting == 'train':
+            self.flips = np.random.rand(2) < 0.5
 
-        self.flow_algo = cv2.optflow.createOptFlow_Farneback()
         self.cut_locs = self._cut_locs()
-        self.subsample_locs = self._subsample_locs()
+        self.subsample_locs = self._subsample_locs() if locs is None else locs
         self.data = self._get_data()
         self.data = self._do_augment()
-        self.recon = self._get_recon()
+        self.recon = self._get_recon() if recon else []
 
     def _get_data(self):
-        if self.read_jpeg:
-            data = self._image_data()
-        else:
-            data = self._video_data()
+        if self.store is not None:
+            return self.store.read(self.meta.id, self.subsample_locs)
+        if self.frame_cache is None:
+            return self._decoded_data()
+
+        data = self.frame_cache.get(self.meta.id, self.subsample_locs)
+        if any(frame is None for frame in data):
+            data = self._decoded_data()
+            self.frame_cache.put(self.meta.id, self.subsample_locs, data)
 
         return data
 
+    def _decoded_data(self) -> t.List[np.ndarray]:
+        return self._image_data() if self.read_jpeg else self._video_data()
+
     def _do_augment(self):
         det_aug_seq = self.aug_seq.to_deterministic()
+        data = [det_aug_seq.augment_image(frame) for frame in self.data]
+        if self.flips[0]:
+            data = [np.ascontiguousarray(frame[:, ::-1]) for frame in data]
+        if self.flips[1]:
+            data = [np.ascontiguousarray(frame[::-1]) for frame in data]
 
-        return [det_aug_seq.augment_image(frame) for frame in self.data]
+        return data
 
     def _get_recon(self):
+        if self.flow and self.flow_cache is not None:
+            recon = self._cached_flow_data()
+            if recon is not None:
+                return recon
         data = ia.Resize(56)(images=self.data)
-        recon = self._flow_data(data) if self.flow else data
+        recon = flow_data(data) if self.flow else data
 
         return recon
 
+    def _cached_flow_data(self) -> t.Optional[t.List[np.ndarray]]:
+        flows = self.flow_cache.read(self.meta.id, self.subsample_locs)
+        if flows is None:
+            return None
+        if self.flips[0]:
+            flows = [flow[:, ::-1] * np.array([-1.0, 1.0], dtype=np.float32) for flow in flows]
+        if self.flips[1]:
+            flows = [flow[::-1] * np.array([1.0, -1.0], dtype=np.float32) for flow in flows]
+
+        return [np.ascontiguousarray(flow) for flow in flows]
+
     def _cut_locs(self) -> np.ndarray:
         all_locs = np.arange(self.meta.length)
         cut_locs = all_locs[0:self.cut]
@@ -68,28 +155,23 @@ class Video(object):
         return subsample_locs
 
     def _random_subsample(self) -> np.ndarray:
-        segments = [segment for segment in np.array_split(self.cut_locs, self.num_segments) if segment.size > 0]
-        segments = self._pad_with_last_segment(segments)
-        sample = [np.random.choice(segment, replace=False) for segment in segments]
+        sample = [np.random.choice(segment, replace=False)
+                  for segment in segments(self.meta.length, self.cut_ratio, self.num_segments)]
 
         return np.array(sample)
 
     def _fixed_subsample(self) -> np.ndarray:
-        segments = [segment for segment in np.array_split(self.cut_locs, self.num_segments) if segment.size > 0]
-        segments = self._pad_with_last_segment(segments)
-        sample = [segment[len(segment) // 2] for segment in segments]
-
-        return np.array(sample)
-
-    def _pad_with_last_segment(self, segments: t.List[np.ndarray]) -> t.List[np.ndarray]:
-        segment_padding = self.num_segments - len(segments)
-
-        return segments + [segments[-1]] * segment_padding
+        return fixed_subsample(self.meta.length, self.cut_ratio, self.num_segments)
 
     def _image_data(self) -> t.List[np.ndarray]:
-        dir_path = glob.escape((self.root_path / self.meta.image_path).as_posix())
-        paths = np.sort(np.array(glob.glob(f'{dir_path}/*.jpeg')))
-        subsample_paths = paths[self.subsample_locs]
+        subsample_paths = None
+        if self.jpeg_index is not None:
+            subsample_paths = self.jpeg_index.paths(self.meta.id, self.root_path / self.meta.image_path,
+                                                    self.subsample_locs)
+        if subsample_paths is None:
+            dir_path = glob.escape((self.root_path / self.meta.image_path).as_posix())
+            paths = np.sort(np.array(glob.glob(f'{dir_path}/*.jpeg')))
+            subsample_paths = paths[self.subsample_locs]
         data = []
         for path in subsample_paths:
             data.append(cv2.cvtColor(cv2.imread(str(path)), cv2.COLOR_BGR2RGB))
@@ -98,6 +180,16 @@ class Video(object):
 
     def _video_data(self) -> t.List[np.ndarray]:
         cap = cv2.VideoCapture(str(self.root_path / self.meta.video_path))
+        data = self._seek_frames(cap) if isinstance(self.meta.keyframes, list) and self.meta.keyframes else None
+        if data is None:
+            cap.release()
+            cap = cv2.VideoCapture(str(self.root_path / self.meta.video_path))
+            data = self._grab_frames(cap)
+        cap.release()
+
+        return data
+
+    def _grab_frames(self, cap: cv2.VideoCapture) -> t.List[np.ndarray]:
         current_frame_loc = 0
         data = []
         for subsample_loc in self.subsample_locs:
@@ -106,26 +198,49 @@ class Video(object):
                 cap.grab()
             current_frame_loc += 1
             data.append(cv2.cvtColor(cap.read()[1], cv2.COLOR_BGR2RGB))
-        cap.release()
 
         return data
 
-    def _flow_data(self, data: t.List[np.ndarray]) -> t.List[np.ndarray]:
-        _flow = []
-        for i in range(len(data) - 1):
-            first, second = data[i], data[i + 1]
-            first = cv2.cvtColor(first, cv2.COLOR_RGB2GRAY)
-            second = cv2.cvtColor(second, cv2.COLOR_RGB2GRAY)
-            frame_flow = np.clip(self.flow_algo.calc(first, second, None), -20, 20)
-            _flow.append(frame_flow)
+    def _seek_frames(self, cap: cv2.VideoCapture) -> t.Optional[t.List[np.ndarray]]:
+        keyframes = np.array(self.meta.keyframes)
+        current_frame_loc = 0
+        data = []
+        for subsample_loc in self.subsample_locs:
+            keyframe_loc = keyframes[max(0, np.searchsorted(keyframes, subsample_loc, side='right') - 1)]
+            if keyframe_loc > current_frame_loc:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe_loc)
+                # the frame position read back after a seek is the requested one. the timestamp of the frame decoded
+                # after it tells where the demuxer landed. on a wrong frame, let the caller fall back to grabbing.
+                if not cap.grab() or not self._landed_on(cap, keyframe_loc):
+                    return None
+                current_frame_loc = keyframe_loc + 1
+            while current_frame_loc <= subsample_loc:
+                if not cap.grab():
+                    return None
+                current_frame_loc += 1
+            ok, frame = cap.retrieve()
+            if not ok:
+                return None
+            data.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+        return data
+
+    def _landed_on(self, cap: cv2.VideoCapture, loc: int) -> bool:
+        """Whether the last grabbed frame is within half a frame of the timestamp of frame loc. Rounded framerates
+        drift on long videos, which only costs a fall back to grabbing."""
+        if not self.meta.framerate:
+            return False
+        period = 1000.0 / self.meta.framerate
 
-        return _flow
+        return abs(cap.get(cv2.CAP_PROP_POS_MSEC) - loc * period) < period / 2
 
     def to_tensor(self):
         self.data = [tv_func.to_tensor(frame) for frame in self.data]
         self.recon = [tv_func.to_tensor(flow) for flow in self.recon]
 
     def to_numpy(self):
+        if isinstance(self.data, list) and self.data and isinstance(self.data[0], np.ndarray):
+            self.to_tensor()
         if isinstance(self.data, list):
             for i in range(len(self.data)):
                 if isinstance(self.data[i], th.Tensor):
@@ -142,3 +257,45 @@ class Video(object):
 
     def __repr__(self):
         return self.__str__()
+
+
+class MultiViewVideo(Video):
+    """Eval video seen through clips x crops views.
+
+    The union of the clip locations is decoded once and every view is cut from those frames. Views are stacked along
+    time, clip-major, so a batch is (B, views * T, C, H, W) for the evaluator to fold into (B * views, T, C, H, W). A
+    single crop is the centre crop of the eval augmentation, other crop counts are spread along the longer side.
+    """
+
+    def __init__(self, meta: vm.VideoMeta, root_path: pl.Path, read_jpeg: bool, cut: float, num_segments: int,
+                 flow: bool, aug_seq: ia.Sequential, clip_locs: np.ndarray, crops: int, size: int = 224,
+                 store: t.Optional[fs.FrameStore] = None, jpeg_index: t.Optional[ji.JpegIndex] = None,
+                 recon: bool = True, frame_cache: t.Optional[frc.FrameCache] = None):
+        self.clip_locs = clip_locs
+        self.crops = crops
+        self.size = size
+        super(MultiViewVideo, self).__init__(meta, root_path, read_jpeg, cut, 'eval', num_segments, flow, aug_seq,
+                                             store, jpeg_index, recon, None, np.unique(clip_locs), frame_cache)
+
+    def _do_augment(self):
+        # decoded frames follow the sorted, unique locations.
+        clips = np.searchsorted(self.subsample_locs, self.clip_locs)
+        if self.crops == 1:
+            det_aug_seq = self.aug_seq.to_deterministic()
+            frames = [det_aug_seq.augment_image(frame) for frame in self.data]
+
+            return [frames[i] for i in clips.reshape(-1)]
+
+        pad = ia.PadToFixedSize(self.size, self.size, position='center')
+        frames = [pad.augment_image(frame) for frame in self.data]
+        windows = crop_windows(*frames[0].shape[0:2], self.size, self.crops)
+
+        return [np.ascontiguousarray(frames[i][window]) for clip in clips for window in windows for i in clip]
+
+    def _get_recon(self):
+        recon = []
+        for start in range(0, len(self.data), self.num_segments):
+            data = ia.Resize(56)(images=self.data[start:start + self.num_segments])
+            recon.extend(flow_data(data) if self.flow else data)
+
+        return recon
@@ -1,16 +1,26 @@
-import dataclasses
+import typing as t
 
 
-@dataclasses.dataclass
-class VideoMeta:
+class VideoMeta(object):
     fields = ['id', 'framerate', 'length', 'height',
-              'width', 'label', 'lid', 'video_path', 'image_path']
-    id: int
-    framerate: int
-    length: int
-    height: int
-    width: int
-    label: str
-    lid: int
-    video_path: str
-    image_path: str
+              'width', 'label', 'lid', 'video_path', 'image_path', 'keyframes']
+    __slots__ = fields
+
+    def __init__(self, id: t.Union[int, str], framerate: int, length: int, height: int, width: int, label: str,
+                 lid: int, video_path: str, image_path: str, keyframes: t.Optional[t.List[int]] = None):
+        self.id = id
+        self.framerate = framerate
+        self.length = length
+        self.height = height
+        self.width = width
+        self.label = label
+        self.lid = lid
+        self.video_path = video_path
+        self.image_path = image_path
+        self.keyframes = keyframes
+
+    def __eq__(self, other: 'VideoMeta') -> bool:
+        return isinstance(other, VideoMeta) and all(getattr(self, f) == getattr(other, f) for f in self.fields)
+
+    def __repr__(self):
+        return f'VideoMeta({", ".join(f"{field}={getattr(self, field)!r}" for field in self.fields)})'
@@ -1,29 +1,152 @@
+import hashlib
 import json
 import pathlib as pl
 import typing as tp
 
 import dacite as da
+import numpy as np
 import pandas as pd
 from torch import nn
 
 import constants as ct
+import env
 import specs
 from options import experiment_options as eo, model_options as mo, data_options as do, job_options as jo
 
+INDEX_COLUMN = '__index__'
+VALUES_SUFFIX = '.values'
+LENGTHS_SUFFIX = '.lengths'
+NULLS_SUFFIX = '.nulls'
+VERSION_KEY = '__version__'
+CHECKSUM_KEY = '__checksum__'
+COMPILED_VERSION = 1
+
+META_JSON = {'orient': 'index'}
+STATS_JSON = {'orient': 'index', 'typ': 'frame'}
+LID2GID_JSON = {'orient': 'index'}
+LABEL2LID_JSON = {'orient': 'index', 'typ': 'frame', 'dtype': False}
+LABEL_MAP_JSON = {'orient': 'index', 'typ': 'frame', 'dtype': True, 'encoding': 'utf-8'}
+
 
 def count_parameters(model: nn.Module) -> int:
     return sum(p.numel() for p in model.parameters())
 
 
+def meta_to_columns(meta: pd.DataFrame) -> tp.Dict[str, np.ndarray]:
+    """Typed numpy columns of a meta frame. Strings become fixed width unicode arrays and list columns (keyframes) are
+    flattened into a values array plus per row lengths, with -1 marking a missing list."""
+    columns = {INDEX_COLUMN: _to_column(meta.index.to_series())}
+    for name in meta.columns:
+        series = meta[name]
+        if series.dtype == object and any(isinstance(value, list) for value in series):
+            lists = [value if isinstance(value, list) else None for value in series]
+            columns[f'{name}{VALUES_SUFFIX}'] = np.array([v for value in lists if value for v in value], dtype=np.int64)
+            columns[f'{name}{LENGTHS_SUFFIX}'] = np.array([-1 if value is None else len(value) for value in lists],
+                                                          dtype=np.int64)
+        else:
+            columns[name] = _to_column(series)
+            if not pd.api.types.is_numeric_dtype(series.dtype) and series.isnull().any():
+                columns[f'{name}{NULLS_SUFFIX}'] = series.isnull().to_numpy()
+
+    return columns
+
+
+def _to_column(series: pd.Series) -> np.ndarray:
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy()
+
+    return series.astype(str).to_numpy().astype(np.str_)
+
+
+def columns_to_meta(columns: tp.Mapping[str, np.ndarray]) -> pd.DataFrame:
+    data = {}
+    for name in columns:
+        if name == INDEX_COLUMN or name.endswith(VALUES_SUFFIX) or name.endswith(NULLS_SUFFIX):
+            continue
+        if name.endswith(LENGTHS_SUFFIX):
+            name = name[:-len(LENGTHS_SUFFIX)]
+            data[name] = split_lists(columns[f'{name}{VALUES_SUFFIX}'], columns[f'{name}{LENGTHS_SUFFIX}'])
+        elif f'{name}{NULLS_SUFFIX}' in columns:
+            data[name] = np.where(columns[f'{name}{NULLS_SUFFIX}'], np.nan, columns[name].astype(object))
+        else:
+            data[name] = columns[name]
+
+    return pd.DataFrame(data, index=columns[INDEX_COLUMN])
+
+
+def split_lists(values: np.ndarray, lengths: np.ndarray) -> tp.List[tp.Optional[tp.List[int]]]:
+    ends = np.cumsum(np.maximum(lengths, 0))
+
+    return [None if length < 0 else values[end - length:end].tolist() for end, length in zip(ends, lengths)]
+
+
+def compiled_path(path: tp.Union[pl.Path, str]) -> pl.Path:
+    path = pl.Path(path)
+
+    return path.parent / f'{path.stem}.compiled.npz'
+
+
+def _checksum(columns: tp.Mapping[str, np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for name in sorted(columns):
+        digest.update(name.encode('utf-8'))
+        digest.update(np.ascontiguousarray(columns[name]).tobytes())
+
+    return digest.hexdigest()
+
+
+def compile_json(path: tp.Union[pl.Path, str], read_kwargs: tp.Dict[str, tp.Any]) -> pl.Path:
+    """Parse a json frame once and store it as versioned, checksummed numpy columns next to it."""
+    columns = meta_to_columns(pd.read_json(path, **read_kwargs))
+    columns[CHECKSUM_KEY] = np.array(_checksum(columns))
+    columns[VERSION_KEY] = np.array(COMPILED_VERSION)
+    with open(compiled_path(path).as_posix(), 'wb') as file:
+        np.savez(file, **columns)
+
+    return compiled_path(path)
+
+
+def _read_compiled(path: pl.Path) -> tp.Optional[pd.DataFrame]:
+    compiled = compiled_path(path)
+    if not compiled.exists() or (path.exists() and compiled.stat().st_mtime < path.stat().st_mtime):
+        return None
+
+    with np.load(compiled.as_posix()) as data:
+        columns = {name: data[name] for name in data.files}
+    version, checksum = int(columns.pop(VERSION_KEY, -1)), str(columns.pop(CHECKSUM_KEY, ''))
+    if version != COMPILED_VERSION or checksum != _checksum(columns):
+        env.LOGGER.warning(f'Ignoring outdated or corrupt compiled frame {compiled}. Reading {path} instead.')
+        return None
+
+    return columns_to_meta(columns)
+
+
+def _read_json(path: tp.Union[pl.Path, str], read_kwargs: tp.Dict[str, tp.Any]) -> pd.DataFrame:
+    df = _read_compiled(pl.Path(path))
+
+    return pd.read_json(path, **read_kwargs) if df is None else df
+
+
 def read_meta(path: tp.Union[pl.Path, str]) -> pd.DataFrame:
     path = ct.WORK_ROOT / pl.Path(path)
+    if path.suffix == '.npz':
+        with np.load(path.as_posix()) as columns:
+            return columns_to_meta(columns).sort_index()
 
-    return pd.read_json(path, orient='index').sort_index()
+    return _read_json(path, META_JSON).sort_index()
+
+
+def write_meta(meta: pd.DataFrame, path: tp.Union[pl.Path, str]) -> None:
+    path = ct.WORK_ROOT / pl.Path(path)
+    if path.suffix == '.npz':
+        np.savez(path.as_posix(), **meta_to_columns(meta))
+    else:
+        meta.to_json(path, orient='index')
 
 
 def read_stats(path: pl.Path) -> pd.DataFrame:
     path = ct.WORK_ROOT / pl.Path(path)
-    df = pd.read_json(path, orient='index', typ='frame')
+    df = _read_json(path, STATS_JSON)
 
     return df
 
@@ -36,24 +159,24 @@ def read_results(path: tp.Union[pl.Path, str]) -> pd.DataFrame:
 
 
 def read_lid2gid(path: pl.Path) -> pd.DataFrame:
-    return pd.read_json(path, orient='index').astype({'lid': int, 'gid': int}).sort_index()
+    return _read_json(path, LID2GID_JSON).astype({'lid': int, 'gid': int}).sort_index()
 
 
 def read_label2lid(path: pl.Path) -> pd.DataFrame:
-    df = pd.read_json(path, orient='index', typ='frame', dtype=False)
+    df = _read_json(path, LABEL2LID_JSON)
 
     return df
 
 
 def read_smth_lid2label(path: pl.Path) -> pd.DataFrame:
-    df = pd.read_json(path, orient='index', typ='frame', dtype=True, encoding='utf-8')
+    df = _read_json(path, LABEL_MAP_JSON)
     df = df.set_index('id', drop=False, verify_integrity=True)
 
     return df
 
 
 def read_gid2labels(path: pl.Path = ct.SMTH_GID2LABELS) -> pd.DataFrame:
-    df = pd.read_json(path, orient='index', typ='frame', dtype=True, encoding='utf-8')
+    df = _read_json(path, LABEL_MAP_JSON)
     df.index = df.index.map(lambda x: (int(x.replace('[', '').replace(']', '').split(',')[0]),
                                        int(x.replace('[', '').replace(']', '').split(',')[1])))
 
@@ -63,7 +186,7 @@ def read_gid2labels(path: pl.Path = ct.SMTH_GID2LABELS) -> pd.DataFrame:
 
 
 def read_smth_label2gid(path: pl.Path = ct.SMTH_LABEL2GID) -> pd.DataFrame:
-    df = pd.read_json(path, orient='index', typ='frame', dtype=True, encoding='utf-8')
+    df = _read_json(path, LABEL_MAP_JSON)
 
     return df
 
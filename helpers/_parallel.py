@@ -1,11 +1,19 @@
+import concurrent.futures as cf
 import dataclasses
+import functools
 import itertools
-import multiprocessing as mp
 import os
-from typing import Any, Callable, Iterable, List, cast
+import time
+import traceback
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, cast
 
 import tqdm
 
+import env
+
+SMOOTHING = 0.5
+BALANCE = 4
+
 
 @dataclasses.dataclass
 class Result:
@@ -13,34 +21,108 @@ class Result:
     items: List[Any]
 
 
-def chunk(n: int, iterable: Iterable):
-    args = [iter(iterable)] * n
-    batches = itertools.zip_longest(*args, fillvalue=None)
-    enumerated_and_filtered = []
-    for idx, batch in enumerate(batches):
-        enumerated_and_filtered.append((idx, list(filter(lambda elem: elem is not None, batch))))
-    return enumerated_and_filtered
+def chunk(n: int, iterable: Iterable) -> Iterator[Tuple[int, List[Any]]]:
+    """Lazily enumerated batches of n items."""
+    iterator = iter(iterable)
+    for idx in itertools.count():
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield idx, batch
+
+
+class _Chunker(object):
+    """Lazy enumerated batches whose size follows the measured time per item, aiming at target seconds per batch.
+    With a known total, batches stay small enough to give every worker several of them."""
+
+    def __init__(self, items: Iterable, size: int, target: Optional[float], total: Optional[int], workers: int):
+        self.items = iter(items)
+        self.size = size
+        self.target = target
+        self.limit = max(1, -(-total // (workers * BALANCE))) if total is not None else None
+        self.per_item = None
+        self.idx = 0
+
+    def next(self) -> Optional[Tuple[int, List[Any]]]:
+        batch = list(itertools.islice(self.items, self.size))
+        if not batch:
+            return None
+        self.idx += 1
+
+        return self.idx - 1, batch
+
+    def measure(self, length: int, seconds: float) -> None:
+        if self.target is None or not length:
+            return
+        per_item = seconds / length
+        self.per_item = per_item if self.per_item is None else SMOOTHING * per_item + (1 - SMOOTHING) * self.per_item
+        size = max(1, int(round(self.target / max(self.per_item, 1e-6))))
+        self.size = min(size, self.limit) if self.limit is not None else size
 
 
-def execute(func: Callable, items: List[Any],
-            batch_size: int = 20, workers: int = os.cpu_count(), debug=False) -> List[Any]:
-    results = []
-    kwargs = {
-        'total': len(items),
-        'leave': True
-    }
+def _timed(func: Callable, batch: Tuple[int, List[Any]]) -> Tuple[Result, float]:
+    start = time.perf_counter()
+    result = func(batch)
+
+    return result, time.perf_counter() - start
+
+
+def execute(func: Callable, items: Iterable[Any], batch_size: int = 20, workers: int = os.cpu_count(),
+            debug: bool = False, threads: bool = False, window: Optional[int] = None, retries: int = 1,
+            target_seconds: Optional[float] = None) -> Iterator[Any]:
+    """Run func over enumerated batches of items in a pool and yield the items of the results as they complete.
+
+    Batches are cut lazily and at most window of them (twice the workers by default) are in flight, so memory stays
+    flat for long item streams. With target_seconds, the batch size adapts to the measured time per item, which
+    changes the batch numbering. Failed batches are retried up to retries times and reported together at the end,
+    after all other batches ran. Set threads for I/O bound functions and debug to run batches in this process.
+    """
+    total = len(items) if hasattr(items, '__len__') else None
+    chunker = _Chunker(items, batch_size, target_seconds, total, workers)
 
-    batches = chunk(batch_size, items)
     if debug:
-        for result in tqdm.tqdm(map(func, batches), total=len(batches)):
-            result = cast(Result, result)
-            results.extend(result.items)
-    else:
-        with mp.Pool(workers) as pool:
-            with tqdm.tqdm(**kwargs) as pbar:
-                for result in pool.imap_unordered(func, batches):
-                    result = cast(Result, result)
-                    pbar.update(result.length)
-                    results.extend(result.items)
-
-    return results
+        with tqdm.tqdm(total=total, leave=True) as pbar:
+            for batch in iter(chunker.next, None):
+                result = cast(Result, func(batch))
+                pbar.update(result.length)
+                yield from result.items
+        return
+
+    window = window or 2 * workers
+    executor = cf.ThreadPoolExecutor if threads else cf.ProcessPoolExecutor
+    failures = []
+    with executor(workers) as pool, tqdm.tqdm(total=total, leave=True) as pbar:
+        pending = {}
+
+        def fill():
+            while len(pending) < window:
+                batch = chunker.next()
+                if batch is None:
+                    return
+                pending[pool.submit(functools.partial(_timed, func), batch)] = (batch, 0)
+
+        fill()
+        while pending:
+            done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+            for future in done:
+                batch, attempt = pending.pop(future)
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    if attempt < retries:
+                        env.LOGGER.warning(f'Batch {batch[0]} failed with {e!r}. Retrying...')
+                        pending[pool.submit(functools.partial(_timed, func), batch)] = (batch, attempt + 1)
+                    else:
+                        failures.append((batch[0], ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+                        pbar.update(len(batch[1]))
+                    continue
+                result = cast(Result, result)
+                chunker.measure(result.length, seconds)
+                pbar.update(result.length)
+                yield from result.items
+            fill()
+
+    for idx, error in failures:
+        env.LOGGER.error(f'Batch {idx} failed after {retries + 1} attempts:\n{error}')
+    if failures:
+        raise RuntimeError(f'{len(failures)} batches failed: {[idx for idx, _ in failures]}.')
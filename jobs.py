@@ -25,11 +25,18 @@ def select_subset(opts: jo.SelectSubsetOptions) -> None:
 def prepro_set(opts: jo.PreproSetOptions) -> None:
     import prepro
     prepro.common.split_train_dev(opts.set, int(opts.split))
-    prepro.common.augment_meta(opts.set, int(opts.split))
+    prepro.common.augment_meta(opts.set, int(opts.split), opts.verify_meta)
     prepro.common.merge_meta(opts.set, int(opts.split))
     prepro.common.gather_stats(opts.set, int(opts.split))
+    prepro.common.compile_meta(opts.set, int(opts.split))
     if opts.jpeg:
-        prepro.common.extract_jpeg(opts.set, int(opts.split))
+        prepro.common.extract_jpeg(opts.set, int(opts.split), opts.jpeg_size, opts.jpeg_quality)
+    if opts.store:
+        prepro.common.store_frames(opts.set, int(opts.split))
+    if opts.shards:
+        prepro.common.write_shards(opts.set, int(opts.split))
+    if opts.flow:
+        prepro.common.cache_flow(opts.set, int(opts.split), opts.dense_flow)
 
 
 def run_experiment(local_rank: int, opts: jo.RunExperimentOptions):
@@ -50,6 +57,7 @@ def run_experiment(local_rank: int, opts: jo.RunExperimentOptions):
 
 def evaluate_experiment(local_rank: int, opts: jo.EvaluateExperimentOptions):
     spec = hp.load_spec(opts)
+    spec.evaluator.clips, spec.evaluator.crops = int(opts.clips), int(opts.crops)
     if spec.model.type == 'class':
         import postpro.evaluators.evaluator_class as ecl
         ecl.ClassEvaluator(spec, local_rank).start()
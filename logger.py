@@ -3,7 +3,6 @@ import json
 import typing as t
 
 import ignite.contrib.handlers.tensorboard_logger as tbl
-import ignite.contrib.handlers.tqdm_logger as tql
 import ignite.engine as ie
 import numpy as np
 import torch.nn as nn
@@ -15,6 +14,7 @@ import constants as ct
 import databunch.databunch as db
 import helpers as hp
 import options.experiment_options as eo
+import pro.engine as pe
 import specs.maps as sm
 
 
@@ -38,16 +38,10 @@ class ExperimentLogger(object):
         self.main_proc = main_proc
         self.train_metrics = sm.Metrics[train_metrics].value
         self.dev_metrics = sm.Metrics[dev_metrics].value
-        self.pbar = self._init_pbar()
+        self.pbar = None
         self.tb_logger = self._init_tb_logger()
         self.metrics = {}
 
-    @_Decorator.main_proc_only
-    def _init_pbar(self) -> t.Optional[tql.ProgressBar]:
-        train_pbar = tql.ProgressBar(persist=True, dynamic_ncols=True)
-
-        return train_pbar
-
     @_Decorator.main_proc_only
     def _init_tb_logger(self) -> t.Optional[tbl.TensorboardLogger]:
         return tbl.TensorboardLogger(
@@ -56,20 +50,29 @@ class ExperimentLogger(object):
 
     @_Decorator.main_proc_only
     def attach_pbar(self, engine: ie.Engine):
-        self.pbar.attach(engine, 'all')
+        """Show a progress bar per epoch that advances with the train metrics on LOG_ITERATION, when they are on the
+        host, instead of on every iteration. The ignite 0.2 ProgressBar only attaches to built-in events."""
+        engine.add_event_handler(pe.LOG_ITERATION, self._update_pbar)
+        engine.add_event_handler(ie.Events.EPOCH_COMPLETED, self._close_pbar)
+
+    def _update_pbar(self, engine: ie.Engine):
+        if self.pbar is None:
+            self.pbar = tqdm.tqdm(total=len(engine.state.dataloader), leave=True, dynamic_ncols=True)
+        self.pbar.set_description(f'Epoch [{engine.state.epoch}/{engine.state.max_epochs}]', refresh=False)
+        self.pbar.set_postfix(engine.state.metrics, refresh=False)
+        self.pbar.update(engine.state.epoch_iteration - self.pbar.n)
+
+    def _close_pbar(self, _engine: ie.Engine):
+        if self.pbar is not None:
+            self.pbar.close()
+            self.pbar = None
 
     @_Decorator.main_proc_only
-    def init_handlers(self, trainer: ie.Engine, evaluator: ie.Engine, model: nn.Module, optimizer):
-        self.tb_logger.attach(trainer,
-                              log_handler=tbl.OutputHandler(
-                                  tag='training',
-                                  metric_names='all'),
-                              event_name=ie.Events.ITERATION_COMPLETED)
-        self.tb_logger.attach(trainer,
-                              log_handler=tbl.OptimizerParamsHandler(
-                                  optimizer,
-                                  tag='training'),
-                              event_name=ie.Events.ITERATION_COMPLETED)
+    def init_handlers(self, trainer: ie.Engine, evaluator: ie.Engine, model: nn.Module, optimizer,
+                      dev_step: t.Optional[t.Callable[[ie.Engine, str], int]] = None):
+        dev_step = dev_step or tbl.global_step_from_engine(trainer)
+        self._attach_log_iteration(trainer, tbl.OutputHandler(tag='training', metric_names='all'))
+        self._attach_log_iteration(trainer, tbl.OptimizerParamsHandler(optimizer, tag='training'))
         self.tb_logger.attach(trainer,
                               log_handler=tbl.OutputHandler(tag='train',
                                                             metric_names='all'),
@@ -77,23 +80,23 @@ class ExperimentLogger(object):
         self.tb_logger.attach(evaluator,
                               log_handler=tbl.OutputHandler(tag='dev',
                                                             metric_names='all',
-                                                            global_step_transform=tbl.global_step_from_engine(trainer)),
+                                                            global_step_transform=dev_step),
                               event_name=ie.Events.EPOCH_COMPLETED)
 
         if self.opts.debug:
-            self.tb_logger.attach(trainer, log_handler=tbl.OptimizerParamsHandler(optimizer, tag=self.DEBUG_TAG),
-                                  event_name=ie.Events.ITERATION_COMPLETED)
-            self.tb_logger.attach(trainer, log_handler=tbl.WeightsHistHandler(model, tag=self.DEBUG_TAG),
-                                  event_name=ie.Events.ITERATION_COMPLETED)
-            self.tb_logger.attach(trainer, log_handler=tbl.WeightsScalarHandler(model, tag=self.DEBUG_TAG),
-                                  event_name=ie.Events.ITERATION_COMPLETED)
+            self._attach_log_iteration(trainer, tbl.OptimizerParamsHandler(optimizer, tag=self.DEBUG_TAG))
+            self._attach_log_iteration(trainer, tbl.WeightsHistHandler(model, tag=self.DEBUG_TAG))
+            self._attach_log_iteration(trainer, tbl.WeightsScalarHandler(model, tag=self.DEBUG_TAG))
             self.tb_logger.attach(trainer, log_handler=tbl.GradsHistHandler(model, tag=self.DEBUG_TAG),
                                   event_name=ie.Events.EPOCH_COMPLETED)
-            self.tb_logger.attach(trainer, log_handler=tbl.GradsScalarHandler(model, tag=self.DEBUG_TAG),
-                                  event_name=ie.Events.ITERATION_COMPLETED)
+            self._attach_log_iteration(trainer, tbl.GradsScalarHandler(model, tag=self.DEBUG_TAG))
             self.tb_logger.attach(trainer, log_handler=tbl.GradsHistHandler(model, tag=self.DEBUG_TAG),
                                   event_name=ie.Events.EPOCH_COMPLETED)
 
+    def _attach_log_iteration(self, trainer: ie.Engine, log_handler: t.Callable):
+        """Attach a tensorboard handler to LOG_ITERATION, stepped by the trainer iteration."""
+        trainer.add_event_handler(pe.LOG_ITERATION, log_handler, self.tb_logger, ie.Events.ITERATION_COMPLETED)
+
     @_Decorator.main_proc_only
     def init_log(self,
                  data_bunch: db.VideoDataBunch = None,
@@ -145,9 +148,9 @@ class ExperimentLogger(object):
             json.dump(opts, file, indent=True)
 
     @_Decorator.main_proc_only
-    def persist_metrics(self, metrics: t.Dict[str, float], split: str):
+    def persist_metrics(self, metrics: t.Dict[str, float], split: str, name: str = 'metrics'):
         self.metrics.update(metrics)
-        with open(str(ct.WORK_ROOT / self.opts.run_dir / split / 'metrics.json'), 'w') as file:
+        with open(str(ct.WORK_ROOT / self.opts.run_dir / split / f'{name}.json'), 'w') as file:
             json.dump(metrics, file, indent=True)
 
     @_Decorator.main_proc_only
@@ -164,5 +167,5 @@ class ExperimentLogger(object):
 
     @_Decorator.main_proc_only
     def close(self):
-        self.pbar.close()
+        self._close_pbar(None)
         self.tb_logger.close()
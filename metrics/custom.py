@@ -1,22 +1,138 @@
 from typing import Tuple
 
+import ignite.engine as ien
 import ignite.exceptions as ie
 import ignite.metrics as im
 import torch as th
+import torch.distributed as dist
 
+import pro.engine as pe
+
+
+def correct(y_pred: th.Tensor, y: th.Tensor, k: int = 1) -> th.Tensor:
+    """Whether the target of each example is among its top k predictions, on the device of the predictions."""
+    if k == 1:
+        return y_pred.argmax(dim=-1) == y
+
+    return (y_pred.topk(k, dim=-1)[1] == y.view(-1, 1)).any(dim=-1)
+
+
+def accuracy(y_pred: th.Tensor, y: th.Tensor) -> th.Tensor:
+    """Top 1 accuracy of a batch, as a tensor on the device of the predictions."""
+    return correct(y_pred, y).float().mean()
+
+
+def top_k_accuracy(y_pred: th.Tensor, y: th.Tensor, k: int = 5) -> th.Tensor:
+    return correct(y_pred, y, k).float().mean()
+
+
+class RunningAverage(im.Metric):
+    """Exponential moving average of a value of the engine output, reset every epoch. The average stays on the device
+    and is only copied to the engine metrics on LOG_ITERATION events, fired by pro.engine.PrefetchEngine every few
+    iterations."""
+
+    def __init__(self, output_transform, alpha=0.98):
+        self.alpha = alpha
+        self._value = None
+        super(RunningAverage, self).__init__(output_transform)
+
+    def reset(self):
+        self._value = None
+
+    def update(self, output):
+        self._value = output if self._value is None else self._value * self.alpha + (1.0 - self.alpha) * output
+
+    def compute(self):
+        return self._value
+
+    def attach(self, engine, name):
+        engine.add_event_handler(ien.Events.EPOCH_STARTED, self.started)
+        engine.add_event_handler(ien.Events.ITERATION_COMPLETED, self.iteration_completed)
+        engine.add_event_handler(pe.LOG_ITERATION, self.completed, name)
+
+
+class SumMetric(im.Metric):
+    """Metric made of `size` sums over examples, averaged by the number of examples. The sums stay on the device while
+    batches are added. Computing the metric reduces the sums and the count of all processes with a single all-reduce
+    and caches the result until the next update, so every metric syncs once per epoch."""
+
+    size = 1
+
+    def reset(self):
+        self._sums = None
+        self._count = 0
+        self._means = None
+
+    def _add(self, n: int, *sums: th.Tensor) -> None:
+        sums = th.stack([value.detach().double() for value in sums])
+        self._sums = sums if self._sums is None else self._sums + sums
+        self._count += n
+        self._means = None
+
+    def _reduce_device(self) -> th.device:
+        if dist.get_backend() == dist.Backend.NCCL:
+            return th.device('cuda', th.cuda.current_device())
+
+        return th.device('cpu')
+
+    def _reduce(self) -> Tuple[float, ...]:
+        if self._means is not None:
+            return self._means
+
+        distributed = dist.is_available() and dist.is_initialized()
+        if self._sums is not None:
+            totals = th.cat([self._sums, self._sums.new_tensor([self._count])])
+        else:
+            # processes without examples still take part in the all-reduce.
+            totals = th.zeros(self.size + 1, dtype=th.float64, device=self._reduce_device() if distributed else None)
+        if distributed:
+            dist.all_reduce(totals)
+        *sums, count = totals.tolist()
+        if count == 0:
+            raise ie.NotComputableError(f'{type(self).__name__} must have at least one example before it can be '
+                                        f'computed')
+        self._means = tuple(value / count for value in sums)
+
+        return self._means
+
+
+class Accuracy(SumMetric):
+    """Top k accuracy, summed on the device and reduced over processes once computed."""
+
+    def __init__(self, k: int = 1, output_transform=lambda x: x):
+        self.k = k
+        super(Accuracy, self).__init__(output_transform)
+
+    def update(self, output):
+        y_pred, y = output
+        self._add(y.shape[0], correct(y_pred, y, self.k).sum())
+
+    def compute(self) -> float:
+        return self._reduce()[0]
+
+
+class Loss(SumMetric):
+    """Average of a batch averaged loss over examples, summed on the device and reduced over processes once computed."""
 
-class AELoss(im.Metric):
     def __init__(self, loss_fn, output_transform=lambda x: x):
-        super(AELoss, self).__init__(output_transform)
         self.loss_fn = loss_fn
-        self.ce = 0
-        self.l1 = 0
-        self.num_examples = 0
+        super(Loss, self).__init__(output_transform)
 
-    def reset(self):
-        self.ce = 0
-        self.l1 = 0
-        self.num_examples = 0
+    def update(self, output):
+        y_pred, y = output
+        n = y.shape[0]
+        self._add(n, self.loss_fn(y_pred, y) * n)
+
+    def compute(self) -> float:
+        return self._reduce()[0]
+
+
+class AELoss(SumMetric):
+    size = 2
+
+    def __init__(self, loss_fn, output_transform=lambda x: x):
+        super(AELoss, self).__init__(output_transform)
+        self.loss_fn = loss_fn
 
     def update(self, output):
         _recon, _pred, _temporal_embeds, _class_embed, _in, _target = output
@@ -24,28 +140,18 @@ class AELoss(im.Metric):
 
         n = _pred.shape[0]
 
-        self.ce += ce.item() * n
-        self.l1 += mse.item() * n
-        self.num_examples += n
+        self._add(n, ce * n, mse * n)
+
+    def compute(self) -> Tuple[float, float]:
+        return self._reduce()
 
-    def compute(self):
-        if self.num_examples == 0:
-            raise ie.NotComputableError('Loss must have at least one example before it can be computed')
-        return self.ce / self.num_examples, self.l1 / self.num_examples
 
+class GSNNLoss(SumMetric):
+    size = 2
 
-class GSNNLoss(im.Metric):
     def __init__(self, loss_fn, output_transform=lambda x: x):
         super(GSNNLoss, self).__init__(output_transform)
         self.loss_fn = loss_fn
-        self.ce = 0
-        self.kld = 0
-        self.num_examples = 0
-
-    def reset(self):
-        self.ce = 0
-        self.kld = 0
-        self.num_examples = 0
 
     def prepare(self, output: Tuple[th.Tensor, ...]) -> Tuple[th.Tensor, ...]:  # noqa
         _pred, _temporal_latents, _class_latent, _mean, _var, _in, _target, _ = output
@@ -58,31 +164,18 @@ class GSNNLoss(im.Metric):
 
         n = _pred.shape[0]
 
-        self.ce += ce.item() * n
-        self.kld += kld.item() * n
-        self.num_examples += n
+        self._add(n, ce * n, kld * n)
 
     def compute(self) -> Tuple[float, float]:
-        if self.num_examples == 0:
-            raise ie.NotComputableError(
-                'Loss must have at least one example before it can be computed')
-        return self.ce / self.num_examples, self.kld / self.num_examples
+        return self._reduce()
+
 
+class VAELoss(SumMetric):
+    size = 3
 
-class VAELoss(im.Metric):
     def __init__(self, loss_fn, output_transform=lambda x: x):
         super(VAELoss, self).__init__(output_transform)
         self.loss_fn = loss_fn
-        self.l1 = 0
-        self.ce = 0
-        self.kld = 0
-        self.num_examples = 0
-
-    def reset(self):
-        self.l1 = 0
-        self.ce = 0
-        self.kld = 0
-        self.num_examples = 0
 
     def prepare(self, output: Tuple[th.Tensor, ...]) -> Tuple[th.Tensor, ...]:  # noqa
         _recon, _pred, _temporal_latents, _class_latent, _mean, _var, _in, _target, _ = output
@@ -95,13 +188,7 @@ class VAELoss(im.Metric):
 
         n = _pred.shape[0]
 
-        self.ce += ce.item() * n
-        self.l1 += l1.item() * n
-        self.kld += kld.item() * n
-        self.num_examples += n
+        self._add(n, ce * n, l1 * n, kld * n)
 
     def compute(self) -> Tuple[float, float, float]:
-        if self.num_examples == 0:
-            raise ie.NotComputableError(
-                'Loss must have at least one example before it can be computed')
-        return self.ce / self.num_examples, self.l1 / self.num_examples, self.kld / self.num_examples
+        return self._reduce()
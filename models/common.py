@@ -20,6 +20,22 @@ class ReparameterizedSample(nn.Module):
         return z.transpose(0, 1).contiguous()
 
 
+class Float32(nn.Module):
+    """Runs a module on float32 inputs with autocast disabled, for numerically sensitive outputs under mixed
+    precision, such as posterior variances."""
+
+    def __init__(self, module: nn.Module):
+        super(Float32, self).__init__()
+
+        self.module = module
+
+    def forward(self, _in: th.Tensor) -> th.Tensor:
+        if not hasattr(th, 'autocast'):
+            return self.module(_in.float())
+        with th.autocast(_in.device.type, enabled=False):
+            return self.module(_in.float())
+
+
 class Upsample(nn.Module):
     shape: tp.Tuple[int, int, int]
 
@@ -1,9 +1,15 @@
 # Based on implementation from https://github.com/hassony2/kinetics_i3d_pytorch
+import inspect
 import typing as tp
 
 import torch as th
+import torch.utils.checkpoint as cp
 from torch import nn
 
+# torch>=1.11 asks for an explicit checkpoint variant. the reentrant one is the only one of older versions, and unlike
+# the other, it does not require the recomputation to save the same tensors, which batch norm layers do not.
+CHECKPOINT_KWARGS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(cp.checkpoint).parameters else {}
+
 
 def _pad_top_bottom(filter_dim: int, stride_val: int) -> tp.Tuple[int, int]:
     pad_along = max(filter_dim - stride_val, 0)
@@ -50,3 +56,56 @@ def he_init(model: nn.Module):
         elif isinstance(module, nn.BatchNorm2d):
             module.weight.data.fill_(1)
             module.bias.data.zero_()
+
+
+def _batch_norms(function: tp.Callable) -> tp.List[nn.Module]:
+    """Batch norm layers that update their running stats when function is a module or a method of a module."""
+    owner = getattr(function, '__self__', function)
+    if not isinstance(owner, nn.Module):
+        return []
+
+    return [module for module in owner.modules()
+            if isinstance(module, nn.modules.batchnorm._BatchNorm) and module.training and module.track_running_stats]
+
+
+def checkpointed(enabled: bool, function: tp.Callable, *args: tp.Any) -> tp.Any:
+    """Run function on args. When enabled and gradients are tracked, its activations are not kept for backward but
+    recomputed from args in the backward pass.
+
+    Only tensor args go through torch.utils.checkpoint. Other args, such as sample counts or missing inputs, are
+    bound in a closure. The recomputation runs in train mode as well, with track_running_stats switched off on the
+    batch norm layers in function, which then normalise with the batch stats without updating their running stats.
+    Their running stats are updated once per step."""
+    if not (enabled and th.is_grad_enabled() and any(isinstance(arg, th.Tensor) and arg.requires_grad for arg in args)):
+        return function(*args)
+
+    locs = [i for i, arg in enumerate(args) if isinstance(arg, th.Tensor)]
+    norms = _batch_norms(function)
+    calls = []
+
+    def run(*tensors: th.Tensor) -> tp.Any:
+        _args = list(args)
+        for i, tensor in zip(locs, tensors):
+            _args[i] = tensor
+        if not calls:
+            calls.append(True)
+            return function(*_args)
+
+        try:
+            for norm in norms:
+                norm.track_running_stats = False
+            return function(*_args)
+        finally:
+            for norm in norms:
+                norm.track_running_stats = True
+
+    return cp.checkpoint(run, *[args[i] for i in locs], **CHECKPOINT_KWARGS)
+
+
+def set_grad_checkpoint(model: nn.Module, enabled: bool) -> int:
+    """Switch activation checkpointing on the modules of a model that support it. Returns their number."""
+    modules = [module for module in model.modules() if hasattr(type(module), 'grad_checkpoint')]
+    for module in modules:
+        module.grad_checkpoint = enabled
+
+    return len(modules)
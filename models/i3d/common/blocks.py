@@ -78,6 +78,7 @@ class Mixed(nn.Module):
     branch_1: nn.Sequential
     branch_2: nn.Sequential
     branch_3: nn.Sequential
+    grad_checkpoint = False
 
     def __init__(self, in_channels: int, out_channels: tp.List[int], kernel_depth: tp.List[int] = None,
                  max_pool: bool = True):
@@ -108,6 +109,9 @@ class Mixed(nn.Module):
             self.branch_3 = nn.Sequential(branch_3_conv2)
 
     def forward(self, _in: th.Tensor) -> th.Tensor:
+        return hp.checkpointed(self.grad_checkpoint, self._forward, _in)
+
+    def _forward(self, _in: th.Tensor) -> th.Tensor:
         _out_0 = self.branch_0(_in)
         _out_1 = self.branch_1(_in)
         _out_2 = self.branch_2(_in)
@@ -57,7 +57,7 @@ class I3DEncoder(nn.Module):
         # latent_size x 1 x 7 x 7
         self.var = nn.Sequential(
             ib.Unit3D(opts),
-            nn.Softplus()
+            mc.Float32(nn.Softplus())
         )
         # latent_size x 1 x 7 x 7
         self.rsample = mc.ReparameterizedSample()
@@ -3,6 +3,7 @@ import typing as tp
 import torch as th
 from torch import nn
 
+import models.helpers as mh
 import models.tarn.common as tc
 
 
@@ -40,6 +41,8 @@ class TemporalResidualBlock(nn.Module):
 
 
 class TemporalResNetEncoder(nn.Module):
+    grad_checkpoint = False
+
     def __init__(self, time_steps: int, in_planes: int):
         super(TemporalResNetEncoder, self).__init__()
 
@@ -58,7 +61,7 @@ class TemporalResNetEncoder(nn.Module):
         for _t in range(self.time_steps):
             _out_prev = _out
             _in_t = _in[:, _t, :, :, :]
-            _out = self.temporal[_t](_in_t, _out_prev)
+            _out = mh.checkpointed(self.grad_checkpoint, self.temporal[_t], _in_t, _out_prev)
             b, c, h, w = _out.shape
             _outs.append(_out.reshape(b, 1, c, h, w))
         _outs = th.cat(_outs, dim=1)
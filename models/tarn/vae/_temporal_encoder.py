@@ -4,6 +4,7 @@ import torch as th
 from torch import nn
 
 import models.common
+import models.helpers
 from models.tarn import common as tc
 
 TEMPORAL_ENCODER_FORWARD = Tuple[th.Tensor, th.Tensor, th.Tensor, th.Tensor]
@@ -27,7 +28,7 @@ class VarTemporalResidualBlock(nn.Module):
         self.mean = tc.conv1x1(in_planes, in_planes)
         self.var = nn.Sequential(
             tc.conv1x1(in_planes, in_planes),
-            nn.Softplus()
+            models.common.Float32(nn.Softplus())
         )
 
         self.rsample = models.common.ReparameterizedSample()
@@ -71,6 +72,8 @@ class VarTemporalResidualBlock(nn.Module):
 
 
 class VarTemporalResNetEncoder(nn.Module):
+    grad_checkpoint = False
+
     def __init__(self, time_steps: int, in_planes: int):
         super(VarTemporalResNetEncoder, self).__init__()
 
@@ -101,7 +104,8 @@ class VarTemporalResNetEncoder(nn.Module):
         for _t in range(self.time_steps):
             _z_prev = _z
             _in_t = _in[:, :, _t, :, :, :]
-            _z, _mean, _var = self.temporal[_t](_in_t, _z_prev, num_samples_per_step[_t])
+            _z, _mean, _var = models.helpers.checkpointed(self.grad_checkpoint, self.temporal[_t], _in_t, _z_prev,
+                                                          num_samples_per_step[_t])
 
             b, s, c, h, w = _z.shape
             _zs.append(_z.reshape(b, s, 1, c, h, w))
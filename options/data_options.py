@@ -15,6 +15,16 @@ class DataSetOptions:
     read_jpeg: bool
     setting: str
     use_flow: bool = False
+    flow_cache: bool = False
+    read_store: bool = False
+    aug_engine: str = 'imgaug'
+    buffered: bool = False
+    frame_cache_mb: int = 0
+    frame_cache_path: Optional[pl.Path] = None
+    clips: int = 1
+    crops: int = 1
+    read_shards: bool = False
+    shuffle_buffer: int = 128
     keep: Union[float, int, None] = None
 
 
@@ -35,6 +45,10 @@ class DataBunch:
     frame_size: Union[int, Tuple[int, int]]
     stats_path: pl.Path
     distributed: bool = False
+    persistent_workers: bool = False
+    bucket_batches: int = 0
+    means: Optional[Tuple[float, float, float]] = None
+    stds: Optional[Tuple[float, float, float]] = None
     dlo: Optional[DataLoaderOptions] = None
     so: Optional[SamplingOptions] = None
     train_dso: Optional[DataSetOptions] = None
@@ -26,11 +26,21 @@ class TrainerOptions:
     optim_opts: AdamOptimizerOptions
     criterion: str
     metrics: str
+    overlap_eval: bool = False
+    prefetch: int = 2
+    amp: bool = False
+    amp_dtype: Optional[str] = None
+    accumulation_steps: int = 1
+    grad_checkpoint: bool = False
+    log_every: int = 10
 
 
 @dc.dataclass
 class EvaluatorOptions:
     metrics: str
+    prefetch: int = 2
+    clips: int = 1
+    crops: int = 1
 
 
 @dc.dataclass
@@ -30,7 +30,14 @@ class SelectSubsetOptions:
 class PreproSetOptions:
     set: str
     split: str
+    verify_meta: str2bool = False
     jpeg: str2bool = False
+    jpeg_size: int = 0
+    jpeg_quality: int = 95
+    store: str2bool = False
+    flow: str2bool = False
+    dense_flow: str2bool = False
+    shards: str2bool = False
 
 
 @dc.dataclass
@@ -53,6 +60,8 @@ class EvaluateExperimentOptions:
     resume: str2bool = False
     overfit: str2bool = False
     dev: str2bool = False
+    clips: int = 1
+    crops: int = 1
 
 
 @dc.dataclass
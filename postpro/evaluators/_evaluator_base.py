@@ -15,9 +15,11 @@ import torch.utils.data as tud
 import tqdm
 
 import constants as ct
+import databunch.batch_transforms as pbt
 import databunch.databunch as db
 import logger as lg
 import options.experiment_options as eo
+import pro.engine as pe
 import specs.maps as sm
 
 RESULTS = t.Tuple[t.Dict[str, np.ndarray], np.ndarray]
@@ -30,6 +32,8 @@ class BaseEvaluator(abc.ABC):
         self.local_rank = local_rank
 
         self.rank, self.world_size = self._init_distributed()
+        self.views = self.opts.evaluator.clips * self.opts.evaluator.crops
+        self.views_tag = f'{self.opts.evaluator.clips}x{self.opts.evaluator.crops}' if self.views > 1 else ''
         self.device = th.device(f'cuda' if cuda.is_available() else f'cpu')
         self.data_bunch, self.opts.model.opts.num_classes = self._init_databunch()
         self.best_ckpt = self._get_best_ckpt()
@@ -89,6 +93,9 @@ class BaseEvaluator(abc.ABC):
         self.opts.databunch.train_dso.setting = 'eval'
         self.opts.databunch.dev_dso.setting = 'eval'
         self.opts.databunch.test_dso.setting = 'eval'
+        assert self.views == 1 or self.opts.model.type == 'class', 'Multi-view evaluation needs a class model.'
+        for dso in [self.opts.databunch.train_dso, self.opts.databunch.dev_dso, self.opts.databunch.test_dso]:
+            dso.clips, dso.crops = self.opts.evaluator.clips, self.opts.evaluator.crops
         self.opts.databunch.dlo.shuffle = False
         self.opts.databunch.distributed = self.local_rank != -1
         data_bunch = db.VideoDataBunch(db_opts=self.opts.databunch)
@@ -103,19 +110,22 @@ class BaseEvaluator(abc.ABC):
         if split == 'train':
             loader = self.data_bunch.train_loader
             evaluator = self.train_evaluator
+            transform = self.data_bunch.train_transform
         elif split == 'dev':
             loader = self.data_bunch.dev_loader
             evaluator = self.dev_evaluator
+            transform = self.data_bunch.dev_transform
         else:
             loader = self.data_bunch.test_loader
             evaluator = self.test_evaluator
+            transform = self.data_bunch.test_transform
 
         metrics = self._calculate_metrics(evaluator, loader, split)
         self.logger.log_metrics(metrics)
-        self.logger.persist_metrics(metrics, split)
+        self.logger.persist_metrics(metrics, split, f'metrics{self.views_tag}')
 
         # Not computing predictions and tsnes for now since we don't use them anywhere.
-        # outs, ids = self._calculate_results(loader, split)
+        # outs, ids = self._calculate_results(loader, transform)
         # outs, tsne_ids = self._calculate_tsnes(outs, ids, split)
         # self.logger.persist_outs(outs, tsne_ids, split)
 
@@ -125,16 +135,19 @@ class BaseEvaluator(abc.ABC):
         evaluator.run(loader)
         self._aggregate_metrics(evaluator)
 
-        return {f'{split}_{k}': float(v) for k, v in evaluator.state.metrics.items()}
+        prefix = f'{split}_{self.views_tag}' if self.views_tag else split
 
-    def _calculate_results(self, loader: tud.DataLoader) -> RESULTS:
+        return {f'{prefix}_{k}': float(v) for k, v in evaluator.state.metrics.items()}
+
+    def _calculate_results(self, loader: tud.DataLoader, transform: pbt.BatchCompose) -> RESULTS:
         ids, targets = [], []
         outs = cl.defaultdict(list)
 
         pbar = tqdm.tqdm(total=len(loader.dataset), leave=True)
         with th.no_grad():
-            for i, (_in, _cls_gt, _recon_gt, videos) in enumerate(loader):
-                x = _in.to(device=self.device, non_blocking=True)
+            for i, batch in enumerate(loader):
+                x, _, _ = pe.prepare_batch(batch, self.device, True, transform)
+                videos = batch[-1]
 
                 ids.extend([video.id for video in videos])
 
@@ -22,9 +22,15 @@ class AutoEncoderEvaluator(_base.BaseEvaluator):
     def _init_evaluators(self) -> t.Tuple[ie.Engine, ie.Engine, ie.Engine]:
         evaluator_metrics = sm.Metrics[self.opts.evaluator.metrics].value
 
-        train_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True)
-        dev_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True)
-        test_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True)
+        train_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True,
+                                                 transform=self.data_bunch.train_transform,
+                                                 prefetch=self.opts.evaluator.prefetch)
+        dev_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True,
+                                               transform=self.data_bunch.dev_transform,
+                                               prefetch=self.opts.evaluator.prefetch)
+        test_evaluator = pe.create_ae_evaluator(self.model, evaluator_metrics, self.device, True,
+                                                transform=self.data_bunch.test_transform,
+                                                prefetch=self.opts.evaluator.prefetch)
 
         return train_evaluator, dev_evaluator, test_evaluator
 
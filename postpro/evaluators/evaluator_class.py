@@ -22,14 +22,29 @@ class ClassEvaluator(_base.BaseEvaluator):
     def _init_evaluators(self) -> t.Tuple[ie.Engine, ie.Engine, ie.Engine]:
         evaluator_metrics = sm.Metrics[self.opts.evaluator.metrics].value
 
-        train_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True)
-        dev_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True)
-        test_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True)
+        train_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True,
+                                                  transform=self.data_bunch.train_transform,
+                                                  prefetch=self.opts.evaluator.prefetch,
+                                                  views=self.views)
+        dev_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True,
+                                                transform=self.data_bunch.dev_transform,
+                                                prefetch=self.opts.evaluator.prefetch,
+                                                views=self.views)
+        test_evaluator = pe.create_cls_evaluator(self.model, evaluator_metrics, self.device, True,
+                                                 transform=self.data_bunch.test_transform,
+                                                 prefetch=self.opts.evaluator.prefetch,
+                                                 views=self.views)
 
         return train_evaluator, dev_evaluator, test_evaluator
 
     def _get_model_outputs(self, x: th.Tensor) -> t.Dict[str, np.ndarray]:
-        energy, temporal_embed, class_embed = self.model(x)
+        if self.views > 1:
+            energy, temporal_embed, class_embed = self.model(pe.fold_views(x, self.views))
+            energy = pe.average_views(energy, self.views)
+            temporal_embed = pe.mean_views(temporal_embed, self.views)
+            class_embed = pe.mean_views(class_embed, self.views)
+        else:
+            energy, temporal_embed, class_embed = self.model(x)
         conf = func.softmax(energy, dim=-1)
 
         return {
@@ -23,11 +23,14 @@ class VariationalAutoEncoderEvaluator(_base.BaseEvaluator):
         evaluator_metrics = sm.Metrics[self.opts.evaluator.metrics].value
 
         train_evaluator = pe.create_vae_evaluator(self.model, evaluator_metrics, self.device, ct.VAE_NUM_SAMPLES_TEST,
-                                                  True)
+                                                  True, transform=self.data_bunch.train_transform,
+                                                  prefetch=self.opts.evaluator.prefetch)
         dev_evaluator = pe.create_vae_evaluator(self.model, evaluator_metrics, self.device, ct.VAE_NUM_SAMPLES_TEST,
-                                                True)
+                                                True, transform=self.data_bunch.dev_transform,
+                                                prefetch=self.opts.evaluator.prefetch)
         test_evaluator = pe.create_vae_evaluator(self.model, evaluator_metrics, self.device, ct.VAE_NUM_SAMPLES_TEST,
-                                                 True)
+                                                 True, transform=self.data_bunch.test_transform,
+                                                 prefetch=self.opts.evaluator.prefetch)
 
         return train_evaluator, dev_evaluator, test_evaluator
 
@@ -1,5 +1,9 @@
 from prepro.common._augment_meta import main as augment_meta
+from prepro.common._cache_flow import main as cache_flow
+from prepro.common._compile_meta import main as compile_meta
 from prepro.common._extract_jpeg import main as extract_jpeg
 from prepro.common._gather_stats import main as gather_stats
 from prepro.common._merge_meta import main as merge_meta
 from prepro.common._split_train_dev import main as split_train_dev
+from prepro.common._store_frames import main as store_frames
+from prepro.common._write_shards import main as write_shards
@@ -1,7 +1,9 @@
-from typing import Any, List, Tuple
+import json
+import pathlib as pl
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
-import skvideo.io
 
 import constants as ct
 import env
@@ -9,6 +11,8 @@ import helpers as ghp
 import prepro.helpers as php
 
 DATA_ROOT_DIR = None
+VERIFY = False
+BATCH_SIZE = 16
 
 
 def add_columns(meta: pd.DataFrame) -> None:
@@ -16,18 +20,40 @@ def add_columns(meta: pd.DataFrame) -> None:
     meta['height'] = None
     meta['width'] = None
     meta['framerate'] = None
-
-
-def _augment_row(row: pd.Series) -> pd.Series:
-    video_path = DATA_ROOT_DIR / row['video_path']
-
-    video = skvideo.io.vread(video_path.as_posix())
-    video_meta = skvideo.io.ffprobe(video_path)['video']
-
-    row['length'], row['height'], row['width'], _ = video.shape
-    row['framerate'] = int(video_meta['@avg_frame_rate'].split('/')[0])
-
-    return row
+    meta['keyframes'] = None
+
+
+def _parse_probe(output: str) -> Tuple[Dict[str, int], List[int], Optional[int]]:
+    """Length, height, width and framerate, keyframe locations and the decoded frame count, if probed, of ffprobe json
+    output. The length is the number of video packets, which holds a single frame each. Packets are listed in decode
+    order, so they are sorted by presentation time to locate keyframes among the frames as they are read."""
+    probe = json.loads(output)
+    stream, packets = probe['streams'][0], probe.get('packets', [])
+    if all('pts_time' in packet for packet in packets):
+        # with B-frames, reference frames are decoded ahead of the frames presented before them.
+        packets = sorted(packets, key=lambda packet: float(packet['pts_time']))
+    num, den = (int(part) for part in stream['avg_frame_rate'].split('/'))
+    fields = {
+        'length': len(packets),
+        'height': int(stream['height']),
+        'width': int(stream['width']),
+        'framerate': int(round(num / den)) if den else num,
+    }
+    keyframes = [loc for loc, packet in enumerate(packets) if 'K' in packet.get('flags', '')]
+    decoded = int(stream['nb_read_frames']) if 'nb_read_frames' in stream else None
+
+    return fields, keyframes, decoded
+
+
+def _probe(video_path: pl.Path) -> Tuple[Dict[str, int], List[int], Optional[int]]:
+    """Read the video meta from the container and packet headers with a single ffprobe call. In verify mode, ffprobe
+    also decodes the stream to count frames."""
+    entries = 'stream=width,height,avg_frame_rate' + (',nb_read_frames' if VERIFY else '') + ':packet=pts_time,flags'
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0'] + (['-count_frames'] if VERIFY else []) +
+                         ['-show_entries', entries, '-of', 'json', video_path.as_posix()],
+                         stdout=subprocess.PIPE, check=True)
+
+    return _parse_probe(out.stdout.decode())
 
 
 def _augment_meta(batch: Tuple[int, List[Any]]) -> ghp.parallel.Result:
@@ -35,21 +61,33 @@ def _augment_meta(batch: Tuple[int, List[Any]]) -> ghp.parallel.Result:
 
     rows = []
     for index, row in batch:
-        rows.append((index, _augment_row(row)))
+        fields, keyframes, decoded = _probe(DATA_ROOT_DIR / row['video_path'])
+        if decoded is not None and decoded != fields['length']:
+            env.LOGGER.warning(f'Video {index} has {fields["length"]} packets but decodes to {decoded} frames.')
+            fields['length'] = decoded
+        for field, value in fields.items():
+            row[field] = value
+        rows.append((index, row, keyframes))
 
     return ghp.parallel.Result(len(batch), rows)
 
 
-def main(dataset: str, split: int):
-    global DATA_ROOT_DIR
+def main(dataset: str, split: int, verify: bool = False):
+    global DATA_ROOT_DIR, VERIFY
     DATA_ROOT_DIR = php.get_data_root_path(dataset)
+    VERIFY = verify
     [train, dev, _, test] = php.get_meta_paths(dataset, split)
 
     for path in [train, dev, test]:
         env.LOGGER.info(f'Augmenting metadata at {path.as_posix()}...')
         meta = ghp.read_meta(path)
         add_columns(meta)
-        for index, row in ghp.parallel.execute(_augment_meta, list(meta.iterrows()), 1):
+        keyframes = {}
+        # ffprobe runs in a subprocess, so threads are enough to keep the cores busy.
+        rows = ghp.parallel.execute(_augment_meta, list(meta.iterrows()), BATCH_SIZE, threads=True)
+        for index, row, row_keyframes in rows:
             meta.loc[index] = row
+            keyframes[index] = row_keyframes
+        meta['keyframes'] = pd.Series(keyframes, dtype=object)
         meta.to_json(ct.WORK_ROOT / path, orient='index')
         env.LOGGER.info('...Done')
@@ -0,0 +1,118 @@
+import pathlib as pl
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import imgaug.augmenters as ia
+import numpy as np
+import pandas as pd
+
+import constants as ct
+import databunch.flow_cache as fc
+import databunch.video as dv
+import env
+import helpers as ghp
+import prepro.helpers as php
+
+DATA_ROOT_DIR = None
+PAIRS_PATH = None
+DENSE_PATH = None
+RESOLUTION = 56
+NUM_SEGMENTS = [4, 8, 16]
+CUTS = [1.00, 0.75, 0.50]
+
+
+def _eval_pairs(length: int) -> List[Tuple[int, int]]:
+    pairs = set()
+    for num_segments in NUM_SEGMENTS:
+        for cut in CUTS:
+            locs = dv.fixed_subsample(length, cut, num_segments)
+            pairs.update((int(a), int(b)) for a, b in zip(locs[:-1], locs[1:]) if a != b)
+
+    return sorted(pairs)
+
+
+def _frames(video_path: pl.Path, count: int) -> List[np.ndarray]:
+    """Decode the first count frames with the eval geometry: centre pad/crop to 224, then resize to the flow size."""
+    eval_seq = ia.Sequential([
+        ia.PadToFixedSize(224, 224, position='center'),
+        ia.CropToFixedSize(224, 224, position='center'),
+    ])
+    cap = cv2.VideoCapture(video_path.as_posix())
+    frames = []
+    while len(frames) < count:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(eval_seq.augment_image(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+    cap.release()
+
+    return ia.Resize(RESOLUTION)(images=frames) if frames else []
+
+
+def _cache_flow(batch: Tuple[int, List[Dict[str, Any]]]) -> ghp.parallel.Result:
+    no, batch = batch
+
+    pairs = np.memmap(PAIRS_PATH.as_posix(), dtype=np.float16, mode='r+').reshape((-1, RESOLUTION, RESOLUTION, 2))
+    dense = None
+    if DENSE_PATH is not None:
+        dense = np.memmap(DENSE_PATH.as_posix(), dtype=np.float16, mode='r+').reshape((-1, RESOLUTION, RESOLUTION, 2))
+
+    decoded = []
+    for item in batch:
+        count = item['length'] if dense is not None else max([b for _, _, b in item['pairs']], default=0) + 1
+        frames = _frames(DATA_ROOT_DIR / item['video_path'], count)
+        for row, a, b in item['pairs']:
+            if b < len(frames):
+                pairs[row] = dv.flow_data([frames[a], frames[b]])[0]
+        if dense is not None:
+            offset = item['offset']
+            for i, flow in enumerate(dv.flow_data(frames)[0:item['length'] - 1]):
+                dense[offset + i] = flow
+        decoded.append((item['id'], len(frames), count))
+    pairs.flush()
+    if dense is not None:
+        dense.flush()
+    del pairs, dense
+
+    return ghp.parallel.Result(len(batch), decoded)
+
+
+def cache_flow(meta_path: pl.Path, dense: bool) -> None:
+    global PAIRS_PATH, DENSE_PATH
+    PAIRS_PATH, pairs_index_path = fc.cache_paths(ct.WORK_ROOT / meta_path, 'pairs', RESOLUTION)
+    DENSE_PATH, dense_index_path = fc.cache_paths(ct.WORK_ROOT / meta_path, 'dense', RESOLUTION)
+    entry_size = RESOLUTION * RESOLUTION * 2
+
+    meta = ghp.read_meta(meta_path)
+    items, pair_index, dense_index, offset = [], [], {}, 0
+    for _id, length, video_path in meta[['id', 'length', 'video_path']].values:
+        pairs = [(len(pair_index) + i, a, b) for i, (a, b) in enumerate(_eval_pairs(int(length)))]
+        pair_index.extend((str(_id), a, b) for _, a, b in pairs)
+        items.append({'id': _id, 'length': int(length), 'video_path': video_path, 'pairs': pairs, 'offset': offset})
+        dense_index[str(_id)] = {'offset': offset, 'count': int(length) - 1}
+        offset += int(length) - 1
+
+    np.memmap(PAIRS_PATH.as_posix(), dtype=np.float16, mode='w+', shape=(len(pair_index) * entry_size,)).flush()
+    if dense:
+        np.memmap(DENSE_PATH.as_posix(), dtype=np.float16, mode='w+', shape=(offset * entry_size,)).flush()
+    else:
+        DENSE_PATH = None
+
+    for _id, count, expected in ghp.parallel.execute(_cache_flow, items, 1):
+        if count < expected:
+            env.LOGGER.warning(f'Decoded {count}/{expected} frames for video {_id}. Missing flow is left at zero.')
+
+    pd.DataFrame(pair_index, columns=fc.PAIR_COLUMNS).to_json(pairs_index_path, orient='records')
+    if dense:
+        pd.DataFrame.from_dict(dense_index, orient='index')[fc.DENSE_COLUMNS].to_json(dense_index_path, orient='index')
+
+
+def main(dataset: str, split: int, dense: bool = False):
+    global DATA_ROOT_DIR
+    DATA_ROOT_DIR = php.get_data_root_path(dataset)
+    [train, dev, _, test] = php.get_meta_paths(dataset, split)
+
+    for path in [train, dev, test]:
+        env.LOGGER.info(f'Caching optical flow for {path.as_posix()}...')
+        cache_flow(path, dense)
+        env.LOGGER.info('...Done')
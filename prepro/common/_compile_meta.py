@@ -0,0 +1,25 @@
+import constants as ct
+import env
+import helpers as ghp
+import prepro.helpers as php
+
+
+def main(dataset: str, split: int):
+    [train, dev, merged, test] = php.get_meta_paths(dataset, split)
+    paths = [(path, ghp.META_JSON) for path in [train, dev, merged, test]]
+    paths.append((php.get_stats_path(dataset, split), ghp.STATS_JSON))
+    if dataset == 'smth':
+        paths.extend([
+            (ct.WORK_ROOT / ct.SMTH_LID2GID_1, ghp.LID2GID_JSON),
+            (ct.WORK_ROOT / ct.SMTH_LABEL2LID, ghp.LABEL2LID_JSON),
+            (ct.WORK_ROOT / ct.SMTH_LID2LABEL, ghp.LABEL_MAP_JSON),
+            (ct.WORK_ROOT / ct.SMTH_GID2LABELS, ghp.LABEL_MAP_JSON),
+            (ct.WORK_ROOT / ct.SMTH_LABEL2GID, ghp.LABEL_MAP_JSON),
+        ])
+
+    for path, read_kwargs in paths:
+        if not (ct.WORK_ROOT / path).exists():
+            continue
+        env.LOGGER.info(f'Compiling {path.as_posix()}...')
+        ghp.compile_json(ct.WORK_ROOT / path, read_kwargs)
+        env.LOGGER.info('...Done')
@@ -1,38 +1,140 @@
 import os
 import pathlib as pl
-from typing import List, Tuple
+import shutil
+from typing import List, Set, Tuple
 
+import cv2
 import pandas as pd
-import skvideo.io
 
+import constants as ct
 import env
 import helpers as ghp
 import prepro.helpers as php
 
 DATA_ROOT_DIR = None
+MANIFEST_PATH = None
+MAX_SIZE = 0
+QUALITY = 95
+BATCH_SIZE = 4
+FRAME_NAME = '%04d.jpeg'
 
 
-def _extract_jpeg(batch: Tuple[int, List[pd.Series]]) -> ghp.parallel.Result:
+def manifest_path(meta_path: pl.Path) -> pl.Path:
+    """Extracted videos of a split are recorded next to its meta file, e.g. meta.train.jpeg.done."""
+    meta_path = pl.Path(meta_path)
+
+    return meta_path.parent / f'{meta_path.stem}.jpeg.done'
+
+
+def _read_manifest(path: pl.Path, max_size: int, quality: int) -> Set[str]:
+    """Ids of the videos extracted with the same settings. Lines are id, frame count, max size and quality."""
+    if not path.exists():
+        return set()
+
+    done = set()
+    with open(path.as_posix(), 'r') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4 and fields[2:] == [str(max_size), str(quality)]:
+                done.add(fields[0])
+
+    return done
+
+
+def _record(_id: str, count: int) -> None:
+    # a single O_APPEND write per line keeps lines whole when workers finish at the same time.
+    fd = os.open(MANIFEST_PATH.as_posix(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, f'{_id}\t{count}\t{MAX_SIZE}\t{QUALITY}\n'.encode())
+    finally:
+        os.close(fd)
+
+
+def _size(height: int, width: int, max_size: int) -> Tuple[int, int]:
+    if not max_size or max(height, width) <= max_size:
+        return height, width
+    scale = max_size / max(height, width)
+
+    return round(height * scale), round(width * scale)
+
+
+def _resize(frame, max_size: int):
+    height, width = frame.shape[:2]
+    size = _size(height, width, max_size)
+    if size == (height, width):
+        return frame
+
+    return cv2.resize(frame, (size[1], size[0]), interpolation=cv2.INTER_AREA)
+
+
+def _is_complete(image_path: pl.Path, row: pd.Series) -> bool:
+    """Whether a directory missing from the manifest, e.g. extracted by an earlier version, holds every frame of the
+    video at the size of the current settings."""
+    if not image_path.is_dir():
+        return False
+    names = set(entry.name for entry in os.scandir(image_path.as_posix()) if entry.name.endswith('.jpeg'))
+    if names != set(FRAME_NAME % loc for loc in range(1, row['length'] + 1)):
+        return False
+    if 'height' not in row or 'width' not in row:
+        return True
+    frame = cv2.imread((image_path / (FRAME_NAME % 1)).as_posix())
+
+    return frame is not None and frame.shape[:2] == _size(row['height'], row['width'], MAX_SIZE)
+
+
+def _extract_jpeg(batch: Tuple[int, List[Tuple[str, pd.Series]]]) -> ghp.parallel.Result:
     no, batch = batch
+    # parallelism comes from the pool. one decoding thread per worker keeps the cores from being oversubscribed.
+    cv2.setNumThreads(1)
 
-    for index, row in batch:
+    extracted = []
+    for _id, row in batch:
         video_path: pl.Path = DATA_ROOT_DIR / row['video_path']
         image_path: pl.Path = DATA_ROOT_DIR / row['image_path']
-        video = skvideo.io.vread(video_path.as_posix())
+        if _is_complete(image_path, row):
+            _record(str(_id), row['length'])
+            extracted.append((_id, row['length']))
+            continue
+        # frames of an unfinished extraction are not in the manifest and are written again.
+        shutil.rmtree(image_path.as_posix(), ignore_errors=True)
         os.makedirs(image_path.as_posix(), exist_ok=True)
-        skvideo.io.vwrite((image_path / '%4d.jpeg').as_posix(), video)
 
-    return ghp.parallel.Result(len(batch), batch)
+        cap = cv2.VideoCapture(video_path.as_posix())
+        count = 0
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            count += 1
+            cv2.imwrite((image_path / (FRAME_NAME % count)).as_posix(), _resize(frame, MAX_SIZE),
+                        [cv2.IMWRITE_JPEG_QUALITY, QUALITY])
+        cap.release()
+        _record(str(_id), count)
+        extracted.append((_id, count))
+
+    return ghp.parallel.Result(len(batch), extracted)
+
 
+def extract_jpeg(meta_path: pl.Path) -> None:
+    global MANIFEST_PATH
+    MANIFEST_PATH = manifest_path(ct.WORK_ROOT / meta_path)
 
-def main(dataset: str, split: int):
-    global DATA_ROOT_DIR
+    meta = ghp.read_meta(meta_path)
+    done = _read_manifest(MANIFEST_PATH, MAX_SIZE, QUALITY)
+    rows = [(_id, row) for _id, row in meta.iterrows() if str(_id) not in done]
+    env.LOGGER.info(f'Skipping {len(meta) - len(rows)} videos already extracted.')
+    for _id, count in ghp.parallel.execute(_extract_jpeg, rows, BATCH_SIZE):
+        if count == 0:
+            env.LOGGER.warning(f'No frames decoded for video {_id}.')
+
+
+def main(dataset: str, split: int, max_size: int = 0, quality: int = 95):
+    global DATA_ROOT_DIR, MAX_SIZE, QUALITY
     DATA_ROOT_DIR = php.get_data_root_path(dataset)
+    MAX_SIZE, QUALITY = max_size, quality
     [train, dev, _, test] = php.get_meta_paths(dataset, split)
 
     for path in [train, dev, test]:
         env.LOGGER.info(f'Extracting jpeg images from {path.as_posix()}...')
-        meta = ghp.read_meta(path)
-        for _ in ghp.parallel.execute(_extract_jpeg, list(meta.iterrows()), 1):
-            continue
+        extract_jpeg(path)
         env.LOGGER.info('...Done')
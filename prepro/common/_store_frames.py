@@ -0,0 +1,79 @@
+import pathlib as pl
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import constants as ct
+import databunch.frame_store as fs
+import env
+import helpers as ghp
+import prepro.helpers as php
+
+DATA_ROOT_DIR = None
+STORE_PATH = None
+
+
+def _create_index(meta: pd.DataFrame) -> pd.DataFrame:
+    index = meta[['length', 'height', 'width']].astype(np.int64)
+    sizes = index['length'] * index['height'] * index['width'] * 3
+    index['offset'] = sizes.cumsum() - sizes
+
+    return index[fs.INDEX_COLUMNS]
+
+
+def _store_frames(batch: Tuple[int, List[Tuple[str, pd.Series]]]) -> ghp.parallel.Result:
+    no, batch = batch
+
+    store = np.memmap(STORE_PATH.as_posix(), dtype=np.uint8, mode='r+')
+    decoded = []
+    for _id, row in batch:
+        offset, length, height, width = (int(value) for value in row[fs.INDEX_COLUMNS])
+        clip = store[offset:offset + length * height * width * 3].reshape((length, height, width, 3))
+
+        cap = cv2.VideoCapture((DATA_ROOT_DIR / row['video_path']).as_posix())
+        count = 0
+        while count < length:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            clip[count] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            count += 1
+        cap.release()
+
+        # containers sometimes decode fewer frames than reported. repeat the last one to keep the layout dense.
+        if 0 < count < length:
+            clip[count:] = clip[count - 1]
+        decoded.append((_id, count))
+    store.flush()
+    del store
+
+    return ghp.parallel.Result(len(batch), decoded)
+
+
+def store_frames(meta_path: pl.Path) -> None:
+    global STORE_PATH
+    STORE_PATH, index_path = fs.store_paths(ct.WORK_ROOT / meta_path)
+
+    meta = ghp.read_meta(meta_path).set_index('id', drop=False, verify_integrity=True)
+    index = _create_index(meta)
+    total = int((index['length'] * index['height'] * index['width'] * 3).sum())
+    np.memmap(STORE_PATH.as_posix(), dtype=np.uint8, mode='w+', shape=(total,)).flush()
+
+    rows = list(index.join(meta[['video_path']]).iterrows())
+    for _id, count in ghp.parallel.execute(_store_frames, rows, 1):
+        if count < index.loc[_id, 'length']:
+            env.LOGGER.warning(f'Decoded {count}/{index.loc[_id, "length"]} frames for video {_id}.')
+    index.to_json(index_path, orient='index')
+
+
+def main(dataset: str, split: int):
+    global DATA_ROOT_DIR
+    DATA_ROOT_DIR = php.get_data_root_path(dataset)
+    [train, dev, _, test] = php.get_meta_paths(dataset, split)
+
+    for path in [train, dev, test]:
+        env.LOGGER.info(f'Storing decoded frames for {path.as_posix()}...')
+        store_frames(path)
+        env.LOGGER.info('...Done')
@@ -0,0 +1,101 @@
+import glob
+import io
+import json
+import os
+import pathlib as pl
+import tarfile
+from typing import List, Tuple
+
+import cv2
+
+import constants as ct
+import databunch.meta_store as pms
+import databunch.shard_dataset as sd
+import databunch.video_meta as vm
+import env
+import helpers as ghp
+import prepro.helpers as php
+
+DATA_ROOT_DIR = None
+SHARD_DIR = None
+SHARD_SIZE = 256
+JPEG_QUALITY = 90
+
+
+def _encoded_frames(meta: vm.VideoMeta) -> List[bytes]:
+    """Extracted jpeg images are packed as they are. Otherwise the video is decoded and its frames encoded."""
+    image_path = DATA_ROOT_DIR / meta.image_path
+    if image_path.is_dir():
+        frames = []
+        for path in sorted(glob.glob(f'{glob.escape(image_path.as_posix())}/*.jpeg')):
+            with open(path, 'rb') as file:
+                frames.append(file.read())
+        return frames
+
+    frames = []
+    cap = cv2.VideoCapture((DATA_ROOT_DIR / meta.video_path).as_posix())
+    while len(frames) < meta.length:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes())
+    cap.release()
+
+    return frames
+
+
+def _add(shard: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    shard.addfile(info, io.BytesIO(data))
+
+
+def _write_shard(batch: Tuple[int, List[Tuple[int, vm.VideoMeta]]]) -> ghp.parallel.Result:
+    no, batch = batch
+
+    name = f'{no:05d}.tar'
+    tmp_path = SHARD_DIR / f'{name}.tmp'
+    decoded = []
+    with tarfile.open(tmp_path.as_posix(), mode='w') as shard:
+        for key, meta in batch:
+            key = f'{key:08d}'
+            _add(shard, sd.meta_name(key), json.dumps({field: getattr(meta, field) for field in meta.fields}).encode())
+            frames = _encoded_frames(meta)
+            decoded.append((meta.id, len(frames), meta.length))
+            # containers sometimes decode fewer frames than reported. repeat the last one to keep all locations valid.
+            frames = (frames + frames[-1:] * meta.length)[:meta.length]
+            for loc, frame in enumerate(frames):
+                _add(shard, sd.frame_name(key, loc), frame)
+    os.replace(tmp_path.as_posix(), (SHARD_DIR / name).as_posix())
+
+    return ghp.parallel.Result(len(batch), [(no, name, len(batch), decoded)])
+
+
+def write_shards(meta_path: pl.Path) -> None:
+    global SHARD_DIR
+    SHARD_DIR, index_path = sd.shard_paths(ct.WORK_ROOT / meta_path)
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+
+    meta = ghp.read_meta(meta_path)
+    store = pms.MetaStore(meta, [field for field in vm.VideoMeta.fields if field in meta.columns])
+    rows = [(key, store[key]) for key in range(len(store))]
+
+    index = []
+    for no, name, count, decoded in sorted(ghp.parallel.execute(_write_shard, rows, SHARD_SIZE)):
+        index.append({'shard': name, 'count': count})
+        for _id, frames, length in decoded:
+            if frames < length:
+                env.LOGGER.warning(f'Decoded {frames}/{length} frames for video {_id}.')
+    with open(index_path.as_posix(), 'w') as file:
+        json.dump(index, file)
+
+
+def main(dataset: str, split: int):
+    global DATA_ROOT_DIR
+    DATA_ROOT_DIR = php.get_data_root_path(dataset)
+    [train, dev, _, test] = php.get_meta_paths(dataset, split)
+
+    for path in [train, dev, test]:
+        env.LOGGER.info(f'Writing shards for {path.as_posix()}...')
+        write_shards(path)
+        env.LOGGER.info('...Done')
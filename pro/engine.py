@@ -1,31 +1,306 @@
+import contextlib
+import queue
+import threading
+import time
+
 import ignite.engine as ie
 import torch as th
-
-
-def prepare_batch(batch, device, non_blocking):
+import torch.nn.functional as func
+
+import databunch.batch_transforms as pbt
+import databunch.dataset as pds
+
+DEFAULT_TRANSFORM = pbt.BatchNormalise()
+PREFETCH_DEPTH = 2
+DATA_WAIT = 'data_wait'
+LOG_ITERATION = 'log_iteration'
+
+
+class _Raised(object):
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+class DevicePrefetcher(object):
+    """Iterates a loader while a background thread loads the next `depth` batches and copies their tensors to the
+    device, on a side stream for cuda devices. With depth 0, batches are loaded and copied on demand.
+
+    Loaders without workers may collate into reused buffers, see databunch.dataset.buffered_collate. The thread that
+    loads batches reserves a buffer for each batch that can be alive at once: the queued ones, the one being loaded
+    and the one in use. Copies from these buffers to cuda devices are waited for before the next batch is loaded.
+
+    The host time spent waiting for batches is summed in `waited`, over `count` batches of the current pass.
+    """
+
+    def __init__(self, loader, device=None, non_blocking=True, depth=PREFETCH_DEPTH):
+        self.loader = loader
+        self.device = th.device(device) if device is not None else None
+        self.non_blocking = non_blocking
+        self.depth = depth
+        self.waited = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, batch, stream):
+        if self.device is None:
+            return batch, None
+        non_blocking = self.non_blocking and stream is not None
+        with th.cuda.stream(stream):
+            tensors = [ie.convert_tensor(data, device=self.device, non_blocking=non_blocking) for data in batch[:3]]
+        event = None
+        if stream is not None:
+            event = th.cuda.Event()
+            event.record(stream)
+            # the host buffers of the batch may be collated into again once the copy is done.
+            event.synchronize()
+
+        return (*tensors, *batch[3:]), event
+
+    @staticmethod
+    def _put(out, item, stop) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _produce(self, out, stop):
+        pds.reserve_buffers(self.depth + 2)
+        stream = None
+        if self.device is not None and self.device.type == 'cuda':
+            stream = th.cuda.Stream(self.device)
+        try:
+            for batch in self.loader:
+                if not self._put(out, self._stage(batch, stream), stop):
+                    return
+            self._put(out, None, stop)
+        except Exception as exception:
+            self._put(out, _Raised(exception), stop)
+
+    def _on_demand(self):
+        pds.reserve_buffers(2)
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch, _ = self._stage(next(iterator), None)
+            except StopIteration:
+                return
+            self.waited += time.perf_counter() - start
+            self.count += 1
+            yield batch
+
+    def __iter__(self):
+        self.waited, self.count = 0.0, 0
+        if self.depth == 0:
+            yield from self._on_demand()
+            return
+
+        out, stop = queue.Queue(maxsize=self.depth), threading.Event()
+        producer = threading.Thread(target=self._produce, args=(out, stop), name='prefetcher', daemon=True)
+        producer.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                staged = out.get()
+                if staged is None:
+                    return
+                if isinstance(staged, _Raised):
+                    raise staged.exception
+                batch, event = staged
+                if event is not None:
+                    # make the compute stream wait for the copy, and keep the copied memory alive until it is used.
+                    current = th.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for data in batch[:3]:
+                        data.record_stream(current)
+                self.waited += time.perf_counter() - start
+                self.count += 1
+                yield batch
+        finally:
+            # a pass left early closes the loader iterator in the background thread before the next pass starts.
+            stop.set()
+            producer.join()
+
+
+class PrefetchEngine(ie.Engine):
+    """Engine that runs on a DevicePrefetcher over its data and reports the mean wait per batch of the current epoch,
+    in seconds, as the `data_wait` metric.
+
+    Every `log_every` iterations of an epoch and on its last iteration, the engine fires LOG_ITERATION after the
+    ITERATION_COMPLETED handlers attached before the run. Handlers that copy values to the host, such as
+    metrics.custom.RunningAverage and the loggers, run on it instead of on every iteration.
+    """
+
+    def __init__(self, process_function, device=None, non_blocking=True, depth=PREFETCH_DEPTH, log_every=1):
+        super(PrefetchEngine, self).__init__(process_function)
+        self.device = device
+        self.non_blocking = non_blocking
+        self.depth = depth
+        self.log_every = log_every
+        self.prefetcher = None
+        self.register_events(LOG_ITERATION)
+        self.add_event_handler(ie.Events.EPOCH_STARTED, self._reset_epoch_iteration)
+        self.add_event_handler(ie.Events.ITERATION_COMPLETED, self._record_data_wait)
+
+    def run(self, data, max_epochs=1):
+        self.prefetcher = DevicePrefetcher(data, self.device, self.non_blocking, self.depth)
+        # added on the first run, after the metrics, so that they are up to date when LOG_ITERATION fires.
+        if not self.has_event_handler(self._log_iteration, ie.Events.ITERATION_COMPLETED):
+            self.add_event_handler(ie.Events.ITERATION_COMPLETED, self._log_iteration)
+
+        return super(PrefetchEngine, self).run(self.prefetcher, max_epochs)
+
+    @staticmethod
+    def _reset_epoch_iteration(_engine: ie.Engine) -> None:
+        _engine.state.epoch_iteration = 0
+
+    def _log_iteration(self, _engine: ie.Engine) -> None:
+        _engine.state.epoch_iteration += 1
+        if _engine.state.epoch_iteration % self.log_every == 0 or _engine.state.epoch_iteration == len(self.prefetcher):
+            _engine.fire_event(LOG_ITERATION)
+
+    def _record_data_wait(self, _engine: ie.Engine) -> None:
+        _engine.state.metrics[DATA_WAIT] = self.prefetcher.waited / max(self.prefetcher.count, 1)
+
+
+class MixedPrecision(object):
+    """Autocast and gradient scaling of a trainer's update, opt-in. Autocast runs in float16 on cuda and bfloat16 on
+    cpu unless a dtype is given. Only float16 losses are scaled, since bfloat16 has the range of float32. Needs
+    torch>=1.10. Disabled, the update runs in float32 as before."""
+
+    def __init__(self, device=None, enabled=False, dtype=None):
+        self.device_type = th.device(device).type if device is not None else 'cpu'
+        self.enabled = enabled
+        if enabled:
+            assert hasattr(th, 'autocast'), 'Mixed precision needs torch>=1.10.'
+        default = th.float16 if self.device_type == 'cuda' else th.bfloat16
+        self.dtype = getattr(th, dtype) if dtype is not None else default
+        self.scaler = None
+        if enabled and self.dtype == th.float16:
+            self.scaler = th.cuda.amp.GradScaler()
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.suppress()
+
+        return th.autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss: th.Tensor) -> None:
+        if self.scaler is None:
+            loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
+    def step(self, optimizer: th.optim.Optimizer) -> None:
+        if self.scaler is None:
+            optimizer.step()
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self) -> dict:
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state: dict) -> None:
+        if self.scaler is not None and state:
+            self.scaler.load_state_dict(state)
+
+
+def prepare_batch(batch, device, non_blocking, transform=None):
     input_data, class_target_data, recon_target_data, _ = batch
     input_data = ie.convert_tensor(input_data, device=device, non_blocking=non_blocking)
     class_target_data = ie.convert_tensor(class_target_data, device=device, non_blocking=non_blocking)
     recon_target_data = ie.convert_tensor(recon_target_data, device=device, non_blocking=non_blocking)
 
+    transform = DEFAULT_TRANSFORM if transform is None else transform
+    input_data, class_target_data, recon_target_data = transform(input_data, class_target_data, recon_target_data)
+
     return input_data, class_target_data, recon_target_data
 
 
-def create_cls_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def micro_batches(batch, steps: int):
+    """Split a loaded batch into at most `steps` micro-batches along the batch dimension. Yields each micro-batch with
+    its share of the batch, which weighs its loss. The batch is split after it is loaded and copied to the device, so
+    only activation memory is saved."""
+    input_data, class_target_data, recon_target_data, metas = batch
+    b = input_data.shape[0]
+    size = -(-b // steps)
+    for start in range(0, b, size):
+        end = min(start + size, b)
+        recon = recon_target_data[start:end] if recon_target_data.numel() else recon_target_data
+        yield (input_data[start:end], class_target_data[start:end], recon, metas[start:end]), (end - start) / b
+
+
+def accumulate(model, optimizer, amp, forward, batch, steps: int = 1):
+    """One optimizer step over a batch, run as `steps` micro-batches whose weighted gradients are accumulated.
+
+    `forward` maps a micro-batch to its loss and the engine output. Outputs are merged into the output of the whole
+    batch: batched tensors are concatenated along the batch dimension, and numbers and scalar tensors are averaged with
+    the micro-batch shares.
+    Distributed models only synchronise gradients on the last backward pass. Batch norm layers see micro-batches, so
+    their statistics differ from those of the whole batch.
+    """
+    optimizer.zero_grad()
+    micro = list(micro_batches(batch, steps)) if steps > 1 else [(batch, 1.0)]
+    outputs, shares = [], []
+    for i, (micro_batch, share) in enumerate(micro):
+        sync = i == len(micro) - 1 or not hasattr(model, 'no_sync')
+        with contextlib.suppress() if sync else model.no_sync():
+            with amp.autocast():
+                loss, output = forward(micro_batch)
+            amp.backward(loss * share if share != 1.0 else loss)
+        outputs.append(output)
+        shares.append(share)
+    amp.step(optimizer)
+
+    if len(outputs) == 1:
+        return outputs[0]
+
+    return tuple(th.cat(values, dim=0) if isinstance(values[0], th.Tensor) and values[0].dim() else
+                 sum(value * share for value, share in zip(values, shares)) for values in zip(*outputs))
+
+
+def fold_views(_in: th.Tensor, views: int) -> th.Tensor:
+    """(B, views * T, ...) batches of multi-view videos to (B * views, T, ...)."""
+    b, vt = _in.shape[0:2]
+
+    return _in.reshape(b * views, vt // views, *_in.shape[2:])
+
+
+def mean_views(_out: th.Tensor, views: int) -> th.Tensor:
+    return _out.reshape(-1, views, *_out.shape[1:]).mean(dim=1)
+
+
+def average_views(y_pred: th.Tensor, views: int) -> th.Tensor:
+    """Average the class probabilities of the views of each video. Returns log probabilities, which the metrics can
+    take in place of logits."""
+    return mean_views(func.softmax(y_pred, dim=-1), views).clamp(min=1e-12).log()
+
+
+def create_cls_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True,
+                       transform=None, prefetch=PREFETCH_DEPTH, amp=None, accumulation_steps=1,
+                       log_every=1) -> ie.Engine:
+    amp = MixedPrecision(device) if amp is None else amp
     if device:
         model.to(device)
 
-    def _update(_engine, batch):
-        model.train()
-        optimizer.zero_grad()
-        _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking)
+    def _forward(batch):
+        _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
         y_pred, temporal_embeds, class_embed = model(_in)
         loss = crt(y_pred, _cls_gt)
-        loss.backward()
-        optimizer.step()
-        return loss.item(), y_pred.detach(), _cls_gt.detach()
+        return loss, (loss.detach(), y_pred.detach(), _cls_gt.detach())
+
+    def _update(_engine, batch):
+        model.train()
+        return accumulate(model, optimizer, amp, _forward, batch, accumulation_steps)
 
-    _engine = ie.Engine(_update)
+    _engine = PrefetchEngine(_update, device, non_blocking, prefetch, log_every)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -33,18 +308,22 @@ def create_cls_trainer(model, optimizer, crt, metrics=None, device=th.device('cp
     return _engine
 
 
-def create_cls_evaluator(model, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def create_cls_evaluator(model, metrics=None, device=th.device('cpu'), non_blocking=True,
+                         transform=None, prefetch=PREFETCH_DEPTH, views=1) -> ie.Engine:
     if device:
         model.to(device)
 
     def _inference(_engine, batch):
         model.eval()
         with th.no_grad():
-            _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking)
-            y_pred, temporal_embeds, class_embed = model(_in)
+            _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
+            y_pred, temporal_embeds, class_embed = model(fold_views(_in, views) if views > 1 else _in)
+            if views > 1:
+                y_pred = average_views(y_pred, views)
+                temporal_embeds, class_embed = mean_views(temporal_embeds, views), mean_views(class_embed, views)
             return y_pred, _cls_gt, temporal_embeds, class_embed
 
-    _engine = ie.Engine(_inference)
+    _engine = PrefetchEngine(_inference, device, non_blocking, prefetch)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -52,34 +331,35 @@ def create_cls_evaluator(model, metrics=None, device=th.device('cpu'), non_block
     return _engine
 
 
-def create_ae_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def create_ae_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True,
+                      transform=None, prefetch=PREFETCH_DEPTH, amp=None, accumulation_steps=1,
+                      log_every=1) -> ie.Engine:
+    amp = MixedPrecision(device) if amp is None else amp
     if device:
         model.to(device)
 
-    def _update(_engine, batch):
-        model.train()
-        optimizer.zero_grad()
-        _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking)
+    def _forward(batch):
+        _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
 
         _recon_pred, _cls_pred, _temporal_embeds, _class_embed = model(_in)
-
         ce, l1 = crt(_recon_pred, _cls_pred, _recon_gt, _cls_gt)
-        (ce + l1).backward()
-
-        optimizer.step()
 
-        return (
+        return ce + l1, (
             _recon_pred.detach(),
             _cls_pred.detach(),
             _temporal_embeds.detach(),
             _class_embed.detach(),
             _in.detach(),
             _cls_gt.detach(),
-            ce.item(),
-            l1.item()
+            ce.detach(),
+            l1.detach()
         )
 
-    _engine = ie.Engine(_update)
+    def _update(_engine, batch):
+        model.train()
+        return accumulate(model, optimizer, amp, _forward, batch, accumulation_steps)
+
+    _engine = PrefetchEngine(_update, device, non_blocking, prefetch, log_every)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -87,18 +367,20 @@ def create_ae_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu
     return _engine
 
 
-def create_ae_evaluator(model, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def create_ae_evaluator(model, metrics=None, device=th.device('cpu'), non_blocking=True,
+                        transform=None, prefetch=PREFETCH_DEPTH) -> ie.Engine:
     if device:
         model.to(device)
 
     def _inference(_engine, batch):
         model.eval()
         with th.no_grad():
-            _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking)
+            _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking,
+                                                    transform=transform)
             _recon_pred, _cls_pred, _temporal_embeds, _class_embed = model(_in)
             return _recon_pred, _cls_pred, _temporal_embeds, _class_embed, _recon_gt, _cls_gt
 
-    _engine = ie.Engine(_inference)
+    _engine = PrefetchEngine(_inference, device, non_blocking, prefetch)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -106,21 +388,19 @@ def create_ae_evaluator(model, metrics=None, device=th.device('cpu'), non_blocki
     return _engine
 
 
-def create_gsnn_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def create_gsnn_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True,
+                        transform=None, prefetch=PREFETCH_DEPTH, amp=None, accumulation_steps=1,
+                        log_every=1) -> ie.Engine:
+    amp = MixedPrecision(device) if amp is None else amp
     if device:
         model.to(device)
 
-    def _update(_engine, batch):
-        model.train()
-        optimizer.zero_grad()
-        _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking)
+    def _forward(batch):
+        _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
         _cls_pred, _temporal_latents, _class_latent, _mean, _var, _ = model(_in, num_samples=1)
         ce, kld = crt(_cls_pred, _cls_gt, _mean, _var)
 
-        (ce + crt.kld_factor * kld).backward()
-        optimizer.step()
-
-        return (
+        return ce + crt.kld_factor * kld, (
             _cls_pred.detach(),
             _temporal_latents.detach(),
             _class_latent.detach(),
@@ -128,12 +408,16 @@ def create_gsnn_trainer(model, optimizer, crt, metrics=None, device=th.device('c
             _var.detach(),
             _in.detach(),
             _cls_gt.detach(),
-            ce.item(),
-            kld.item(),
+            ce.detach(),
+            kld.detach(),
             crt.kld_factor
         )
 
-    _engine = ie.Engine(_update)
+    def _update(_engine, batch):
+        model.train()
+        return accumulate(model, optimizer, amp, _forward, batch, accumulation_steps)
+
+    _engine = PrefetchEngine(_update, device, non_blocking, prefetch, log_every)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -141,18 +425,19 @@ def create_gsnn_trainer(model, optimizer, crt, metrics=None, device=th.device('c
     return _engine
 
 
-def create_gsnn_evaluator(model, metrics=None, device=None, num_samples: int = None, non_blocking=True) -> ie.Engine:
+def create_gsnn_evaluator(model, metrics=None, device=None, num_samples: int = None, non_blocking=True,
+                          transform=None, prefetch=PREFETCH_DEPTH) -> ie.Engine:
     if device:
         model.to(device)
 
     def _inference(_engine, batch):
         model.eval()
         with th.no_grad():
-            _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking)
+            _in, _cls_gt, _ = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
             _cls_pred, _temp_lat, _cls_lat, _mean, _var, _vote = model(_in, num_samples=num_samples)
             return _cls_pred, _temp_lat, _cls_lat, _mean, _var, _in, _cls_gt, _vote
 
-    _engine = ie.Engine(_inference)
+    _engine = PrefetchEngine(_inference, device, non_blocking, prefetch)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -160,21 +445,19 @@ def create_gsnn_evaluator(model, metrics=None, device=None, num_samples: int = N
     return _engine
 
 
-def create_vae_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True) -> ie.Engine:
+def create_vae_trainer(model, optimizer, crt, metrics=None, device=th.device('cpu'), non_blocking=True,
+                       transform=None, prefetch=PREFETCH_DEPTH, amp=None, accumulation_steps=1,
+                       log_every=1) -> ie.Engine:
+    amp = MixedPrecision(device) if amp is None else amp
     if device:
         model.to(device)
 
-    def _update(_engine, batch):
-        model.train()
-        optimizer.zero_grad()
-        _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking)
+    def _forward(batch):
+        _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking, transform=transform)
         _recon_pred, _cls_pred, _temporal_latents, _class_latent, _mean, _var, _ = model(_in, num_samples=1)
         ce, l1, kld = crt(_recon_pred, _cls_pred, _recon_gt, _cls_gt, _mean, _var)
 
-        (ce + l1 + crt.kld_factor * kld).backward()
-        optimizer.step()
-
-        return (
+        return ce + l1 + crt.kld_factor * kld, (
             _recon_pred.detach(),
             _cls_pred.detach(),
             _temporal_latents.detach(),
@@ -183,13 +466,17 @@ def create_vae_trainer(model, optimizer, crt, metrics=None, device=th.device('cp
             _var.detach(),
             _in.detach(),
             _cls_gt.detach(),
-            ce.item(),
-            l1.item(),
-            kld.item(),
+            ce.detach(),
+            l1.detach(),
+            kld.detach(),
             crt.kld_factor
         )
 
-    _engine = ie.Engine(_update)
+    def _update(_engine, batch):
+        model.train()
+        return accumulate(model, optimizer, amp, _forward, batch, accumulation_steps)
+
+    _engine = PrefetchEngine(_update, device, non_blocking, prefetch, log_every)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
@@ -197,18 +484,20 @@ def create_vae_trainer(model, optimizer, crt, metrics=None, device=th.device('cp
     return _engine
 
 
-def create_vae_evaluator(model, metrics=None, device=None, num_samples: int = None, non_blocking=True) -> ie.Engine:
+def create_vae_evaluator(model, metrics=None, device=None, num_samples: int = None, non_blocking=True,
+                         transform=None, prefetch=PREFETCH_DEPTH) -> ie.Engine:
     if device:
         model.to(device)
 
     def _inference(_engine, batch):
         model.eval()
         with th.no_grad():
-            _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking)
+            _in, _cls_gt, _recon_gt = prepare_batch(batch, device=device, non_blocking=non_blocking,
+                                                    transform=transform)
             _recon_pred, _cls_pred, _temp_lat, _cls_lat, _mean, _var, _vote = model(_in, num_samples=num_samples)
             return _recon_pred, _cls_pred, _temp_lat, _cls_lat, _mean, _var, _in, _cls_gt, _vote
 
-    _engine = ie.Engine(_inference)
+    _engine = PrefetchEngine(_inference, device, non_blocking, prefetch)
     if metrics is not None:
         for name, metric in metrics.items():
             metric.attach(_engine, name)
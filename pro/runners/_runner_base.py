@@ -4,6 +4,7 @@ import dataclasses as dc
 import glob
 import json
 import pathlib as pth
+import threading
 import typing as typ
 
 import ignite.engine as ie
@@ -18,10 +19,25 @@ import constants as ct
 import databunch.databunch as db
 import helpers as ghp
 import logger as pl
+import models.helpers as mh
+import pro.engine as pe
 import options.experiment_options as eo
 import specs.maps as sm
 
 
+class _StateSnapshot(object):
+    """Copy of the state dict of an object, taken when an overlapped dev evaluation starts."""
+
+    def __init__(self):
+        self.state = None
+
+    def update(self, obj: typ.Any) -> None:
+        self.state = copy.deepcopy(obj.state_dict())
+
+    def state_dict(self) -> typ.Optional[dict]:
+        return self.state
+
+
 class BaseRunner(abc.ABC):
     class _Decorator:
         @staticmethod
@@ -63,6 +79,17 @@ class BaseRunner(abc.ABC):
         self.criterion = self._init_criterion()
         self.optimizer = self._init_optimizer()
         self.lr_scheduler = self._init_lr_scheduler()
+        self.amp = self._init_amp()
+        self.eval_model = self._init_eval_model()
+        self.eval_state = {}
+        self.eval_thread = None
+        self.eval_error = None
+        self.eval_stream = None
+        if self.opts.trainer.overlap_eval and cuda.is_available():
+            self.eval_stream = cuda.Stream(self.device)
+        self.optimizer_snapshot = _StateSnapshot()
+        self.lr_scheduler_snapshot = _StateSnapshot()
+        self.amp_snapshot = _StateSnapshot()
 
         self.logger = pl.ExperimentLogger(
             self.opts,
@@ -153,6 +180,9 @@ class BaseRunner(abc.ABC):
         opts = dc.asdict(copy.deepcopy(self.opts.model.opts))
         del opts['batch_size']
         model = sm.Models[self.opts.model.arch].value(**opts).to(self.device)
+        if self.opts.trainer.grad_checkpoint:
+            checkpointed = mh.set_grad_checkpoint(model, True)
+            assert checkpointed, f'Model {self.opts.model.arch} has no blocks that support activation checkpointing.'
 
         if self.opts.resume:
             latest_models = list(glob.glob(str(ct.WORK_ROOT / self.opts.run_dir / 'ckpt' / 'latest_model_*.pth')))
@@ -205,6 +235,28 @@ class BaseRunner(abc.ABC):
 
         return lr_scheduler
 
+    @_Decorator.sync
+    def _init_amp(self) -> pe.MixedPrecision:
+        amp = pe.MixedPrecision(self.device, self.opts.trainer.amp, self.opts.trainer.amp_dtype)
+
+        if self.opts.resume:
+            # runs started without mixed precision have no scaler checkpoint.
+            amp_paths = glob.glob(str(ct.WORK_ROOT / self.opts.run_dir / 'ckpt' / 'latest_amp_*'))
+            if amp_paths:
+                print(f'Loading gradient scaler from {amp_paths[-1]}...')
+                amp.load_state_dict(th.load(amp_paths[-1], map_location=self.device))
+
+        return amp
+
+    @_Decorator.sync
+    def _init_eval_model(self) -> nn.Module:
+        """Overlapped dev evaluation runs on a copy of the model, refreshed with the trained weights every epoch."""
+        if not self.opts.trainer.overlap_eval:
+            return self.model
+        assert not self.distributed, 'Overlapped evaluation is not supported in distributed runs.'
+
+        return copy.deepcopy(self.model)
+
     @_Decorator.sync
     @abc.abstractmethod
     def _init_engines(self) -> typ.Tuple[ie.Engine, ie.Engine]:
@@ -219,15 +271,15 @@ class BaseRunner(abc.ABC):
     def _init_events(self) -> None:
         """Initialize the handlers of engine events. All file handling in done only in the main process. """
         self.trainer.add_event_handler(ie.Events.STARTED, self._resume_trainer_state)
-        self.trainer.add_event_handler(ie.Events.EPOCH_STARTED, self._set_distributed_sampler_seed)
-        self.trainer.add_event_handler(ie.Events.ITERATION_COMPLETED, self._aggregate_metrics)
-        self.logger.attach_pbar(self.trainer)  # ON ITERATION_COMPLETED
-        self.logger.init_handlers(self.trainer, self.evaluator, self.model, self.optimizer)  # ON EPOCH_COMPLETED
+        self.trainer.add_event_handler(ie.Events.EPOCH_STARTED, self._set_sampler_epoch)
+        self.trainer.add_event_handler(pe.LOG_ITERATION, self._aggregate_metrics)
+        self.logger.attach_pbar(self.trainer)  # ON LOG_ITERATION
+        self.logger.init_handlers(self.trainer, self.evaluator, self.model, self.optimizer,
+                                  self._dev_step)  # ON LOG_ITERATION AND EPOCH_COMPLETED
         self.trainer.add_event_handler(ie.Events.EPOCH_COMPLETED, self._evaluate)
         self.trainer.add_event_handler(ie.Events.COMPLETED, self._end_run)
         self.trainer.add_event_handler(ie.Events.EXCEPTION_RAISED, self._graceful_shutdown)
 
-        self.evaluator.add_event_handler(ie.Events.ITERATION_COMPLETED, self._aggregate_metrics)
         self.evaluator.add_event_handler(ie.Events.EPOCH_COMPLETED, self.logger.log_dev_metrics)
 
         # only main process returns checkpoint handlers
@@ -238,7 +290,9 @@ class BaseRunner(abc.ABC):
             self.evaluator.add_event_handler(ie.Events.COMPLETED, best_ckpt_handler, ckpt_args)
             self.evaluator.add_event_handler(ie.Events.COMPLETED, self._save_trainer_state)
 
-        self.evaluator.add_event_handler(ie.Events.EXCEPTION_RAISED, self._graceful_shutdown)
+        # overlapped evaluation errors are raised again in the trainer, which shuts down.
+        if not self.opts.trainer.overlap_eval:
+            self.evaluator.add_event_handler(ie.Events.EXCEPTION_RAISED, self._graceful_shutdown)
         self._init_runner_specific_handlers()
 
     @_Decorator.sync
@@ -249,8 +303,16 @@ class BaseRunner(abc.ABC):
         ckpt_args = {
             'model': self.model.module if hasattr(self.model, 'module') else self.model,  # noqa
             'optimizer': self.optimizer,
-            'lr_scheduler': self.lr_scheduler
+            'lr_scheduler': self.lr_scheduler,
+            'amp': self.amp
         }
+        if self.opts.trainer.overlap_eval:
+            ckpt_args = {
+                'model': self.eval_model,
+                'optimizer': self.optimizer_snapshot,
+                'lr_scheduler': self.lr_scheduler_snapshot,
+                'amp': self.amp_snapshot
+            }
         score_fn = self._neg_dev_total_loss if self.opts.debug else self._dev_acc_1
         best_ckpt = ih.ModelCheckpoint(dirname=ckpt_dir.as_posix(), filename_prefix='best',
                                        n_saved=1, require_empty=require_empty,
@@ -270,11 +332,7 @@ class BaseRunner(abc.ABC):
 
     def _save_trainer_state(self, _engine: ie.Engine):
         with open((ct.WORK_ROOT / self.opts.run_dir / 'ckpt' / 'trainer_state.json').as_posix(), 'w') as file:
-            state = {
-                'iteration': self.trainer.state.iteration,
-                'epoch': self.trainer.state.epoch,
-            }
-            json.dump(state, file, indent=True)
+            json.dump(self.eval_state, file, indent=True)
 
     def _resume_trainer_state(self, _: ie.Engine) -> None:
         if self.opts.resume:
@@ -284,12 +342,15 @@ class BaseRunner(abc.ABC):
                 state = json.load(file)
                 self.trainer.state.iteration = state['iteration']
                 self.trainer.state.epoch = state['epoch']
+                if 'sampler' in state:
+                    self.data_bunch.train_set.sampler.load_state_dict(state['sampler'])
 
-    def _set_distributed_sampler_seed(self, _engine: ie.Engine) -> None:
-        if self.distributed:
-            self.data_bunch.train_sampler.set_epoch(_engine.state.epoch)
+    def _set_sampler_epoch(self, _engine: ie.Engine) -> None:
+        self.data_bunch.set_epoch(_engine.state.epoch)
 
     def _end_run(self, _: ie.Engine):
+        self._wait_evaluation()
+        self.data_bunch.close()
         if self.local_rank != -1 and dist.is_initialized():
             dist.barrier()
         self.logger.close()
@@ -302,9 +363,50 @@ class BaseRunner(abc.ABC):
         raise exception
 
     def _evaluate(self, _engine: ie.Engine) -> None:
-        self.evaluator.run(self.data_bunch.dev_loader)
+        self._wait_evaluation()
+        self.eval_state = {
+            'iteration': self.trainer.state.iteration,
+            'epoch': self.trainer.state.epoch,
+            'sampler': self.data_bunch.train_set.sampler.state_dict(),
+        }
+        if not self.opts.trainer.overlap_eval:
+            self.evaluator.run(self.data_bunch.dev_loader)
+            return
+
+        self.eval_model.load_state_dict(self.model.state_dict())
+        self.optimizer_snapshot.update(self.optimizer)
+        self.lr_scheduler_snapshot.update(self.lr_scheduler)
+        self.amp_snapshot.update(self.amp)
+        self.eval_thread = threading.Thread(target=self._evaluate_snapshot, name='evaluator', daemon=True)
+        self.eval_thread.start()
+
+    def _evaluate_snapshot(self) -> None:
+        """Dev evaluation of the weight snapshot, on a side stream while the next train epoch runs."""
+        try:
+            if self.eval_stream is not None:
+                self.eval_stream.wait_stream(cuda.default_stream(self.device))
+            with cuda.stream(self.eval_stream):
+                self.evaluator.run(self.data_bunch.dev_loader)
+            if self.eval_stream is not None:
+                self.eval_stream.synchronize()
+        except Exception as exception:
+            self.eval_error = exception
+
+    def _wait_evaluation(self) -> None:
+        if self.eval_thread is None or self.eval_thread is threading.current_thread():
+            return
+        self.eval_thread.join()
+        self.eval_thread = None
+        if self.eval_error is not None:
+            error, self.eval_error = self.eval_error, None
+            raise error
+
+    def _dev_step(self, _engine: ie.Engine, _event_name: str) -> int:
+        return self.eval_state['epoch']
 
     def _aggregate_metrics(self, _engine: ie.Engine) -> None:
+        """Average the running metrics of the trainer over processes, at log points only. Running averages over batches
+        of the same size average like the batch values. Evaluation metrics reduce their own sums and counts."""
         local_names, global_names, values = [], [], []
         for key, value in _engine.state.metrics.items():
             local_names.append(key)
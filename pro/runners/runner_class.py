@@ -21,10 +21,17 @@ class ClassRunner(_base.BaseRunner):
                                         self.optimizer,
                                         self.criterion,
                                         trainer_metrics,
-                                        self.device)
-        evaluator = pe.create_cls_evaluator(self.model,
+                                        self.device,
+                                        transform=self.data_bunch.train_transform,
+                                        prefetch=self.opts.trainer.prefetch,
+                                        amp=self.amp,
+                                        accumulation_steps=self.opts.trainer.accumulation_steps,
+                                        log_every=self.opts.trainer.log_every)
+        evaluator = pe.create_cls_evaluator(self.eval_model,
                                             evaluator_metrics,
-                                            self.device)
+                                            self.device,
+                                            transform=self.data_bunch.dev_transform,
+                                            prefetch=self.opts.evaluator.prefetch)
 
         return trainer, evaluator
 
@@ -1,7 +1,41 @@
+import json
+import os
+import pickle
+import time
+import types
+
+import cv2
+import imgaug.augmenters as ia
+import numpy as np
+import pandas as pd
 import pytest
+import torch as th
+import torch.utils.data as thd
+import torchvision.transforms.functional as tv_func
 import tqdm
 
+import databunch.batch_transforms as bt
+import databunch.bucket_sampler as bs
 import databunch.databunch as db
+import databunch.dataset as ds
+import databunch.flow_cache as fc
+import databunch.frame_cache as frc
+import databunch.frame_store as fs
+import databunch.jpeg_index as ji
+import databunch.meta_store as ms
+import databunch.persistent_loader as pl
+import databunch.segment_sampler as ss
+import databunch.shard_dataset as sd
+import databunch.video as dv
+import databunch.video_meta as vm
+import helpers as hp
+import models.common as mc
+import options.data_options as do
+import pro.engine as pe
+import prepro.common._augment_meta as pam
+import prepro.common._extract_jpeg as pej
+import prepro.common._store_frames as psf
+import prepro.common._write_shards as pws
 import specs
 
 HMDB_DBO = [
@@ -19,6 +53,54 @@ SMTH_DBO = [
 ]
 
 
+
+@pytest.fixture
+def video_meta():
+    """Build the meta of `num` videos with every VideoMeta field. Keyword arguments replace whole columns."""
+
+    def _video_meta(num: int, **columns) -> pd.DataFrame:
+        meta = pd.DataFrame({'id': list(range(num)), 'framerate': 12, 'length': 8, 'height': 48, 'width': 64,
+                             'label': [['a', 'b'][i % 2] for i in range(num)], 'lid': [i % 2 for i in range(num)],
+                             'video_path': [f'v/{i}.avi' for i in range(num)],
+                             'image_path': [f'i/{i}' for i in range(num)]})
+        for name, column in columns.items():
+            meta[name] = column
+
+        return meta
+
+    return _video_meta
+
+
+@pytest.fixture
+def write_video(tmp_path):
+    """Write an MJPG video under tmp_path whose frame at location `loc` has all pixels set to `step * loc`."""
+
+    def _write_video(path: str, length: int, size=(64, 48), fps: int = 12, step: int = 10):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        writer = cv2.VideoWriter((tmp_path / path).as_posix(), cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+        for loc in range(length):
+            writer.write(np.full((size[1], size[0], 3), step * loc, np.uint8))
+        writer.release()
+
+        return tmp_path / path
+
+    return _write_video
+
+
+@pytest.fixture
+def write_jpegs(tmp_path):
+    """Extract `length` frames of each video in `meta` as jpegs under tmp_path, in the same way as write_video."""
+
+    def _write_jpegs(meta: pd.DataFrame, length: int, size=(64, 48), step: int = 10):
+        for image_path in meta['image_path']:
+            (tmp_path / image_path).mkdir(parents=True)
+            for loc in range(length):
+                frame = np.full((size[1], size[0], 3), step * loc, np.uint8)
+                cv2.imwrite((tmp_path / image_path / f'{loc + 1:04d}.jpeg').as_posix(), frame)
+
+    return _write_jpegs
+
+
 @pytest.mark.parametrize('dbo', HMDB_DBO + SMTH_DBO)
 def test_databunch(dbo):
     dbo.dlo.timeout = 0
@@ -46,3 +128,426 @@ def test_databunch(dbo):
         pbar.close()
 
     tqdm.tqdm.write('')
+
+
+def test_frame_store(tmp_path):
+    meta = pd.DataFrame({'length': [3, 5], 'height': [4, 2], 'width': [2, 3]}, index=['a', 'b'])
+    index = psf._create_index(meta)
+    data_path, index_path = fs.store_paths(tmp_path / 'meta.train.json')
+    clips = [np.random.randint(0, 255, (row.length, row.height, row.width, 3), dtype=np.uint8)
+             for row in index.itertuples()]
+    np.concatenate([clip.reshape(-1) for clip in clips]).tofile(data_path.as_posix())
+    index.to_json(index_path, orient='index')
+
+    store = fs.FrameStore(tmp_path / 'meta.train.json')
+    locs = np.array([0, 2, 2, 4])
+    assert len(store) == 2 and 'b' in store
+    assert np.array_equal(np.stack(store.read('b', locs)), clips[1][locs])
+    assert np.array_equal(np.stack(store.read('a', locs[:2])), clips[0][locs[:2]])
+
+
+def test_jpeg_index(tmp_path, video_meta, write_jpegs):
+    assert ji._infer_pattern(['0002.jpeg', '0001.jpeg', '0003.jpeg']) == ('%04d.jpeg', 1, 3)
+    assert ji._infer_pattern(['9.jpeg', '10.jpeg']) == ('%d.jpeg', 9, 2)
+    assert ji._infer_pattern(['0001.jpeg', '0003.jpeg'])[0] is None
+
+    meta = video_meta(2, id=[1, 2], image_path=['jpeg/1', 'jpeg/2'])
+    write_jpegs(meta.iloc[:1], 5)
+    write_jpegs(meta.iloc[1:], 3)
+    (tmp_path / 'meta.train.json').touch()
+
+    index = ji.JpegIndex(meta, tmp_path, tmp_path / 'meta.train.json')
+    paths = index.paths(2, tmp_path / 'jpeg' / '2', np.array([0, 2]))
+    assert paths == [(tmp_path / 'jpeg' / '2' / name).as_posix() for name in ['0001.jpeg', '0003.jpeg']]
+    assert ji.index_path(tmp_path / 'meta.train.json').exists()
+
+    reloaded = ji.JpegIndex(meta, tmp_path / 'missing', tmp_path / 'meta.train.json')
+    paths = reloaded.paths(1, tmp_path / 'jpeg' / '1', np.array([4]))
+    assert paths == [(tmp_path / 'jpeg' / '1' / '0005.jpeg').as_posix()]
+
+
+def test_batch_augment():
+    frames = th.rand(2, 4, 3, 32, 32)
+    assert th.allclose(bt.hsv_to_rgb(bt.rgb_to_hsv(frames)), frames, atol=1e-5)
+
+    image = np.random.randint(0, 255, (32, 32, 3), dtype=np.uint8)
+    expected = ia.AddToHueAndSaturation(25)(image=image).astype(np.float32) / 255
+    _in = th.from_numpy(image).permute(2, 0, 1).float().div(255).reshape(1, 1, 3, 32, 32)
+    _out, _, recon = bt.BatchAugment(0.0, 0.0, (0, 0), (25, 25))(_in, th.zeros(1), th.empty(0))
+    assert np.abs(_out[0, 0].permute(1, 2, 0).numpy() - expected).mean() < 0.01
+    assert recon.shape == (1, 1, 3, 56, 56)
+
+    _out, _, _ = bt.BatchAugment(1.0, 0.0, (0, 0), (0, 0))(frames, th.zeros(2), th.empty(0))
+    assert th.allclose(_out, frames.flip(dims=[-1]), atol=1e-5)
+
+
+def test_buffered_collate():
+    batch = []
+    for _ in range(3):
+        data = [np.random.randint(0, 255, (8, 6, 3), dtype=np.uint8) for _ in range(4)]
+        recon = [np.random.randint(0, 255, (4, 3, 3), dtype=np.uint8) for _ in range(4)]
+        batch.append((types.SimpleNamespace(data=data, recon=recon), types.SimpleNamespace(data=1), None))
+    buffered = ds.buffered_collate(batch)
+    for video, *_ in batch:
+        video.data = [tv_func.to_tensor(frame) for frame in video.data]
+        video.recon = [tv_func.to_tensor(frame) for frame in video.recon]
+    stacked = ds.collate(batch)
+
+    assert buffered[0].dtype == th.uint8 and buffered[0].shape == (3, 4, 3, 8, 6)
+    _in, _, _recon = pe.prepare_batch(buffered, th.device('cpu'), False)
+    assert th.allclose(_in, stacked[0]) and th.allclose(_recon, stacked[2])
+
+
+def test_buffer_ring():
+    class Frames(thd.Dataset):
+        def __getitem__(self, item):
+            video = types.SimpleNamespace(data=[np.full((8, 6, 3), item, dtype=np.uint8)] * 4, recon=[])
+            return video, types.SimpleNamespace(data=item), None
+
+        def __len__(self):
+            return 24
+
+    def check(_engine, batch):
+        # give the loading thread time to fill the queue, which must not overwrite the batch in use.
+        time.sleep(0.01)
+        assert th.equal(batch[0], batch[1].to(th.uint8).view(-1, 1, 1, 1, 1).expand_as(batch[0]))
+        alive.append(batch)
+
+    loader = thd.DataLoader(Frames(), batch_size=2, num_workers=0, collate_fn=ds.buffered_collate)
+    for depth in [0, 3]:
+        alive = []
+        pe.PrefetchEngine(check, th.device('cpu'), True, depth).run(loader)
+        assert len(alive) == 12 and len(set(batch[0].data_ptr() for batch in alive)) == depth + 2
+
+
+def test_batch_normalise():
+    means, stds = [0.4, 0.5, 0.6], [0.2, 0.25, 0.3]
+    frames = th.randint(0, 256, (2, 4, 3, 8, 8), dtype=th.uint8)
+    recon = th.randint(0, 256, (2, 4, 3, 4, 4), dtype=th.uint8)
+    _in, _, _recon = bt.BatchNormalise(means, stds)(frames, th.zeros(2), recon)
+
+    expected = mc.Standardize(means, stds)(frames.float().div(255).reshape(8, 3, 8, 8)).reshape(2, 4, 3, 8, 8)
+    assert th.allclose(_in, expected, atol=1e-5)
+    assert th.allclose(_recon, recon.float() / 255)
+
+
+def test_flow_cache(tmp_path):
+    meta_path, res = tmp_path / 'meta.dev.json', 8
+    entries = np.zeros((6, res, res, 2), dtype=np.float16)
+    entries[0:5, ..., 0] = 1.0
+    entries[5] = np.random.rand(res, res, 2)
+    dense_path, dense_index_path = fc.cache_paths(meta_path, 'dense', res)
+    entries[0:5].tofile(dense_path.as_posix())
+    pd.DataFrame({'offset': [0], 'count': [5]}, index=['v1']).to_json(dense_index_path, orient='index')
+    pairs_path, pairs_index_path = fc.cache_paths(meta_path, 'pairs', res)
+    entries[5:].tofile(pairs_path.as_posix())
+    pd.DataFrame([('v1', 1, 4)], columns=fc.PAIR_COLUMNS).to_json(pairs_index_path, orient='records')
+
+    cache = fc.FlowCache(meta_path, res)
+    flows = cache.read('v1', np.array([0, 0, 1, 4]))
+    assert np.all(flows[0] == 0) and np.allclose(flows[1][..., 0], 1.0)
+    assert np.allclose(flows[2], entries[5].astype(np.float32))
+    assert np.allclose(cache.read('v1', np.array([0, 3]))[0][..., 0], 3.0)
+    assert cache.read('v1', np.array([2, 6])) is None and cache.read('v2', np.array([0, 1])) is None
+
+
+def test_segment_sampler():
+    lengths = np.arange(4, 200)
+    for setting in ['train', 'eval']:
+        sampler = ss.SegmentSampler(lengths, 0.75, 8, setting, 0)
+        for i, length in enumerate(lengths):
+            cut_locs = np.arange(length)[0:int(round(length * 0.75)) - 1]
+            segments = [segment for segment in np.array_split(cut_locs, 8) if segment.size > 0]
+            segments += [segments[-1]] * (8 - len(segments))
+            if setting == 'eval':
+                assert [segment[len(segment) // 2] for segment in segments] == list(sampler[i])
+            else:
+                assert all(loc in segment for loc, segment in zip(sampler[i], segments))
+
+    sampler.set_epoch(1)
+    locs = sampler.locs.copy()
+    sampler.set_epoch(2)
+    sampler.load_state_dict({'seed': 0, 'epoch': 1})
+    assert np.array_equal(sampler.locs, locs)
+
+
+def test_meta_store(tmp_path, video_meta):
+    meta = video_meta(3, id=[3, 1, 2], framerate=[12, 12, 24], length=[40, 50, 60], width=[320, 427, 100],
+                      label=['a', 'bb', 'a'], keyframes=[[0, 12], np.nan, []]).set_index(pd.Index([3, 1, 2]))
+    hp.write_meta(meta, tmp_path / 'meta.npz')
+    loaded = hp.read_meta(tmp_path / 'meta.npz')
+    assert list(loaded.index) == [1, 2, 3] and loaded.loc[3, 'keyframes'] == [0, 12]
+    assert loaded.loc[1, 'keyframes'] is None and loaded.loc[2, 'keyframes'] == []
+
+    store = ms.MetaStore(meta, vm.VideoMeta.fields)
+    for item in range(len(meta)):
+        expected = meta.iloc[item].to_dict()
+        expected['keyframes'] = expected['keyframes'] if isinstance(expected['keyframes'], list) else None
+        assert store[item] == vm.VideoMeta(**expected)
+
+    store.share()
+    shared = pickle.loads(pickle.dumps(store))
+    assert isinstance(shared.columns['id'], np.memmap) and shared.path == store.path
+    assert [shared[item] for item in range(len(meta))] == [store[item] for item in range(len(meta))]
+
+
+def test_meta_store_nulls(tmp_path, video_meta):
+    meta = video_meta(3, label=['a', None, 'b'], keyframes=None)
+    hp.write_meta(meta, tmp_path / 'meta.npz')
+    loaded = hp.read_meta(tmp_path / 'meta.npz')
+    assert pd.isnull(loaded.loc[1, 'label']) and loaded['keyframes'].isnull().all()
+
+    store = ms.MetaStore(loaded, vm.VideoMeta.fields)
+    assert store[1].label is None and all(store[item].keyframes is None for item in range(3))
+    assert store[0].label == 'a' and store[2] == vm.VideoMeta(**{**loaded.iloc[2].to_dict(), 'keyframes': None})
+
+
+def test_compiled_meta(tmp_path):
+    path = tmp_path / 'meta.train.json'
+    meta = pd.DataFrame({'id': [2, 1], 'label': ['b', None], 'length': [30, 40],
+                         'keyframes': [[0, 12], None]}, index=[2, 1])
+    meta.to_json(path, orient='index')
+    expected = hp.read_meta(path)
+
+    compiled = hp.compile_json(path, hp.META_JSON)
+    path.write_text('{}')
+    os.utime(path.as_posix(), (0, 0))
+    loaded = hp.read_meta(path)
+    assert list(loaded.index) == list(expected.index) and pd.isnull(loaded.loc[1, 'label'])
+    assert loaded.loc[2, 'keyframes'] == [0, 12] and np.array_equal(loaded['length'], expected['length'])
+
+    with np.load(compiled.as_posix()) as data:
+        columns = {name: data[name] for name in data.files}
+    columns['length'][0] = 0
+    np.savez(compiled.as_posix(), **columns)
+    os.utime(path.as_posix(), (0, 0))
+    assert len(hp.read_meta(path)) == 0
+
+
+def test_persistent_loader():
+    class EpochSet(thd.Dataset):
+        def __getitem__(self, item):
+            epoch, item = item
+            return epoch, item, os.getpid()
+
+        def __len__(self):
+            return 10
+
+    loader = pl.PersistentDataLoader(EpochSet(), batch_size=4, shuffle=True, num_workers=2, collate_fn=list)
+    loader.set_epoch(3)
+    pids = set()
+    for epoch in [3, 4, 5]:
+        batches = list(loader)
+        assert len(batches) == len(loader) == 3
+        assert sorted(item for batch in batches for _, item, _ in batch) == list(range(10))
+        assert all(_epoch == epoch for batch in batches for _epoch, _, _ in batch)
+        pids.update(pid for batch in batches for _, _, pid in batch)
+    assert len(pids) <= 2
+
+    # passes left part-way do not leak batches of their epoch into the next pass.
+    passes = iter(loader)
+    assert all(_epoch == 6 for _epoch, _, _ in next(passes))
+    passes.close()
+    pe.PrefetchEngine(lambda engine, batch: engine.terminate(), None, True, 2).run(loader)
+    batches = list(loader)
+    assert sorted(item for batch in batches for _, item, _ in batch) == list(range(10))
+    assert all(_epoch == 8 for batch in batches for _epoch, _, _ in batch)
+    loader.close()
+
+
+def test_device_prefetcher():
+    batches = [(th.full((2, 3), i), th.tensor([i, i]), th.empty(0), [f'meta{i}']) for i in range(5)]
+    for depth in [0, 2]:
+        seen = []
+        engine = pe.PrefetchEngine(lambda _engine, batch: seen.append(batch), th.device('cpu'), True, depth)
+        engine.run(batches, max_epochs=2)
+        assert [batch[3] for batch in seen] == [batch[3] for batch in batches] * 2
+        assert all(th.equal(a[0], b[0]) for a, b in zip(seen, batches * 2))
+        assert engine.state.metrics[pe.DATA_WAIT] >= 0.0
+
+    def failing():
+        yield batches[0]
+        raise RuntimeError('loader failed')
+
+    prefetcher = pe.DevicePrefetcher(failing(), th.device('cpu'))
+    iterator = iter(prefetcher)
+    next(iterator)
+    with pytest.raises(RuntimeError):
+        next(iterator)
+
+
+def test_frame_cache(tmp_path, monkeypatch):
+    frame = np.random.randint(0, 255, (240, 320, 3), dtype=np.uint8)
+    cache = frc.FrameCache(budget=8 * frame.nbytes, path=tmp_path / 'frames')
+    cache.put('a/1', [0, 1], [frame, frame + 1])
+    assert [f is None for f in cache.get('a/1', [1, 2])] == [False, True]
+    assert np.array_equal(cache.get('a/1', [1])[0], frame + 1)
+
+    os.utime(cache._frame_path('a/1', 0).as_posix(), (0, 0))
+    os.utime(cache._frame_path('a/1', 1).as_posix(), (1, 1))
+    time.sleep(0.01)
+    cache.get('a/1', [0])
+    cache.put('b', list(range(6)), [frame] * 6)
+    assert cache.used.value <= 8 * frame.nbytes and len(cache) == 7
+    assert cache.get('a/1', [0])[0] is not None and cache.get('a/1', [1])[0] is None
+
+    # workers that both miss a frame cache it once.
+    cache = frc.FrameCache(budget=8 * frame.nbytes, path=tmp_path / 'race')
+    with monkeypatch.context() as patch:
+        patch.setattr(frc.pl.Path, 'exists', lambda _path: False)
+        cache.put('c', [0], [frame])
+        cache.put('c', [0], [frame + 1])
+    assert cache.used.value == os.path.getsize(cache._frame_path('c', 0).as_posix())
+    assert np.array_equal(cache.get('c', [0])[0], frame) and not list(cache.path.glob('*.tmp'))
+
+    shared = frc.FrameCache(budget=frame.nbytes)
+    path = shared.path
+    assert path.exists()
+    del shared
+    assert not path.exists()
+
+
+def test_multi_view_video():
+    class LocStore(object):
+        def __init__(self):
+            self.reads = []
+
+        def read(self, _id, locs):
+            self.reads.append(list(locs))
+            return [np.full((240, 320, 3), loc, dtype=np.uint8) for loc in locs]
+
+    store = LocStore()
+    meta = vm.VideoMeta(0, 12, 30, 240, 320, 'a', 0, 'v/0.avi', 'i/0')
+    clip_locs = ss.SegmentSampler(np.array([30]), 1.0, 4, 'eval').clips(2)[0]
+    eval_seq = ia.Sequential([ia.PadToFixedSize(224, 224, position='center'),
+                              ia.CropToFixedSize(224, 224, position='center')])
+    video = dv.MultiViewVideo(meta, None, False, 1.0, 4, False, eval_seq, clip_locs, 3, store=store)
+    assert store.reads == [sorted(set(clip_locs.reshape(-1)))]
+    assert len(video.data) == 2 * 3 * 4 and len(video.recon) == 2 * 3 * 4
+    views = np.array([frame[0, 0, 0] for frame in video.data]).reshape(2, 3, 4)
+    assert np.array_equal(views, np.repeat(clip_locs[:, np.newaxis], 3, axis=1))
+
+    y_pred = th.randn(2 * 6, 5)
+    assert pe.fold_views(th.zeros(2, 6 * 4, 3, 8, 8), 6).shape == (12, 4, 3, 8, 8)
+    probs = pe.average_views(y_pred, 6).exp()
+    assert th.allclose(probs, th.softmax(y_pred, dim=-1).reshape(2, 6, 5).mean(dim=1))
+
+
+def test_seek_frames(tmp_path, write_video):
+    write_video('0.avi', 24)
+
+    video = dv.Video.__new__(dv.Video)
+    video.root_path, video.subsample_locs = tmp_path, np.array([2, 9, 9, 17])
+    video.meta = vm.VideoMeta(0, 12, 24, 48, 64, 'a', 0, '0.avi', 'i/0', [0, 8, 16])
+    seeked = video._seek_frames(cv2.VideoCapture((tmp_path / '0.avi').as_posix()))
+    assert [int(round(frame[0, 0, 0] / 10)) for frame in seeked] == [2, 9, 9, 17]
+    # a framerate that does not match the decoded timestamps is taken for an inaccurate seek.
+    video.meta.framerate = 24
+    assert video._seek_frames(cv2.VideoCapture((tmp_path / '0.avi').as_posix())) is None
+
+
+def test_bucket_sampler():
+    lengths = np.random.RandomState(0).randint(20, 400, 203)
+    sampler = bs.BucketBatchSampler(lengths, 8, 4, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 26
+    assert sorted(i for batch in batches for i in batch) == list(range(203))
+    spread = np.mean([np.ptp(lengths[batch]) for batch in batches])
+    assert spread < np.ptp(lengths) / 4
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+    replicas = [bs.BucketBatchSampler(lengths, 8, 4, num_replicas=3, rank=rank, seed=1) for rank in range(3)]
+    batches = [list(replica) for replica in replicas]
+    assert all(len(batch) == len(replicas[0]) == 9 for batch in batches)
+    assert set(i for rank in batches for batch in rank for i in batch) == set(range(203))
+
+
+def test_shards(tmp_path, video_meta, write_jpegs):
+    meta = video_meta(5)
+    write_jpegs(meta, 7)
+    meta_path = tmp_path / 'meta.train.json'
+    hp.write_meta(meta, meta_path)
+    pws.DATA_ROOT_DIR, pws.SHARD_SIZE = tmp_path, 2
+    pws.write_shards(meta_path)
+
+    dso = do.DataSetOptions(tmp_path, meta_path, False, 'eval', read_shards=True)
+    dataset = sd.ShardedVideoDataset(1.0, 224, dso, do.SamplingOptions(4))
+    assert len(dataset.shards) == 3 and len(dataset) == 5
+    assert sorted(meta.id for _, _, meta in dataset) == list(range(5))
+    # frames come from the locations of the segment sampler, keyed by the meta position of the sample.
+    dataset.sampler.locs = np.array([[6, 4, 2, 0], [1, 2, 3, 4], [0, 0, 1, 1], [5, 5, 5, 5], [3, 2, 1, 0]])
+    for video, _, meta in dataset:
+        assert [int(round(frame[0, 112, 112].item() * 25.5)) for frame in video.data] == list(dataset.sampler[meta.id])
+
+    dso.setting = 'train'
+    dataset = sd.ShardedVideoDataset(1.0, 224, dso, do.SamplingOptions(4))
+    loader = sd.ShardLoader(dataset, batch_size=2, num_workers=2, collate_fn=dataset.collate)
+    batches = list(loader)
+    assert len(batches) == len(loader) == 3 and sum(len(batch[3]) for batch in batches) == 5
+
+
+def test_extract_jpeg(tmp_path, video_meta, write_video, write_jpegs):
+    write_video('v/0.avi', 6, size=(320, 240), step=20)
+    meta = video_meta(1, length=6, height=240, width=320)
+    meta_path = tmp_path / 'meta.train.json'
+    hp.write_meta(meta, meta_path)
+    pej.DATA_ROOT_DIR, pej.MAX_SIZE, pej.QUALITY = tmp_path, 160, 80
+
+    # complete trees extracted before the manifest existed are recorded instead of being extracted again.
+    write_jpegs(meta, 6, size=(160, 120))
+    pej.extract_jpeg(meta_path)
+    assert abs(int(cv2.imread((tmp_path / 'i/0/0002.jpeg').as_posix())[0, 0, 0]) - 10) < 5
+    assert pej.manifest_path(meta_path).read_text() == '0\t6\t160\t80\n'
+
+    pej.manifest_path(meta_path).unlink()
+    (tmp_path / 'i/0/0006.jpeg').unlink()
+    pej.extract_jpeg(meta_path)
+    names = sorted(path.name for path in (tmp_path / 'i/0').iterdir())
+    assert ji._infer_pattern(names) == ('%04d.jpeg', 1, 6)
+    frame = cv2.imread((tmp_path / 'i/0/0002.jpeg').as_posix())
+    assert frame.shape == (120, 160, 3) and abs(int(frame[0, 0, 0]) - 20) < 5
+
+    (tmp_path / 'i/0/0001.jpeg').unlink()
+    pej.extract_jpeg(meta_path)
+    assert not (tmp_path / 'i/0/0001.jpeg').exists()
+    assert pej.manifest_path(meta_path).read_text() == '0\t6\t160\t80\n'
+
+
+def test_probe_meta():
+    output = json.dumps({'packets': [{'flags': 'K_'}, {'flags': '__'}, {'flags': '__'}, {'flags': 'K_'}],
+                         'streams': [{'width': 427, 'height': 240, 'avg_frame_rate': '30000/1001',
+                                      'nb_read_frames': '3'}]})
+    fields, keyframes, decoded = pam._parse_probe(output)
+    assert fields == {'length': 4, 'height': 240, 'width': 427, 'framerate': 30}
+    assert keyframes == [0, 3] and decoded == 3
+
+    # packets in decode order of an open gop: I0 P3 B1 B2 I6 B4 B5.
+    packets = [{'pts_time': f'{pts / 30:.6f}', 'flags': 'K_' if pts in [0, 6] else '__'}
+               for pts in [0, 3, 1, 2, 6, 4, 5]]
+    output = json.dumps({'packets': packets, 'streams': [{'width': 64, 'height': 48, 'avg_frame_rate': '30/1'}]})
+    fields, keyframes, decoded = pam._parse_probe(output)
+    assert fields['length'] == 7 and keyframes == [0, 6] and decoded is None
+
+
+def test_parallel_execute():
+    def double(batch):
+        no, batch = batch
+        if no == 1 and 1 not in attempts:
+            attempts.add(1)
+            raise ValueError('transient')
+        return hp.parallel.Result(len(batch), [(no, item * 2) for item in batch])
+
+    attempts = set()
+    results = hp.parallel.execute(double, iter(range(50)), 4, workers=2, threads=True, window=2)
+    assert not isinstance(results, list)
+    results = list(results)
+    assert sorted(item for _, item in results) == list(range(0, 100, 2))
+    assert sorted(set(no for no, _ in results)) == list(range(13))
+
+    attempts = {1}
+    adaptive = list(hp.parallel.execute(double, list(range(50)), 1, workers=2, threads=True, target_seconds=1.0))
+    assert len(adaptive) == 50 and max(no for no, _ in adaptive) < 49
+
+    with pytest.raises(RuntimeError):
+        list(hp.parallel.execute(lambda batch: 1 / 0, range(4), 2, workers=2, threads=True, retries=0))
@@ -0,0 +1,62 @@
+import torch as th
+from torch import nn
+
+import metrics.custom as cm
+import models.common as mc
+import pro.engine as pe
+from criterion.custom import VAECriterion
+
+
+def test_mixed_precision():
+    amp = pe.MixedPrecision('cpu', True)
+    assert amp.dtype == th.bfloat16 and amp.scaler is None and amp.state_dict() == {}
+    var = nn.Sequential(nn.Linear(8, 8), mc.Float32(nn.Softplus()))
+    with amp.autocast():
+        mean = nn.Linear(8, 8)(th.randn(4, 8))
+        kld = VAECriterion().kld(mean, var(th.randn(4, 8)) + 1e-5)
+    assert mean.dtype == th.bfloat16 and kld.dtype == th.float32
+
+    model = nn.Linear(6, 3)
+    model.forward = lambda _in, forward=model.forward: (forward(_in.reshape(2, 6)), None, None)
+    trainer = pe.create_cls_trainer(model, th.optim.SGD(model.parameters(), lr=0.1), nn.CrossEntropyLoss(),
+                                    device=None, transform=lambda *batch: batch, prefetch=0, amp=amp)
+    weight = model.weight.clone()
+    trainer.run([(th.randn(2, 2, 3), th.tensor([0, 2]), th.empty(0), None)])
+    assert trainer.state.output[1].dtype == th.bfloat16 and not th.equal(weight, model.weight)
+
+
+def test_gradient_accumulation():
+    batch = (th.randn(6, 2, 3), th.tensor([0, 2, 1, 1, 0, 2]), th.empty(0), list(range(6)))
+    grads, outputs = [], []
+    for steps in [1, 4]:
+        th.manual_seed(0)
+        model = nn.Linear(6, 3)
+        forward = model.forward
+        model.forward = lambda _in: (forward(_in.reshape(-1, 6)), None, None)
+        optimizer = th.optim.SGD(model.parameters(), lr=0.0)
+        trainer = pe.create_cls_trainer(model, optimizer, nn.CrossEntropyLoss(), device=None,
+                                        transform=lambda *data: data, prefetch=0, accumulation_steps=steps)
+        trainer.run([batch])
+        grads.append(model.weight.grad.clone())
+        outputs.append(trainer.state.output)
+    assert th.allclose(grads[0], grads[1], atol=1e-6)
+    assert abs(outputs[0][0] - outputs[1][0]) < 1e-5 and outputs[1][1].shape == (6, 3)
+
+
+def test_log_every():
+    th.manual_seed(0)
+    model = nn.Linear(6, 3)
+    forward = model.forward
+    model.forward = lambda _in: (forward(_in.reshape(-1, 6)), None, None)
+    optimizer = th.optim.SGD(model.parameters(), lr=0.1)
+    metrics = {'acc_1': cm.RunningAverage(output_transform=lambda x: cm.accuracy(x[1], x[2])),
+               'ce_loss': cm.RunningAverage(output_transform=lambda x: x[0])}
+    trainer = pe.create_cls_trainer(model, optimizer, nn.CrossEntropyLoss(), metrics, device=None,
+                                    transform=lambda *data: data, prefetch=0, log_every=3)
+    logged = []
+    trainer.add_event_handler(pe.LOG_ITERATION, lambda engine: logged.append(dict(engine.state.metrics)))
+    batches = [(th.randn(4, 2, 3), th.tensor([0, 2, 1, 1]), th.empty(0), None) for _ in range(4)]
+    trainer.run(batches)
+    assert len(logged) == 2 and isinstance(trainer.state.output[0], th.Tensor)
+    assert all(isinstance(logs[name], float) for logs in logged for name in metrics)
+    assert logged[0]['ce_loss'] != logged[1]['ce_loss']
@@ -0,0 +1,18 @@
+import torch as th
+from torch import nn
+
+import metrics.custom as cm
+
+
+def test_sum_metrics():
+    th.manual_seed(0)
+    y_pred, y = th.randn(7, 6), th.tensor([0, 1, 2, 3, 4, 5, 0])
+    metrics = [cm.Accuracy(), cm.Accuracy(k=5), cm.Loss(nn.CrossEntropyLoss())]
+    for metric in metrics:
+        metric.reset()
+        metric.update((y_pred[:3], y[:3]))
+        metric.update((y_pred[3:], y[3:]))
+        assert isinstance(metric._sums, th.Tensor)
+    acc_1, acc_5, loss = [metric.compute() for metric in metrics]
+    assert abs(acc_1 - cm.accuracy(y_pred, y).item()) < 1e-6 and abs(acc_5 - cm.top_k_accuracy(y_pred, y).item()) < 1e-6
+    assert abs(loss - nn.CrossEntropyLoss()(y_pred, y).item()) < 1e-6
@@ -6,6 +6,9 @@ import pytest
 import torch as th
 
 import helpers as hp
+import models.helpers as mh
+import models.tarn.common as tc
+import models.tarn.vae._temporal_encoder as vte
 import specs.maps as sm
 import specs.models as mo
 
@@ -176,3 +179,38 @@ def test_vae_model(model_spec: str, time_steps: int):
     assert var_inf_class_embed.shape == (BATCH_SIZE, VAE_TEST_NUM_SAMPLES, class_embed_planes)
     assert var_inf_recon.shape == (BATCH_SIZE, VAE_TEST_NUM_SAMPLES, time_steps, C, H, W)
     assert var_inf_vote.shape == (BATCH_SIZE, NUM_CLASSES)
+
+
+def test_grad_checkpoint(monkeypatch):
+    checkpoint = mh.cp.checkpoint
+
+    def tensors_only(function, *args, **kwargs):
+        # the reentrant checkpoint of older torch versions saves its inputs for backward, which only takes tensors.
+        assert all(isinstance(arg, th.Tensor) for arg in args) and kwargs == mh.CHECKPOINT_KWARGS
+        return checkpoint(function, *args, **kwargs)
+
+    monkeypatch.setattr(mh.cp, 'checkpoint', tensors_only)
+    th.manual_seed(0)
+    encoder = tc.TemporalResNetEncoder(4, 8)
+    _in = th.randn(2, 4, 8, 6, 6, requires_grad=True)
+    grads, stats = [], []
+    for enabled in [False, True]:
+        assert mh.set_grad_checkpoint(encoder, enabled) == 1
+        encoder.zero_grad()
+        _in.grad = None
+        norm = encoder.temporal[0].bn1
+        norm.reset_running_stats()
+        _out, _outs = encoder(_in)
+        _outs.sum().backward()
+        grads.append((_in.grad.clone(), encoder.temporal[0].conv1.weight.grad.clone()))
+        stats.append((norm.running_mean.clone(), norm.num_batches_tracked.clone()))
+    assert all(th.allclose(plain, ckpt, atol=1e-5) for plain, ckpt in zip(*grads))
+    assert all(th.allclose(plain, ckpt) for plain, ckpt in zip(*stats))
+    norms = [module for module in encoder.modules() if isinstance(module, th.nn.modules.batchnorm._BatchNorm)]
+    assert norms and all(norm.track_running_stats for norm in norms)
+
+    encoder = vte.VarTemporalResNetEncoder(4, 8)
+    assert mh.set_grad_checkpoint(encoder, True) == 1
+    _zs, _means, _vars, *_ = encoder(th.randn(2, 1, 4, 8, 6, 6, requires_grad=True), 2)
+    _zs.sum().backward()
+    assert encoder.temporal[0].mean.weight.grad is not None